@@ -0,0 +1,295 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Admission control and load shedding.
+
+Requests are sorted into route classes by their longest matching path prefix,
+so "/wells/latest" can be bulk while the rest of "/wells" is interactive. Each
+class has its own concurrency limit and bounded queue, and all classes share
+a total limit sized to the database pool. When a slot frees up, queued requests are admitted in
+priority order so interactive traffic overtakes bulk harvests. Requests that
+find their queue full, or wait longer than the queue timeout, are shed
+immediately with a Retry-After header.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+
+import metrics
+from database import POOL_SIZE, MAX_OVERFLOW
+
+
+class RouteClass:
+    def __init__(
+        self,
+        name,
+        prefixes,
+        limit,
+        queue,
+        priority=0,
+        status_code=503,
+        retry_after=1,
+    ):
+        self.name = name
+        self.prefixes = tuple(prefixes)
+        self.limit = limit
+        self.queue = queue
+        self.priority = priority
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "queue_timeout": 0}
+        self.wait_seconds = 0.0
+
+
+class Shed(Exception):
+    def __init__(self, route_class, reason):
+        self.route_class = route_class
+        self.reason = reason
+
+
+class AdmissionController:
+    def __init__(self, classes, total, queue_timeout=5.0):
+        self.classes = classes
+        self.total = total
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def classify(self, path):
+        match, length = None, -1
+        for rc in self.classes:
+            for prefix in rc.prefixes:
+                if (
+                    path == prefix or path.startswith(prefix.rstrip("/") + "/")
+                ) and len(prefix) > length:
+                    match, length = rc, len(prefix)
+        return match
+
+    def _can_admit(self, rc):
+        return rc.active < rc.limit and self.active < self.total
+
+    def _admit(self, rc):
+        rc.active += 1
+        rc.admitted += 1
+        self.active += 1
+
+    async def acquire(self, rc):
+        # only take a free slot directly if nobody of equal or higher priority is queued
+        if self._can_admit(rc) and not any(
+            w[0] <= rc.priority and not w[3].done() for w in self._waiters
+        ):
+            self._admit(rc)
+            return
+
+        if rc.waiting >= rc.queue:
+            rc.shed["queue_full"] += 1
+            raise Shed(rc, "queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (rc.priority, next(self._seq), rc, future))
+        rc.waiting += 1
+        st = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # admitted just as we timed out. keep the slot
+                return
+            future.cancel()
+            rc.shed["queue_timeout"] += 1
+            raise Shed(rc, "queue_timeout")
+        except asyncio.CancelledError:
+            # client went away while queued. don't leak a slot we were handed
+            if future.done() and not future.cancelled():
+                self.release(rc)
+            else:
+                future.cancel()
+            raise
+        finally:
+            rc.waiting -= 1
+            rc.wait_seconds += time.monotonic() - st
+
+    def release(self, rc):
+        rc.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        skipped = []
+        while self._waiters and self.active < self.total:
+            item = heapq.heappop(self._waiters)
+            _, _, rc, future = item
+            if future.done():
+                continue
+            if rc.active < rc.limit:
+                self._admit(rc)
+                future.set_result(True)
+            else:
+                skipped.append(item)
+
+        for item in skipped:
+            heapq.heappush(self._waiters, item)
+
+    def collect(self):
+        def samples(attr):
+            return [({"class": rc.name}, getattr(rc, attr)) for rc in self.classes]
+
+        return [
+            (
+                "admission_active",
+                "gauge",
+                "Requests currently admitted",
+                samples("active"),
+            ),
+            (
+                "admission_queue_depth",
+                "gauge",
+                "Requests waiting for admission",
+                samples("waiting"),
+            ),
+            (
+                "admission_limit",
+                "gauge",
+                "Concurrency limit",
+                samples("limit") + [({"class": "total"}, self.total)],
+            ),
+            (
+                "admission_admitted_total",
+                "counter",
+                "Requests admitted",
+                samples("admitted"),
+            ),
+            (
+                "admission_wait_seconds_total",
+                "counter",
+                "Time spent queued for admission",
+                samples("wait_seconds"),
+            ),
+            (
+                "admission_shed_total",
+                "counter",
+                "Requests rejected by admission control",
+                [
+                    ({"class": rc.name, "reason": reason}, n)
+                    for rc in self.classes
+                    for reason, n in rc.shed.items()
+                ],
+            ),
+        ]
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        rc = self.controller.classify(scope["path"])
+        if rc is None:
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.controller.acquire(rc)
+        except Shed as e:
+            return await self._reject(e, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(rc)
+
+    async def _reject(self, shed, send):
+        rc = shed.route_class
+        body = json.dumps(
+            {"detail": f"server busy ({rc.name} {shed.reason}). retry later"}
+        ).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": rc.status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(rc.retry_after).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def make_controller():
+    """
+    build the controller from ADMISSION_* environment variables. by default the
+    total limit matches the database pool so admitted requests never wait on
+    a pool checkout, and bulk routes may use at most half of it
+    """
+    total = env_int("ADMISSION_TOTAL", POOL_SIZE + MAX_OVERFLOW)
+    classes = [
+        RouteClass(
+            "interactive",
+            ("/map", "/locations", "/well", "/wells", "/pod", "/graphql", "/batch"),
+            limit=env_int("ADMISSION_INTERACTIVE_LIMIT", total),
+            queue=env_int("ADMISSION_INTERACTIVE_QUEUE", 4 * total),
+            priority=0,
+            status_code=503,
+            retry_after=env_int("ADMISSION_INTERACTIVE_RETRY_AFTER", 1),
+        ),
+        RouteClass(
+            "bulk",
+            (
+                "/waterlevels",
+                "/ngwmn",
+                "/waterchem",
+                "/changes",
+                "/jobs",
+                # statewide reads
+                "/wells/latest",
+                "/wells/surface",
+            ),
+            limit=env_int("ADMISSION_BULK_LIMIT", max(1, total // 2)),
+            queue=env_int("ADMISSION_BULK_QUEUE", total),
+            priority=1,
+            status_code=429,
+            retry_after=env_int("ADMISSION_BULK_RETRY_AFTER", 5),
+        ),
+    ]
+    return AdmissionController(
+        classes,
+        total,
+        queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 5)),
+    )
+
+
+controller = make_controller()
+metrics.register(controller.collect)
+
+# ============= EOF =============================================
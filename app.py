@@ -33,8 +33,4 @@ app = FastAPI(
 )
 
 
-# from graphql_app import graphql_app
-# app.add_route("/graphql", graphql_app)
-# app.add_websocket_route("/graphql", graphql_app)
-
 # ============= EOF =============================================
@@ -0,0 +1,169 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Worker startup benchmark.
+
+Imports the app in fresh interpreters and reports import time, idle RSS and
+which heavy optional dependencies got pulled in. With --serve it also boots a
+uvicorn worker and times it until /metrics answers.
+
+    python bench_startup.py
+    python bench_startup.py --runs 10 --modules 15
+    python bench_startup.py --serve
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+HEAVY = ("pandas", "numpy", "plotly", "jinja2", "matplotlib", "pyarrow")
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t
+rss = 0
+with open("/proc/self/status") as rfile:
+    for line in rfile:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1]) / 1024
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"import_s": elapsed, "rss_mb": rss, "heavy": heavy}}))
+"""
+
+
+def probe(module):
+    code = PROBE.format(module=module, heavy=HEAVY)
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def import_profile(module, n):
+    """
+    the n slowest top-level imports (cumulative) from -X importtime
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # direct children of the probe only (two spaces of indentation)
+        if name.startswith("   ") and not name.startswith("    "):
+            try:
+                rows.append((int(cumulative) / 1e6, name.strip()))
+            except ValueError:
+                pass
+    return sorted(rows, reverse=True)[:n]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_of(pid):
+    with open(f"/proc/{pid}/status") as rfile:
+        for line in rfile:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def serve_probe(app, timeout=60):
+    """
+    seconds from spawn until /metrics answers, and the worker's idle RSS
+    """
+    port = free_port()
+    st = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - st < timeout:
+            try:
+                requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.02)
+        else:
+            raise RuntimeError("worker did not come up")
+
+        ready = time.perf_counter() - st
+        time.sleep(0.5)
+        return ready, rss_of(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def summarize(label, values, unit):
+    print(
+        f"{label:<16} median {statistics.median(values):8.3f} {unit}"
+        f"   min {min(values):8.3f}   max {max(values):8.3f}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--app", default="main:app")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modules", type=int, default=10, help="top N imports")
+    parser.add_argument("--serve", action="store_true")
+    args = parser.parse_args(argv)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    results = [probe(args.module) for _ in range(args.runs)]
+    print(f"import {args.module} x{args.runs}")
+    summarize("import time", [r["import_s"] for r in results], "s")
+    summarize("idle rss", [r["rss_mb"] for r in results], "MB")
+    print(f"heavy modules loaded: {', '.join(results[0]['heavy']) or 'none'}")
+
+    if args.modules:
+        print(f"\nslowest imports ({args.module})")
+        for seconds, name in import_profile(args.module, args.modules):
+            print(f"  {seconds:8.3f} s  {name}")
+
+    if args.serve:
+        ready, rss = zip(*(serve_probe(args.app) for _ in range(args.runs)))
+        print(f"\nuvicorn {args.app} x{args.runs}")
+        summarize("time to ready", ready, "s")
+        summarize("worker rss", rss, "MB")
+
+
+if __name__ == "__main__":
+    main()
+
+# ============= EOF =============================================
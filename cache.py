@@ -0,0 +1,330 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Result cache for crud readers.
+
+    @cache.cached(ttl=600, tags=lambda pointid: [f"pointid:{pointid}", "table:WaterLevels"])
+    def read_waterlevels_manual(pointid, db):
+        ...
+
+    cache.invalidate("pointid:MG-030")
+
+Keys are built from the function name and its arguments, ignoring the
+session. Backends are selected with CACHE_BACKEND:
+
+    memory  in-process LRU bounded by CACHE_MAX_BYTES (default)
+    redis   shared cache at CACHE_REDIS_URL. needs the `redis` package
+    none    caching disabled
+
+Per function TTLs can be overridden with CACHE_TTL_<FUNCTION_NAME> (seconds,
+0 disables caching for that function).
+
+Freshness is TTL based. The database is loaded by other systems and the API
+never writes to it, so nothing in the app calls invalidate(): new data shows
+up once the entries holding the old data expire. Tags let a writer (a sync
+job, a test) drop entries early.
+
+Cached values are shared between sessions and threads (and pickled for
+redis). Readers must return plain data (rows, dicts, pydantic models), never
+session-bound ORM instances.
+"""
+
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+
+from sqlalchemy.orm import Session
+
+import metrics
+
+MISSING = object()
+
+
+def sizeof(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+# backends =====================================================================
+class NullBackend:
+    def get(self, key):
+        return MISSING
+
+    def set(self, key, value, ttl, tags):
+        pass
+
+    def invalidate(self, tags):
+        return 0
+
+    def clear(self):
+        pass
+
+    def info(self):
+        return {}
+
+
+class MemoryBackend:
+    """
+    thread safe LRU bounded by the (pickled) size of its entries
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._tags = defaultdict(set)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+
+            value, size, expires, tags = entry
+            if expires and expires < time.monotonic():
+                self._remove(key)
+                return MISSING
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl, tags):
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+            self._data[key] = (value, size, expires, tags)
+            self.bytes += size
+            for tag in tags:
+                self._tags[tag].add(key)
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        n = 0
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    if key in self._data:
+                        self._remove(key)
+                        n += 1
+        return n
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self.bytes = 0
+
+    def info(self):
+        return {
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "entries": len(self._data),
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key):
+        value, size, expires, tags = self._data.pop(key)
+        self.bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend:
+    """
+    shared cache over any client with the redis-py interface. values are
+    pickled; each tag is a set of the keys carrying it, expiring with the
+    longest lived of them
+    """
+
+    def __init__(self, client, prefix="nmaquifer:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        blob = self.client.get(f"{self.prefix}{key}")
+        if blob is None:
+            return MISSING
+        return pickle.loads(blob)
+
+    def set(self, key, value, ttl, tags):
+        key = f"{self.prefix}{key}"
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.client.set(key, blob, ex=int(ttl) if ttl else None)
+        for tag in tags:
+            tkey = f"{self.prefix}tag:{tag}"
+            self.client.sadd(tkey, key)
+            # a tag set lives as long as its longest lived entry, so the keys
+            # of expired entries don't pile up in it forever
+            if not ttl:
+                self.client.persist(tkey)
+            elif self.client.ttl(tkey) < int(ttl):
+                self.client.expire(tkey, int(ttl))
+
+    def invalidate(self, tags):
+        n = 0
+        for tag in tags:
+            tkey = f"{self.prefix}tag:{tag}"
+            keys = self.client.smembers(tkey)
+            if keys:
+                n += self.client.delete(*keys)
+            self.client.delete(tkey)
+        return n
+
+    def clear(self):
+        keys = self.client.keys(f"{self.prefix}*")
+        if keys:
+            self.client.delete(*keys)
+
+    def info(self):
+        return {}
+
+
+def make_backend():
+    kind = os.environ.get("CACHE_BACKEND", "memory").lower()
+    if kind == "none":
+        return NullBackend()
+    elif kind == "redis":
+        import redis
+
+        url = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+        return RedisBackend(redis.Redis.from_url(url))
+    else:
+        return MemoryBackend(int(os.environ.get("CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+
+
+# cache ========================================================================
+class Stats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+
+class Cache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = {}
+
+    def cached(self, ttl=300, tags=None, name=None):
+        """
+        cache a reader's return value.
+
+        tags is a list of tags or a callable taking the reader's arguments
+        (minus the session) and returning a list of tags
+        """
+
+        def decorator(func):
+            fname = name or func.__name__
+            signature = inspect.signature(func)
+            stats = self.stats[fname] = Stats()
+            fttl = float(os.environ.get(f"CACHE_TTL_{fname.upper()}", ttl))
+
+            @wraps(func)
+            def wrapper(*args, **kw):
+                if not fttl:
+                    return func(*args, **kw)
+
+                bound = signature.bind(*args, **kw)
+                bound.apply_defaults()
+                keyargs = {
+                    k: v
+                    for k, v in bound.arguments.items()
+                    if not isinstance(v, Session)
+                }
+                key = make_key(fname, keyargs)
+
+                value = self._get(key, stats)
+                if value is not MISSING:
+                    stats.hits += 1
+                    return value
+
+                stats.misses += 1
+                value = func(*args, **kw)
+                ts = tags(**keyargs) if callable(tags) else (tags or [])
+                self._set(key, value, fttl, [t for t in ts if t], stats)
+                return value
+
+            wrapper.uncached = func
+            return wrapper
+
+        return decorator
+
+    def invalidate(self, *tags):
+        return self.backend.invalidate(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def _get(self, key, stats):
+        # a shared cache going away shouldn't take the API down with it
+        try:
+            return self.backend.get(key)
+        except Exception:
+            stats.errors += 1
+            return MISSING
+
+    def _set(self, key, value, ttl, tags, stats):
+        try:
+            self.backend.set(key, value, ttl, tags)
+        except Exception:
+            stats.errors += 1
+
+    def collect(self):
+        def samples(attr):
+            return [({"function": k}, getattr(v, attr)) for k, v in self.stats.items()]
+
+        ret = [
+            ("cache_hits_total", "counter", "Cache hits", samples("hits")),
+            ("cache_misses_total", "counter", "Cache misses", samples("misses")),
+            ("cache_errors_total", "counter", "Backend errors", samples("errors")),
+        ]
+        for k, v in self.backend.info().items():
+            ret.append((f"cache_{k}", "gauge", f"Cache backend {k}", [({}, v)]))
+        return ret
+
+
+def make_key(name, kw):
+    h = hashlib.sha1(repr(sorted(kw.items())).encode()).hexdigest()
+    return f"{name}:{h}"
+
+
+cache = Cache(make_backend())
+metrics.register(cache.collect)
+
+# ============= EOF =============================================
@@ -13,8 +13,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import os
+from datetime import timedelta
+
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    and_,
+    case,
+    column,
+    func,
+    inspect,
+    or_,
+    select,
+    union_all,
+)
+from sqlalchemy.orm import joinedload
+
 import models
 import requests
+import schemas
+from cache import cache
+from database import new_session
+from dependencies import BULK_TIMEOUT
+from singleflight import SingleFlight
+
+POD_SERVICE_URL = os.environ.get(
+    "POD_SERVICE_URL",
+    "https://services2.arcgis.com/qXZbWTdPDbTjl7Dy/arcgis/rest/services/OSE_PODs/FeatureServer/0/query",
+)
+# seconds to wait on the POD service before giving up
+POD_TIMEOUT = float(os.environ.get("POD_TIMEOUT", 3))
 
 
 def public_release_filter(q):
@@ -30,76 +59,513 @@ def read_locations(db, pointid=None):
     return q
 
 
-def read_waterlevels_acoustic_query(pointid, db, as_dict=False):
-    if as_dict:
-        q = db.query(models.WaterLevelsContinuous_Acoustic.__table__)
-    else:
-        q = db.query(models.WaterLevelsContinuous_Acoustic)
+def pointid_tags(table):
+    def tags(pointid=None, **kw):
+        return [f"pointid:{pointid}" if pointid else None, f"table:{table}"]
 
-    if pointid:
-        q = q.join(models.Well)
-        q = q.join(models.Location)
-        q = q.filter(models.Location.PointID == pointid)
-    q = q.order_by(models.WaterLevelsContinuous_Acoustic.DateMeasured)
+    return tags
+
+
+def location_record(location):
+    located = location.Easting is not None and location.Northing is not None
+    return schemas.LocationRecord(
+        LocationId=location.LocationId,
+        PointID=location.PointID,
+        Easting=location.Easting,
+        Northing=location.Northing,
+        Altitude=location.Altitude,
+        geometry=location.geometry if located else None,
+    )
+
+
+@cache.cached(ttl=600, tags=pointid_tags("Location"))
+def read_location_list(db, pointid=None):
+    """
+    public locations as schemas.LocationRecord. the cache shares its value
+    across sessions and threads, so no ORM instances
+    """
+    q = read_locations(db, pointid)
+    return [location_record(l) for l in q]
+
+
+@cache.cached(ttl=900, tags=["table:Location", "table:WellData"])
+def read_public_sites(db):
+    """
+    (PointID.upper() -> [WellID, ...], WellID -> PointID) for every publicly
+    released well. cached and refreshed every CACHE_TTL_READ_PUBLIC_SITES
+    seconds (default 15 min).
+
+    the upper-cased keys are for case-insensitive lookups only. responses use
+    the PointID as stored
+    """
+    q = db.query(models.Location.PointID, models.Well.WellID)
+    q = q.join(models.Well, models.Well.LocationId == models.Location.LocationId)
     q = public_release_filter(q)
+
+    wells, names = {}, {}
+    for pointid, wellid in q:
+        if pointid:
+            wells.setdefault(pointid.upper(), []).append(wellid)
+            names[wellid] = pointid
+    return wells, names
+
+
+def read_public_wells(db):
+    """
+    map of PointID.upper() -> [WellID, ...], for lookups
+    """
+    return read_public_sites(db)[0]
+
+
+def read_public_pointids(db):
+    """
+    map of WellID -> stored PointID, for output
+    """
+    return read_public_sites(db)[1]
+
+
+def public_wellids_filter(q, table, pointid, db):
+    """
+    restrict `table` to publicly released wells with a semi-join on WellID
+    instead of joining Well and Location into the result.
+
+    pointid(s) are resolved to WellIDs through the cached public well map.
+    unfiltered listings use an IN (subquery) the database can answer from the
+    WellID index
+    """
+    if pointid:
+        public = read_public_wells(db)
+        wellids = [w for p in as_pointids(pointid) for w in public.get(p.upper(), [])]
+        return q.filter(table.WellID.in_(wellids))
+
+    public = select(models.Well.WellID).join(models.Location)
+    public = public.where(models.Location.PublicRelease == True)
+    return q.filter(table.WellID.in_(public))
+
+
+def as_pointids(pointid):
+    if pointid is None:
+        return []
+    if isinstance(pointid, str):
+        pointid = [pointid]
+    # accept repeated ?pointid= as well as comma separated lists
+    return [p.strip() for pi in pointid for p in pi.split(",") if p.strip()]
+
+
+def date_window_filter(q, table, start=None, end=None):
+    """
+    bound DateMeasured to [start, end] (dates, inclusive) with range
+    predicates on the bare column so the DateMeasured indexes stay usable
+    """
+    if start:
+        q = q.filter(table.DateMeasured >= start)
+    if end:
+        q = q.filter(table.DateMeasured < end + timedelta(days=1))
     return q
 
 
-def read_waterlevels_pressure_query(pointid, db, as_dict=False):
+def read_waterlevels_query(table, pointid, db, as_dict=False, start=None, end=None):
     if as_dict:
-        q = db.query(models.WaterLevelsContinuous_Pressure.__table__)
+        q = db.query(table.__table__)
     else:
-        q = db.query(models.WaterLevelsContinuous_Pressure)
+        # the lookup meanings are serialized for every row. load them in the
+        # same query instead of one lazy load per row
+        q = db.query(table).options(
+            joinedload(table.lu_measurement_method),
+            joinedload(table.lu_data_source),
+        )
 
-    if pointid:
-        q = q.join(models.Well)
-        q = q.join(models.Location)
-        q = q.filter(models.Location.PointID == pointid)
-    q = q.order_by(models.WaterLevelsContinuous_Pressure.DateMeasured)
-    q = public_release_filter(q)
+    q = public_wellids_filter(q, table, pointid, db)
+    q = date_window_filter(q, table, start, end)
+    if len(as_pointids(pointid)) > 1:
+        # keep each site's records together
+        q = q.order_by(table.WellID, table.DateMeasured)
+    else:
+        q = q.order_by(table.DateMeasured)
     return q
 
 
-def read_waterlevels_manual_query(pointid, db, as_dict=False):
-    if as_dict:
-        q = db.query(models.WaterLevels.__table__)
+def read_waterlevels_acoustic_query(pointid, db, as_dict=False, start=None, end=None):
+    return read_waterlevels_query(
+        models.WaterLevelsContinuous_Acoustic, pointid, db, as_dict, start, end
+    )
+
+
+def read_waterlevels_pressure_query(pointid, db, as_dict=False, start=None, end=None):
+    return read_waterlevels_query(
+        models.WaterLevelsContinuous_Pressure, pointid, db, as_dict, start, end
+    )
+
+
+def read_waterlevels_manual_query(pointid, db, as_dict=False, start=None, end=None):
+    return read_waterlevels_query(models.WaterLevels, pointid, db, as_dict, start, end)
+
+
+def read_waterlevels_by_site(table, pointid, db, start=None, end=None, limit=None):
+    """
+    records for one or more sites in a single query, grouped by PointID.
+    at most `limit` records are read
+    """
+    pointids = as_pointids(pointid)
+    public = read_public_wells(db)
+    sites = {w: p for p in pointids for w in public.get(p.upper(), [])}
+
+    groups = {p: [] for p in pointids}
+    q = read_waterlevels_query(table, pointids, db, start=start, end=end)
+    q = q.order_by(None).order_by(table.WellID, table.DateMeasured)
+    if limit is not None:
+        q = q.limit(limit)
+    for record in q:
+        groups[sites[record.WellID]].append(record)
+    return groups
+
+
+@cache.cached(ttl=600, tags=pointid_tags("WaterLevels"))
+def read_waterlevels_manual(pointid, db):
+    return read_waterlevels_manual_query(pointid, db, as_dict=True).all()
+
+
+@cache.cached(ttl=600, tags=pointid_tags("WaterLevelsContinuous_Pressure"))
+def read_waterlevels_pressure(pointid, db):
+    return read_waterlevels_pressure_query(pointid, db, as_dict=True).all()
+
+
+def latest_waterlevels_query(table, db, start=None, end=None):
+    """
+    most recent reading of every public well in `table`, in one query.
+    ROW_NUMBER() over each well's readings, newest first, keeping row 1.
+    start/end restrict it to readings in a window
+    """
+    rn = func.row_number().over(
+        partition_by=table.WellID,
+        order_by=(table.DateMeasured.desc(), table.OBJECTID.desc()),
+    )
+    q = db.query(
+        table.WellID, table.DateMeasured, table.DepthToWaterBGS, rn.label("rn")
+    )
+    q = public_wellids_filter(q, table, None, db)
+    # undated readings are never the latest. some databases sort NULL first
+    q = q.filter(table.DateMeasured.isnot(None))
+    q = date_window_filter(q, table, start, end).subquery()
+    return db.query(q.c.WellID, q.c.DateMeasured, q.c.DepthToWaterBGS).filter(
+        q.c.rn == 1
+    )
+
+
+# identical concurrent refills of read_latest_waterlevels share one
+latest_flight = SingleFlight("latest_waterlevels")
+
+
+@cache.cached(
+    ttl=600,
+    tags=[
+        "table:WaterLevels",
+        "table:WaterLevelsContinuous_Pressure",
+        "table:WaterLevelsContinuous_Acoustic",
+    ],
+)
+def read_latest_waterlevels(db, start=None, end=None):
+    """
+    latest manual and continuous reading for every public well with data
+    (in [start, end] if given). the continuous reading is whichever of
+    pressure/acoustic is newer.
+
+    three statewide window queries. concurrent misses share one refill,
+    run on a session of its own with the bulk statement timeout so that no
+    one caller's timeout or disconnect decides it for the rest
+    """
+
+    def refill():
+        with new_session(db) as session:
+            session.info["statement_timeout"] = BULK_TIMEOUT
+            return latest_waterlevels(session, start, end)
+
+    return latest_flight.do((start, end), refill)
+
+
+def latest_waterlevels(db, start=None, end=None):
+    pointids = read_public_pointids(db)
+
+    latest = {}
+    for source, table in (
+        ("manual", models.WaterLevels),
+        ("pressure", models.WaterLevelsContinuous_Pressure),
+        ("acoustic", models.WaterLevelsContinuous_Acoustic),
+    ):
+        for wellid, dt, depth in latest_waterlevels_query(table, db, start, end):
+            depth = float(depth) if depth is not None else None
+            latest.setdefault(wellid, {})[source] = (dt, depth)
+
+    rows = []
+    for wellid, readings in latest.items():
+        mdate, mdepth = readings.get("manual", (None, None))
+        continuous = [
+            (readings[k], k)
+            for k in ("pressure", "acoustic")
+            if k in readings and readings[k][0] is not None
+        ]
+        if continuous:
+            (cdate, cdepth), csource = max(continuous, key=lambda c: c[0][0])
+        else:
+            cdate, cdepth, csource = None, None, None
+
+        rows.append(
+            {
+                "PointID": pointids.get(wellid),
+                "WellID": wellid,
+                "manual_measurement_date": mdate,
+                "manual_depth_to_water_ftbgs": mdepth,
+                "continuous_measurement_datetime": cdate,
+                "continuous_depth_to_water_ftbgs": cdepth,
+                "continuous_source": csource,
+            }
+        )
+
+    return sorted(rows, key=lambda r: (r["PointID"] or "", str(r["WellID"])))
+
+
+# water chemistry ==============================================================
+CHEMISTRY_TABLES = (models.MajorChemistry, models.MinorandTraceChemistry)
+
+
+def chemistry_query(pointid=None, analyte=None, start=None, end=None):
+    """
+    results from the major and minor/trace chemistry tables for public
+    samples at public locations as one UNION ALL subquery
+    """
+    pointids = as_pointids(pointid)
+    # analytes accept the same repeated or comma separated forms as pointids
+    analytes = as_pointids(analyte)
+
+    sample = models.ChemistrySampleInfo
+    selects = []
+    for table in CHEMISTRY_TABLES:
+        q = select(
+            models.Location.PointID,
+            sample.SamplePointID,
+            sample.SamplePtID,
+            sample.CollectionDate,
+            table.Analyte,
+            table.Symbol,
+            table.SampleValue,
+            table.Units,
+            table.Uncertainty,
+            table.AnalysisMethod,
+            table.AnalysisDate,
+        )
+        q = q.join(sample, sample.SamplePtID == table.SamplePtID)
+        q = q.join(models.Location, models.Location.LocationId == sample.LocationId)
+        q = q.where(models.Location.PublicRelease == True)
+        q = q.where(sample.PublicRelease == True)
+        if pointids:
+            q = q.where(models.Location.PointID.in_(pointids))
+        if analytes:
+            q = q.where(table.Analyte.in_(analytes))
+        if start:
+            q = q.where(sample.CollectionDate >= start)
+        if end:
+            q = q.where(sample.CollectionDate < end + timedelta(days=1))
+        selects.append(q)
+
+    return union_all(*selects).subquery("chemistry")
+
+
+def read_chemistry_long(pointid=None, analyte=None, start=None, end=None):
+    u = chemistry_query(pointid, analyte, start, end)
+    return select(u).order_by(u.c.PointID, u.c.CollectionDate, u.c.Analyte)
+
+
+def read_chemistry_analytes(db, pointid=None):
+    u = chemistry_query(pointid)
+    q = select(u.c.Analyte).distinct().order_by(u.c.Analyte)
+    return [a for (a,) in db.execute(q) if a]
+
+
+def read_chemistry_wide(analytes, pointid=None, start=None, end=None):
+    """
+    one row per sample, one column per analyte. pivoted in the database with
+    conditional aggregation so only the wide rows cross the wire
+    """
+    u = chemistry_query(pointid, analytes, start, end)
+    keys = (u.c.PointID, u.c.SamplePointID, u.c.SamplePtID, u.c.CollectionDate)
+    columns = [
+        func.max(case((u.c.Analyte == a, u.c.SampleValue))).label(a) for a in analytes
+    ]
+    q = select(*keys, *columns).group_by(*keys)
+    return q.order_by(u.c.PointID, u.c.CollectionDate)
+
+
+# change feeds =================================================================
+CHANGE_FEEDS = {
+    "waterlevels": models.WaterLevels,
+    "pressure": models.WaterLevelsContinuous_Pressure,
+    "acoustic": models.WaterLevelsContinuous_Acoustic,
+    "locations": models.Location,
+}
+# candidate watermark columns, most significant first. not every deployment
+# has both, so they are looked up in the live schema rather than mapped
+WATERMARK_COLUMNS = (("Updated", DateTime), ("OBJECTID", Integer))
+# filled in for a watermark that is NULL, e.g. Updated on a row never edited
+WATERMARK_FALLBACKS = {"Updated": "Created"}
+_live_columns = {}
+
+
+def live_columns(table, db):
+    """
+    names of the columns `table` has in the live schema
+    """
+    bind = db.get_bind()
+    key = (str(bind.url), table.__tablename__)
+    if key not in _live_columns:
+        columns = inspect(bind).get_columns(table.__tablename__)
+        _live_columns[key] = {c["name"] for c in columns}
+    return _live_columns[key]
+
+
+def watermark_columns(table, db):
+    """
+    the watermark columns present on `table`, as (name, type) pairs
+    """
+    names = live_columns(table, db)
+    return [(n, t) for n, t in WATERMARK_COLUMNS if n in names]
+
+
+def keyset_after(columns, values):
+    """
+    rows strictly after `values` in `columns` order, spelled out with AND/OR
+    (not every backend supports row value comparison).
+
+    NULL sorts first, as it does on MSSQL and SQLite. a None in the position
+    becomes IS NULL / IS NOT NULL
+    """
+
+    def equal(c, v):
+        return c.is_(None) if v is None else c == v
+
+    def after(c, v):
+        return c.isnot(None) if v is None else c > v
+
+    clauses = []
+    for i, (c, v) in enumerate(zip(columns, values)):
+        prefix = [equal(ci, vi) for ci, vi in zip(columns[:i], values[:i])]
+        clauses.append(and_(*prefix, after(c, v)))
+    return or_(*clauses)
+
+
+def change_feed_order(table, db):
+    """
+    keyset order of a change feed: the watermark columns present on `table`
+    (Updated, OBJECTID), then the primary key as a tie breaker so a position
+    is always unambiguous. None if `table` has no watermark column.
+
+    a NULL watermark can't be ordered against the rows already read: a row
+    inserted with a NULL Updated after a reader has passed the NULLs would
+    never be delivered. so Updated is keyed on COALESCE(Updated, Created)
+    where the table has Created. an index on that expression (a persisted
+    computed column on MSSQL) serves the order and the keyset predicates.
+    rows still without a watermark come first; see rows_without_watermark
+    """
+    names = live_columns(table, db)
+    marks = watermark_columns(table, db)
+    if not marks:
+        return
+
+    t = table.__table__
+
+    def live(name, type_):
+        c = t.c.get(name)
+        return column(name, type_, _selectable=t) if c is None else c
+
+    order = []
+    for name, type_ in marks:
+        c = live(name, type_)
+        fallback = WATERMARK_FALLBACKS.get(name)
+        if fallback in names:
+            c = func.coalesce(c, live(fallback, type_)).label(name)
+        order.append(c)
+    order.extend(c for c in t.primary_key.columns if c.name not in dict(marks))
+    return order
+
+
+def rows_without_watermark(table, order):
+    """
+    public rows of `table` with no value in the leading watermark of `order`.
+    a keyset position can't tell which of them are new, so an incremental
+    reader re-reads them
+    """
+    return change_feed_query(table, order).where(order[0].is_(None))
+
+
+def change_feed_query(table, order, after=None, limit=None):
+    """
+    public rows of `table` after the keyset position `after`, oldest change
+    first
+    """
+    t = table.__table__
+    # watermark columns and expressions the model doesn't map
+    extra = [c for c in order if t.c.get(c.name) is not c]
+    q = select(t, *extra)
+    if table is models.Location:
+        q = q.where(t.c.PublicRelease == True)
     else:
-        q = db.query(models.WaterLevels)
+        public = select(models.Well.WellID).join(models.Location)
+        public = public.where(models.Location.PublicRelease == True)
+        q = q.where(t.c.WellID.in_(public))
 
-    if pointid:
-        q = q.join(models.Well)
-        q = q.join(models.Location)
-        q = q.filter(models.Location.PointID == pointid)
-    q = q.order_by(models.WaterLevels.DateMeasured)
-    q = public_release_filter(q)
+    if after:
+        q = q.where(keyset_after(order, after))
+    q = q.order_by(*order)
+    if limit:
+        q = q.limit(limit)
     return q
 
 
-def _read_pods(pointid, db):
+@cache.cached(ttl=3600, tags=pointid_tags("WellData"))
+def read_wells(pointid, db):
+    """
+    public wells at a PointID as schemas.WellRecord (plain data, see
+    read_location_list)
+    """
     q = db.query(models.Well)
-    if pointid:
-        q = q.join(models.Location)
-        q = q.filter(models.Location.PointID == pointid)
-        q = q.order_by(models.Well.WellID)
-        q = public_release_filter(q)
+    q = q.options(joinedload(models.Well.lu_formation))
+    q = q.join(models.Location)
+    q = q.filter(models.Location.PointID == pointid)
+    q = q.order_by(models.Well.WellID)
+    q = public_release_filter(q)
+    return [
+        schemas.WellRecord.from_orm(w).copy(
+            update={"formation_meaning": w.lu_formation and w.lu_formation.Meaning}
+        )
+        for w in q
+    ]
+
+
+# OSE PODs change rarely and each one costs an ArcGIS round trip. a failed or
+# timed out request raises, so only good responses are cached
+@cache.cached(ttl=3600, tags=["table:OSE_PODs"])
+def read_ose_pods(ose_id):
+    url = (
+        f"{POD_SERVICE_URL}"
+        f"?where"
+        f"=db_file= '{ose_id}' &outFields=*&outSR=4326&f=json"
+    )
 
-        ps = q.all()
+    resp = requests.get(url, timeout=POD_TIMEOUT)
+    resp.raise_for_status()
+    resp = resp.json()
+    return resp.get("features")
+
+
+def _read_pods(pointid, db):
+    if pointid:
+        # read_wells is cached. copy before attaching the pods
+        ps = [pi.copy() for pi in read_wells(pointid, db)]
 
         for pi in ps:
             # print(pi)
             ose_id = pi.OSEWellID
             if ose_id:
-                url = (
-                    f"https://services2.arcgis.com/qXZbWTdPDbTjl7Dy/arcgis/rest/services/OSE_PODs/FeatureServer/0/query"
-                    f"?where"
-                    f"=db_file= '{ose_id}' &outFields=*&outSR=4326&f=json"
-                )
-
-                resp = requests.get(url)
-                resp = resp.json()
-                pods = resp.get("features")
-
-                pi.pods = pods
+                pi.pods = read_ose_pods(ose_id)
 
         return ps
 
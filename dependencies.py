@@ -13,7 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from database import SessionLocal
+import asyncio
+import os
+
+from fastapi import Depends, Request
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, cancel_session, open_read_session
+
+# per route class statement timeouts (seconds)
+INTERACTIVE_TIMEOUT = float(os.environ.get("DB_TIMEOUT_INTERACTIVE", 15))
+BULK_TIMEOUT = float(os.environ.get("DB_TIMEOUT_BULK", 120))
+DISCONNECT_POLL = 0.25
 
 
 def get_db():
@@ -24,4 +35,69 @@ def get_db():
         db.close()
 
 
+def get_read_db(db: Session = Depends(get_db)):
+    """
+    the get_db session, or a session on the read mirror when DB_READ_MODE is
+    mirror and the mirror is fresh (see database.Mirror)
+    """
+    session = open_read_session()
+    if session is None:
+        yield db
+        return
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+async def _watch_disconnect(request, db):
+    while True:
+        if await request.is_disconnected():
+            cancel_session(db)
+            return
+        await asyncio.sleep(DISCONNECT_POLL)
+
+
+def get_db_timeout(timeout, mirror=True):
+    """
+    make a dependency that yields a session with a statement timeout, from
+    get_read_db if the route only reads mirrored tables (`mirror`) else from
+    get_db.
+    statements running longer than `timeout` seconds are cancelled and the
+    in-flight statement is cancelled if the client disconnects.
+
+    inside a batch (see routers/batch.py) the batch's shared session is
+    yielded instead
+    """
+
+    async def dependency(
+        request: Request, db: Session = Depends(get_read_db if mirror else get_db)
+    ):
+        batch = request.scope.get("batch")
+        if batch is not None and (mirror or not batch.db.info.get("mirror")):
+            # sub-request of POST /batch. use the batch's session, one
+            # sub-request at a time, and never for longer than the batch may
+            async with batch.lock:
+                shared = batch.db
+                shared.info["statement_timeout"] = min(timeout, batch.timeout)
+                yield shared
+            return
+
+        db.info["statement_timeout"] = timeout
+        watcher = asyncio.ensure_future(_watch_disconnect(request, db))
+        try:
+            yield db
+        finally:
+            watcher.cancel()
+
+    return dependency
+
+
+get_interactive_db = get_db_timeout(INTERACTIVE_TIMEOUT)
+get_bulk_db = get_db_timeout(BULK_TIMEOUT)
+# routes reading what the mirror does not carry (chemistry, NGWMN views) or
+# feeding it (change feeds)
+get_primary_bulk_db = get_db_timeout(BULK_TIMEOUT, mirror=False)
+
+
 # ============= EOF =============================================
@@ -18,17 +18,20 @@ import pyproj
 PROJECTIONS = {}
 
 
-def utm_to_latlon(e, n, zone=13):
+def utm_to_latlon(e, n, zone=13, inverse=True):
     name = f"utm{zone}"
     if name not in PROJECTIONS:
         pr = pyproj.Proj(proj="utm", zone=int(zone), ellps="WGS84")
         PROJECTIONS[name] = pr
 
     pr = PROJECTIONS[name]
-    return pr(e, n, inverse=True)
+    return pr(e, n, inverse=inverse)
 
 
-def latlon_to_utm(lon, lat):
+def latlon_to_utm(lon, lat, zone=None):
+    if zone is not None:
+        return utm_to_latlon(lon, lat, zone, inverse=False)
+
     name = "latlon"
     if name not in PROJECTIONS:
         pr = pyproj.Proj(proj="utm", ellps="WGS84")
@@ -13,25 +13,378 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+"""
+GraphQL over Location -> Well -> WaterLevels/Pressure/Acoustic.
+
+Every nested field resolves through a per-request DataLoader, so a query
+costs one SQL statement per entity type no matter how many parents it fans
+out from. Queries are bounded by depth (GRAPHQL_MAX_DEPTH) and by an
+estimated cost (GRAPHQL_MAX_COST): each field costs 1, multiplied by the
+`limit` of every list above it.
+"""
+
+import os
+import threading
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+
 import strawberry
-from strawberry.asgi import GraphQL
+from fastapi import Depends
+from graphql import GraphQLError, get_named_type, get_nullable_type, is_list_type
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+from graphql.language.ast import IntValueNode
+from graphql.validation import ValidationRule
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
+from strawberry.dataloader import DataLoader
+from strawberry.extensions import AddValidationRules, QueryDepthLimiter
+from strawberry.fastapi import GraphQLRouter
+
+import models
+from crud import public_release_filter
+from dependencies import get_interactive_db
+
+MAX_DEPTH = int(os.environ.get("GRAPHQL_MAX_DEPTH", 8))
+MAX_COST = int(os.environ.get("GRAPHQL_MAX_COST", 50000))
+MAX_LIMIT = 1000
+DEFAULT_LIMIT = 100
+
+
+def clamp(limit):
+    return max(0, min(limit, MAX_LIMIT))
+
+
+# types ========================================================================
+@strawberry.type
+class WaterLevel:
+    measurement_datetime: Optional[datetime]
+    depth_to_water_ftbgs: Optional[float]
+    measuring_agency: Optional[str]
+    method_code: strawberry.Private[Optional[str]]
+    source_code: strawberry.Private[Optional[str]]
+
+    @strawberry.field
+    async def measurement_method(self, info) -> Optional[str]:
+        return await lookup(info, "LU_MeasurementMethod", self.method_code)
+
+    @strawberry.field
+    async def data_source(self, info) -> Optional[str]:
+        return await lookup(info, "LU_DataSource", self.source_code)
+
+    @classmethod
+    def from_row(cls, row):
+        dt = row.DateMeasured
+        if isinstance(dt, date) and not isinstance(dt, datetime):
+            # manual levels keep the time of day in its own column
+            dt = datetime.combine(dt, getattr(row, "TimeMeasured", None) or time())
+        depth = row.DepthToWaterBGS
+        return cls(
+            measurement_datetime=dt,
+            depth_to_water_ftbgs=float(depth) if depth is not None else None,
+            measuring_agency=row.MeasuringAgency,
+            method_code=row.MeasurementMethod,
+            source_code=row.DataSource,
+        )
+
+
+def waterlevels_field(table):
+    async def resolve(
+        self,
+        info,
+        limit: int = DEFAULT_LIMIT,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+    ) -> List[WaterLevel]:
+        """
+        most recent `limit` readings, newest first
+        """
+        loader = info.context["loaders"][table]
+        return await loader.load((self.well_id, clamp(limit), start, end))
+
+    return strawberry.field(resolver=resolve)
 
 
 @strawberry.type
-class User:
-    name: str
-    age: int
+class Well:
+    well_id: strawberry.ID
+    point_id: Optional[str]
+    ose_well_id: Optional[str]
+    hole_depth_ftbgs: Optional[float]
+    well_depth_ftbgs: Optional[float]
+    formation_code: strawberry.Private[Optional[str]]
+
+    @strawberry.field
+    async def formation(self, info) -> Optional[str]:
+        return await lookup(info, "LU_Formations", self.formation_code)
+
+    manual: List[WaterLevel] = waterlevels_field("WaterLevels")
+    pressure: List[WaterLevel] = waterlevels_field("WaterLevelsContinuous_Pressure")
+    acoustic: List[WaterLevel] = waterlevels_field("WaterLevelsContinuous_Acoustic")
+
+    @classmethod
+    def from_orm(cls, w):
+        return cls(
+            well_id=strawberry.ID(str(w.WellID)),
+            point_id=w.PointID,
+            ose_well_id=w.OSEWellID,
+            hole_depth_ftbgs=w.HoleDepth,
+            well_depth_ftbgs=w.WellDepth,
+            formation_code=w.FormationZone,
+        )
+
+
+@strawberry.type
+class Location:
+    location_id: strawberry.ID
+    point_id: str
+    alternate_site_id: Optional[str]
+    longitude: Optional[float]
+    latitude: Optional[float]
+    elevation_ft: Optional[float]
+    elevation_method_code: strawberry.Private[Optional[str]]
+
+    @strawberry.field
+    async def elevation_method(self, info) -> Optional[str]:
+        return await lookup(info, "LU_AltitudeMethod", self.elevation_method_code)
+
+    @strawberry.field
+    async def wells(self, info) -> List[Well]:
+        return await info.context["loaders"]["wells"].load(self.location_id)
+
+    @classmethod
+    def from_orm(cls, l):
+        lon, lat = (None, None)
+        if l.Easting is not None and l.Northing is not None:
+            lon, lat = l.lonlat
+        return cls(
+            location_id=strawberry.ID(str(l.LocationId)),
+            point_id=l.PointID,
+            alternate_site_id=l.AlternateSiteID,
+            longitude=lon,
+            latitude=lat,
+            elevation_ft=l.Altitude,
+            elevation_method_code=l.AltitudeMethod,
+        )
+
+
+@strawberry.type
+class LookupValue:
+    code: str
+    meaning: Optional[str]
+
 
+async def lookup(info, table, code):
+    if code is None:
+        return
+    return await info.context["loaders"][table].load(str(code))
 
+
+# loaders ======================================================================
+LU_TABLES = {
+    "LU_MeasurementMethod": models.LU_MeasurementMethod,
+    "LU_DataSource": models.LU_DataSource,
+    "LU_Formations": models.LU_Formations,
+    "LU_AltitudeMethod": models.LU_AltitudeMethod,
+}
+
+WATERLEVEL_TABLES = {
+    "WaterLevels": models.WaterLevels,
+    "WaterLevelsContinuous_Pressure": models.WaterLevelsContinuous_Pressure,
+    "WaterLevelsContinuous_Acoustic": models.WaterLevelsContinuous_Acoustic,
+}
+
+
+def make_loaders(db):
+    """
+    DataLoaders for one request. batches run in the threadpool, serialized
+    on the request's session
+    """
+    lock = threading.Lock()
+
+    def run(fn, *args):
+        def locked():
+            with lock:
+                return fn(*args)
+
+        return run_in_threadpool(locked)
+
+    def wells(keys):
+        q = db.query(models.Well).filter(models.Well.LocationId.in_(keys))
+        q = q.order_by(models.Well.WellID)
+        groups = defaultdict(list)
+        for w in q:
+            groups[str(w.LocationId)].append(Well.from_orm(w))
+        return [groups[k] for k in keys]
+
+    def waterlevels(table, keys):
+        # one query per distinct (limit, start, end) shape; typically one
+        shapes = defaultdict(set)
+        for wellid, limit, start, end in keys:
+            shapes[(limit, start, end)].add(wellid)
+
+        results = {}
+        for (limit, start, end), wellids in shapes.items():
+            rn = func.row_number().over(
+                partition_by=table.WellID,
+                order_by=(table.DateMeasured.desc(), table.OBJECTID.desc()),
+            )
+            q = db.query(table.__table__, rn.label("rn"))
+            q = q.filter(table.WellID.in_(wellids))
+            if start:
+                q = q.filter(table.DateMeasured >= start)
+            if end:
+                q = q.filter(table.DateMeasured < end + timedelta(days=1))
+            sub = q.subquery()
+            rows = (
+                db.query(sub).filter(sub.c.rn <= limit).order_by(sub.c.WellID, sub.c.rn)
+            )
+
+            groups = defaultdict(list)
+            for row in rows:
+                groups[str(row.WellID)].append(WaterLevel.from_row(row))
+            for wellid in wellids:
+                results[(wellid, limit, start, end)] = groups[wellid]
+        return [results[k] for k in keys]
+
+    def lookups(table, keys):
+        q = db.query(table.Code, table.Meaning).filter(table.Code.in_(keys))
+        meanings = {str(code): meaning for code, meaning in q}
+        return [meanings.get(k) for k in keys]
+
+    def loader(fn, *args):
+        async def load(keys):
+            return await run(fn, *args, keys)
+
+        return DataLoader(load_fn=load)
+
+    loaders = {"wells": loader(wells)}
+    for name, table in WATERLEVEL_TABLES.items():
+        loaders[name] = loader(waterlevels, table)
+    for name, table in LU_TABLES.items():
+        loaders[name] = loader(lookups, table)
+    return loaders, run
+
+
+# query ========================================================================
 @strawberry.type
 class Query:
     @strawberry.field
-    def user(self) -> User:
-        return User(name="Patrick", age=100)
+    async def location(self, info, point_id: str) -> Optional[Location]:
+        def get():
+            q = public_release_filter(info.context["db"].query(models.Location))
+            loc = q.filter(models.Location.PointID == point_id).first()
+            return Location.from_orm(loc) if loc else None
+
+        return await info.context["run"](get)
+
+    @strawberry.field
+    async def locations(
+        self,
+        info,
+        point_ids: Optional[List[str]] = None,
+        limit: int = DEFAULT_LIMIT,
+        offset: int = 0,
+    ) -> List[Location]:
+        def get():
+            q = public_release_filter(info.context["db"].query(models.Location))
+            if point_ids:
+                q = q.filter(models.Location.PointID.in_(point_ids))
+            q = q.order_by(models.Location.PointID).offset(offset)
+            return [Location.from_orm(l) for l in q.limit(clamp(limit))]
+
+        return await info.context["run"](get)
+
+    @strawberry.field
+    async def lookup_table(self, info, name: str) -> List[LookupValue]:
+        """
+        all codes of an LU table, e.g. LU_MeasurementMethod
+        """
+        table = LU_TABLES.get(name)
+        if table is None:
+            raise GraphQLError(f"Unknown lookup table {name}")
+
+        def get():
+            q = info.context["db"].query(table.Code, table.Meaning)
+            return [LookupValue(code=str(c), meaning=m) for c, m in q]
+
+        return await info.context["run"](get)
+
+
+# limits =======================================================================
+class QueryCostLimiter(ValidationRule):
+    """
+    reject operations whose estimated cost exceeds MAX_COST. a list field
+    multiplies the cost of its selection by its `limit` argument (its
+    default when not a literal)
+    """
+
+    def enter_operation_definition(self, node, *args):
+        root = self.context.schema.query_type
+        cost = self.selection_cost(node.selection_set, root)
+        if cost > MAX_COST:
+            self.report_error(
+                GraphQLError(
+                    f"Query cost {cost} exceeds the maximum of {MAX_COST}",
+                    node,
+                )
+            )
+
+    def selection_cost(self, selection_set, parent):
+        if selection_set is None or parent is None:
+            return 0
+
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field = getattr(parent, "fields", {}).get(selection.name.value)
+                if field is None:
+                    continue
+                multiplier = 1
+                if is_list_type(get_nullable_type(field.type)):
+                    multiplier = self.limit(selection, field)
+                child = get_named_type(field.type)
+                cost += 1 + multiplier * self.selection_cost(
+                    selection.selection_set, child
+                )
+            elif isinstance(selection, InlineFragmentNode):
+                cost += self.selection_cost(selection.selection_set, parent)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = self.context.get_fragment(selection.name.value)
+                if fragment:
+                    cost += self.selection_cost(fragment.selection_set, parent)
+        return cost
+
+    @staticmethod
+    def limit(selection, field):
+        for arg in selection.arguments or ():
+            if arg.name.value == "limit":
+                if isinstance(arg.value, IntValueNode):
+                    return clamp(int(arg.value.value))
+                # a variable could be anything up to the cap
+                return MAX_LIMIT
+
+        arg = field.args.get("limit")
+        if arg is not None and isinstance(arg.default_value, int):
+            return arg.default_value
+        # lists without a limit (e.g. a location's wells) are short
+        return 10
+
+
+schema = strawberry.Schema(
+    query=Query,
+    extensions=[
+        QueryDepthLimiter(max_depth=MAX_DEPTH),
+        AddValidationRules([QueryCostLimiter]),
+    ],
+)
+
 
+async def get_context(db=Depends(get_interactive_db)):
+    loaders, run = make_loaders(db)
+    return {"db": db, "loaders": loaders, "run": run}
 
-schema = strawberry.Schema(query=Query)
 
+graphql_app = GraphQLRouter(schema, context_getter=get_context)
 
-graphql_app = GraphQL(schema)
 # ============= EOF =============================================
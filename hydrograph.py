@@ -0,0 +1,148 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Merging manual and continuous water levels into one hydrograph.
+
+Precedence (shared with the NGWMN WaterLevels document): on a day with both a
+manual and a continuous reading, the k-th continuous reading of the day is
+paired with the k-th manual reading of the day and the shallower of the two
+is kept. Unpaired manual readings are always kept. The result is ordered by
+day.
+"""
+
+import numpy as np
+import pandas as pd
+
+from crud import (
+    read_waterlevels_acoustic_query,
+    read_waterlevels_manual_query,
+    read_waterlevels_pressure_query,
+)
+
+COLUMNS = ["source", "measurement_datetime", "depth_to_water_ftbgs"]
+
+
+def merge_order(manual_dates, manual_depths, continuous_dates, continuous_depths):
+    """
+    vectorized merge of a manual and a continuous series.
+
+    returns (is_manual, row), the selected records in hydrograph order. row
+    indexes the manual series where is_manual is True, otherwise the
+    continuous series
+    """
+    m = pd.DataFrame(
+        {
+            "day": pd.to_datetime(pd.Series(manual_dates, dtype=object)).dt.normalize(),
+            "depth": pd.to_numeric(pd.Series(manual_depths, dtype=object)),
+            "row": np.arange(len(manual_dates)),
+        }
+    )
+    c = pd.DataFrame(
+        {
+            "day": pd.to_datetime(
+                pd.Series(continuous_dates, dtype=object)
+            ).dt.normalize(),
+            "depth": pd.to_numeric(pd.Series(continuous_depths, dtype=object)),
+            "row": np.arange(len(continuous_dates)),
+        }
+    )
+    m["k"] = m.groupby("day").cumcount()
+    c["k"] = c.groupby("day").cumcount()
+
+    pairs = c.merge(m, on=["day", "k"], how="left", suffixes=("", "_m"))
+    paired = pairs["row_m"].notna().to_numpy()
+    use_manual = paired & (pairs["depth_m"] < pairs["depth"]).to_numpy()
+
+    leftover = m[~m["row"].isin(pairs["row_m"][paired])]
+    out = pd.DataFrame(
+        {
+            "day": np.concatenate(
+                [pairs["day"].to_numpy(), leftover["day"].to_numpy()]
+            ),
+            "is_manual": np.concatenate(
+                [use_manual, np.ones(len(leftover), dtype=bool)]
+            ),
+            "row": np.concatenate(
+                [
+                    np.where(use_manual, pairs["row_m"].fillna(-1), pairs["row"]),
+                    leftover["row"].to_numpy(),
+                ]
+            ).astype(int),
+        }
+    )
+    out = out.sort_values("day", kind="mergesort")
+    return out["is_manual"].to_numpy(), out["row"].to_numpy()
+
+
+def series_frame(rows, source):
+    """
+    frame of (source, measurement_datetime, depth_to_water_ftbgs) from
+    as_dict waterlevel rows
+    """
+    rows = [r._mapping for r in rows]
+    df = pd.DataFrame(
+        {
+            "source": source,
+            "measurement_datetime": pd.to_datetime(
+                pd.Series([r["DateMeasured"] for r in rows], dtype=object)
+            ),
+            "depth_to_water_ftbgs": pd.to_numeric(
+                pd.Series([r["DepthToWaterBGS"] for r in rows], dtype=object)
+            ).astype(float),
+        },
+        columns=COLUMNS,
+    )
+    if rows and "TimeMeasured" in rows[0]:
+        # manual readings keep the time of day in a separate column
+        times = [r["TimeMeasured"] and r["TimeMeasured"].isoformat() for r in rows]
+        offset = pd.to_timedelta(pd.Series(times, dtype=object))
+        df["measurement_datetime"] += offset.fillna(pd.Timedelta(0))
+    return df
+
+
+def combine(manual, pressure, acoustic):
+    """
+    combined hydrograph from manual, pressure and acoustic frames (see
+    series_frame), tagged by source
+    """
+    continuous = pd.concat([pressure, acoustic], ignore_index=True)
+    continuous = continuous.sort_values("measurement_datetime", kind="mergesort")
+    continuous = continuous.reset_index(drop=True)
+
+    is_manual, row = merge_order(
+        manual["measurement_datetime"],
+        manual["depth_to_water_ftbgs"],
+        continuous["measurement_datetime"],
+        continuous["depth_to_water_ftbgs"],
+    )
+    both = pd.concat([continuous, manual], ignore_index=True)
+    idx = np.where(is_manual, row + len(continuous), row)
+    return both.iloc[idx].reset_index(drop=True)[COLUMNS]
+
+
+def read_combined_waterlevels(pointid, db):
+    frames = [
+        series_frame(func(pointid, db, as_dict=True), source)
+        for func, source in (
+            (read_waterlevels_manual_query, "manual"),
+            (read_waterlevels_pressure_query, "pressure"),
+            (read_waterlevels_acoustic_query, "acoustic"),
+        )
+    ]
+    return combine(*frames)
+
+
+# ============= EOF =============================================
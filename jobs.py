@@ -0,0 +1,557 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Background export jobs.
+
+An export (a water level series, or the NGWMN documents) is split into
+partitions, one per well or per year. Each partition is written to its own
+file by a local process pool, and the files are then zipped into the job's
+result. A job's id is a digest of its normalized spec, so identical requests
+share one job. A finished result is reused for JOBS_TTL seconds.
+
+Job state lives in JOBS_DIR/<id>/job.json, so any web worker can report
+progress and serve the result. Workers touch JOBS_DIR/<id>/heartbeat every
+HEARTBEAT seconds while a partition runs. A job that has neither made
+progress nor beaten for JOBS_STALE seconds (its process went away) is
+started over on the next request for it. Taking a job over is serialized by
+an exclusive JOBS_DIR/<id>.lock file. Each run writes its partitions to its
+own JOBS_DIR/<id>/parts-<run>, and a failed run is only reported once none
+of its partitions is still running, so a rerun never shares files with it.
+
+    python jobs.py pressure --partition year --start 2020-01-01
+"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+
+import models
+from crud import (
+    as_pointids,
+    date_window_filter,
+    public_wellids_filter,
+    read_public_pointids,
+    read_public_sites,
+    read_public_wells,
+)
+from ngwmn import make_lithology, make_waterlevels, make_wellconstruction
+
+JOBS_DIR = os.environ.get("JOBS_DIR", "./jobs")
+JOBS_WORKERS = int(os.environ.get("JOBS_WORKERS", 4))
+JOBS_TTL = float(os.environ.get("JOBS_TTL", 86400))
+JOBS_STALE = float(os.environ.get("JOBS_STALE", 3600))
+HEARTBEAT = 60
+# a claim lock older than this was left by a process that died mid-claim
+CLAIM_TIMEOUT = 60
+
+SERIES = {
+    "manual": models.WaterLevels,
+    "pressure": models.WaterLevelsContinuous_Pressure,
+    "acoustic": models.WaterLevelsContinuous_Acoustic,
+}
+NGWMN = {
+    "waterlevels": make_waterlevels,
+    "wellconstruction": make_wellconstruction,
+    "lithology": make_lithology,
+}
+RESULT = "result.zip"
+BATCH = 5000
+
+_pool = None
+_engines = {}
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=JOBS_WORKERS, initializer=init_worker)
+    return _pool
+
+
+def init_worker():
+    """
+    forked workers must not reuse the parent's pooled connections
+    """
+    import database
+
+    database.engine.dispose(close=False)
+
+
+def bind_url(bind):
+    return bind.url.render_as_string(hide_password=False)
+
+
+@contextmanager
+def worker_session(url):
+    """
+    a session on the database at url, from inside a worker process
+    """
+    if url not in _engines:
+        import database
+
+        engine = database.engine
+        _engines[url] = engine if bind_url(engine) == url else create_engine(url)
+
+    session = Session(bind=_engines[url], autoflush=False)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+# spec =========================================================================
+def canonical(spec):
+    """
+    spec with pointids normalized and dates as strings, so that equivalent
+    requests get the same job
+    """
+    spec = dict(spec)
+    pointids = as_pointids(spec.get("pointids"))
+    spec["pointids"] = sorted({p.upper() for p in pointids}) or None
+    for k in ("start", "end"):
+        spec[k] = spec.get(k) and str(spec[k])
+    return spec
+
+
+def job_id(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def window(spec):
+    return tuple(spec[k] and date.fromisoformat(spec[k]) for k in ("start", "end"))
+
+
+def list_parts(spec, db):
+    """
+    the partitions of an export: PointIDs, or years
+    """
+    public = read_public_wells(db)
+    pointids = spec["pointids"]
+    if pointids:
+        pointids = [p for p in pointids if p in public]
+        if not pointids:
+            return []
+
+    if spec["kind"] == "ngwmn":
+        return pointids or sorted(public)
+
+    table = SERIES[spec["kind"]]
+    start, end = window(spec)
+    if spec["partition"] == "well":
+        if pointids:
+            return pointids
+
+        names = {w: p.upper() for w, p in read_public_pointids(db).items()}
+        q = db.query(table.WellID).distinct()
+        q = date_window_filter(
+            public_wellids_filter(q, table, None, db), table, start, end
+        )
+        return sorted({names[w] for (w,) in q if w in names})
+
+    if not (start and end):
+        q = db.query(func.min(table.DateMeasured), func.max(table.DateMeasured))
+        q = date_window_filter(
+            public_wellids_filter(q, table, pointids, db), table, start, end
+        )
+        lo, hi = q.one()
+        if lo is None:
+            return []
+        start, end = start or lo, end or hi
+    return list(range(start.year, end.year + 1))
+
+
+# partitions (run in a worker process) =========================================
+def parts_dir(job, run):
+    return os.path.join(job_dir(job), f"parts-{run}")
+
+
+def part_path(job, run, spec, part):
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", str(part))
+    ext = "" if spec["kind"] == "ngwmn" else f".{spec['format']}"
+    return os.path.join(parts_dir(job, run), f"{name}{ext}")
+
+
+def part_query(spec, part, public, db):
+    """
+    the rows of one partition of a series export, in (WellID, DateMeasured)
+    order
+    """
+    table = SERIES[spec["kind"]]
+    start, end = window(spec)
+    q = db.query(table.__table__)
+    if spec["partition"] == "well":
+        q = q.filter(table.WellID.in_(public.get(part, [])))
+    else:
+        if spec["pointids"]:
+            wellids = [w for p in spec["pointids"] for w in public.get(p, [])]
+            q = q.filter(table.WellID.in_(wellids))
+        else:
+            q = public_wellids_filter(q, table, None, db)
+        start = max(start or date.min, date(part, 1, 1))
+        end = min(end or date.max, date(part, 12, 31))
+
+    q = date_window_filter(q, table, start, end)
+    return q.order_by(table.WellID, table.DateMeasured)
+
+
+def write_rows(q, fmt, path, names):
+    """
+    stream a query to csv or ndjson, with each row's PointID first. returns
+    the number of rows
+    """
+    columns = ["PointID"] + [c["name"] for c in q.column_descriptions]
+    n = 0
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", newline="") as wfile:
+        if fmt == "csv":
+            writer = csv.writer(wfile)
+            writer.writerow(columns)
+        for row in q.yield_per(BATCH):
+            values = (names.get(row.WellID), *row)
+            if fmt == "csv":
+                writer.writerow(values)
+            else:
+                wfile.write(json.dumps(dict(zip(columns, values)), default=str))
+                wfile.write("\n")
+            n += 1
+    os.replace(tmp, path)
+    return n
+
+
+def write_ngwmn(pointid, path, db):
+    os.makedirs(path, exist_ok=True)
+    for name, make in NGWMN.items():
+        data = make(pointid, db)
+        with open(os.path.join(path, f"{name}.xml"), "wb") as wfile:
+            wfile.write(data.encode() if isinstance(data, str) else data)
+    return len(NGWMN)
+
+
+def touch(path):
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+
+@contextmanager
+def heartbeat(path, every=None):
+    """
+    touch `path` every `every` (HEARTBEAT) seconds while the block runs, so
+    a long partition still counts as progress (see last_progress)
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(every or HEARTBEAT):
+            touch(path)
+
+    touch(path)
+    thread = threading.Thread(target=beat, name="job-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_part(url, spec, part, path):
+    """
+    export one partition to path. returns the number of rows (documents for
+    ngwmn)
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    alive = os.path.join(os.path.dirname(os.path.dirname(path)), "heartbeat")
+    with heartbeat(alive), worker_session(url) as db:
+        if spec["kind"] == "ngwmn":
+            return write_ngwmn(part, path, db)
+
+        # not the cached maps: a worker's cache outlives the parent's
+        public, names = read_public_sites.uncached(db)
+        return write_rows(
+            part_query(spec, part, public, db), spec["format"], path, names
+        )
+
+
+def assemble(job, run):
+    """
+    zip a run's partitions into the job's result and drop them
+    """
+    parts = parts_dir(job, run)
+    os.makedirs(parts, exist_ok=True)
+    path = job_dir(job)
+    tmp = os.path.join(path, f"{RESULT}.tmp")
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zfile:
+        for root, _, files in os.walk(parts):
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                zfile.write(full, os.path.relpath(full, parts))
+    os.replace(tmp, os.path.join(path, RESULT))
+    shutil.rmtree(parts, ignore_errors=True)
+
+
+# state ========================================================================
+def job_dir(job):
+    return os.path.join(JOBS_DIR, job)
+
+
+def result_path(job):
+    return os.path.join(job_dir(job), RESULT)
+
+
+def claim_path(job):
+    return os.path.join(JOBS_DIR, f"{job}.lock")
+
+
+def last_progress(state):
+    """
+    when a job last wrote its state or a worker beat for it
+    """
+    try:
+        beat = os.path.getmtime(os.path.join(job_dir(state["id"]), "heartbeat"))
+    except OSError:
+        beat = 0
+    return max(state["updated"], beat)
+
+
+def read_state(job):
+    try:
+        with open(os.path.join(job_dir(job), "job.json")) as rfile:
+            return json.load(rfile)
+    except (OSError, ValueError):
+        return
+
+
+def write_state(state):
+    state["updated"] = time.time()
+    path = os.path.join(job_dir(state["id"]), "job.json")
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as wfile:
+        json.dump(state, wfile)
+    os.replace(tmp, path)
+
+
+def reusable(state):
+    """
+    whether a job answers requests for its spec: finished within JOBS_TTL,
+    or still making progress
+    """
+    if state is None:
+        return False
+
+    if state["status"] == "done":
+        age = time.time() - state["updated"]
+        return age < JOBS_TTL and os.path.isfile(result_path(state["id"]))
+    age = time.time() - last_progress(state)
+    return state["status"] in ("queued", "running") and age < JOBS_STALE
+
+
+def claim(job, spec):
+    """
+    take over (re)running a job. False if it is reusable as is, or another
+    process got there first.
+
+    the check and the reset happen under an O_EXCL lock file, so only one
+    process ever resets a job. the new run gets its own parts directory;
+    those of earlier runs go when the job is pruned
+    """
+    if reusable(read_state(job)):
+        return False
+
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    lock = claim_path(job)
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock) > CLAIM_TIMEOUT:
+                os.remove(lock)
+        except OSError:
+            pass
+        return False
+
+    try:
+        # another process may have claimed it between the check and the lock
+        if reusable(read_state(job)):
+            return False
+
+        os.makedirs(job_dir(job), exist_ok=True)
+        write_state(
+            {
+                "id": job,
+                "run": uuid.uuid4().hex[:8],
+                "status": "queued",
+                "spec": spec,
+                "parts": 0,
+                "done": 0,
+                "rows": 0,
+                "error": None,
+                "created": time.time(),
+            }
+        )
+        return True
+    finally:
+        try:
+            os.remove(lock)
+        except OSError:
+            pass
+
+
+def fail(job, error):
+    state = read_state(job)
+    if state is not None:
+        state.update(status="failed", error=repr(error))
+        write_state(state)
+
+
+def start(job, spec, parts, url):
+    """
+    queue a claimed job's partitions on the pool. progress is written to the
+    job's state as they finish. after a failure the queued partitions are
+    cancelled, and the job is marked failed once the running ones are over
+    """
+    state = read_state(job)
+    state.update(status="running", parts=len(parts))
+    write_state(state)
+
+    run = state["run"]
+    pool = get_pool()
+    lock = threading.RLock()
+    errors = []
+    finished = []
+
+    def assembled(future):
+        with lock:
+            try:
+                future.result()
+                state["status"] = "done"
+            except Exception as e:
+                state.update(status="failed", error=repr(e))
+            write_state(state)
+
+    def part_done(future):
+        with lock:
+            finished.append(future)
+            if not errors:
+                try:
+                    state["rows"] += future.result()
+                    state["done"] += 1
+                except Exception as e:
+                    errors.append(e)
+                    for f in futures:
+                        f.cancel()
+
+            if errors:
+                if len(finished) == len(futures):
+                    state.update(status="failed", error=repr(errors[0]))
+                    write_state(state)
+                return
+
+            write_state(state)
+            if state["done"] == state["parts"]:
+                pool.submit(assemble, job, run).add_done_callback(assembled)
+
+    futures = [
+        pool.submit(run_part, url, spec, part, part_path(job, run, spec, part))
+        for part in parts
+    ]
+    if not futures:
+        pool.submit(assemble, job, run).add_done_callback(assembled)
+    for f in futures:
+        f.add_done_callback(part_done)
+    return dict(state)
+
+
+def prune():
+    """
+    remove expired and abandoned jobs
+    """
+    if not os.path.isdir(JOBS_DIR):
+        return
+
+    now = time.time()
+    for job in os.listdir(JOBS_DIR):
+        if not os.path.isdir(job_dir(job)):
+            # a claim lock
+            continue
+        state = read_state(job)
+        if state is None:
+            expired = now - os.path.getmtime(job_dir(job)) > JOBS_STALE
+        else:
+            expired = not reusable(state) and now - last_progress(state) > JOBS_STALE
+        if expired:
+            shutil.rmtree(job_dir(job), ignore_errors=True)
+
+
+def main(argv=None):
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="run an export job")
+    parser.add_argument("kind", choices=[*SERIES, "ngwmn"])
+    parser.add_argument("--pointid", action="append")
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    parser.add_argument("--partition", choices=("well", "year"), default="well")
+    parser.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+    args = parser.parse_args(argv)
+
+    spec = canonical(
+        {
+            "kind": args.kind,
+            "pointids": args.pointid,
+            "start": args.start,
+            "end": args.end,
+            "partition": args.partition,
+            "format": args.format,
+        }
+    )
+    job = job_id(spec)
+    if claim(job, spec):
+        db = SessionLocal()
+        try:
+            start(job, spec, list_parts(spec, db), bind_url(db.get_bind()))
+        finally:
+            db.close()
+
+    while True:
+        state = read_state(job)
+        print(f"{job} {state['status']} {state['done']}/{state['parts']} parts")
+        if state["status"] not in ("queued", "running"):
+            break
+        time.sleep(2)
+    if state["status"] == "done":
+        print(result_path(job))
+
+
+if __name__ == "__main__":
+    main()
+
+# ============= EOF =============================================
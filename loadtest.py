@@ -0,0 +1,582 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Mixed traffic load generator.
+
+Seeds a SQLite stand-in database, starts the app against it with the ArcGIS POD
+service replaced by a local stub, and replays a weighted mix of map loads,
+location views, NGWMN harvests and paginated waterlevel walks at increasing
+concurrency, reporting throughput and tail latency for each level.
+
+    python loadtest.py run --concurrency 1,2,4,8,16,32 --duration 10
+    python loadtest.py run --mix map=1,view=4,ngwmn=2,walk=3 --workers 2
+    python loadtest.py run --url http://localhost:8000 --no-seed
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from sqlalchemy import create_engine, event, insert, text
+
+DEFAULT_DB = "./loadtest.db"
+DEFAULT_MIX = "map=1,view=4,ngwmn=2,walk=3"
+
+# stand-ins for the NGWMN views/tables that live in the dbo schema on MSSQL.
+# the " [ngwmn_*]" column suffixes are picked up by sqlite3.PARSE_COLNAMES so
+# the rows come back as date/datetime objects just as they do from pymssql
+DBO_TABLES = {
+    "view_NGWMN_WaterLevels": [
+        "PointID",
+        '"DateMeasured [ngwmn_date]"',
+        "DepthToWaterBGS",
+        "LevelUnits",
+        "MeasurementMethod",
+        "LevelAccuracy",
+    ],
+    "WaterLevelsContinuous_Pressure_Daily": [
+        "GlobalID",
+        "OBJECTID",
+        "WellID",
+        "PointID",
+        '"DateMeasured [ngwmn_datetime]"',
+        "TemperatureWater",
+        "WaterHead",
+        "WaterHeadAdjusted",
+        "DepthToWaterBGS",
+        "MeasurementMethod",
+        "DataSource",
+        "MeasuringAgency",
+        "QCed",
+        "Notes",
+        "Created",
+        "Updated",
+        "ProcessedBy",
+        "CheckedBy",
+        '"CONDDL (mS/cm)"',
+    ],
+    "view_NGWMN_WellConstruction": [
+        "PointID",
+        "CasingTop",
+        "CasingBottom",
+        "CasingDepthUnits",
+        "ScreenTop",
+        "ScreenBottom",
+        "ScreenUnits",
+        "ScreenDescription",
+        "CasingDescription",
+    ],
+    "view_NGWMN_Lithology": [
+        "PointID",
+        "LithologyCode",
+        "TERM",
+        "StratSource",
+        "StratTop",
+        "StratTopUnit",
+        "StratBottom",
+        "StratBottomUnit",
+    ],
+}
+
+sqlite3.register_converter("ngwmn_date", lambda v: date.fromisoformat(v.decode()))
+sqlite3.register_converter(
+    "ngwmn_datetime", lambda v: datetime.fromisoformat(v.decode())
+)
+
+
+def make_engine(path):
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={
+            "check_same_thread": False,
+            "detect_types": sqlite3.PARSE_COLNAMES,
+        },
+    )
+
+    @event.listens_for(engine, "connect")
+    def attach_dbo(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"ATTACH DATABASE '{path}.dbo' AS dbo")
+
+    return engine
+
+
+def pointids(nwells):
+    return [f"LT-{i:04d}" for i in range(nwells)]
+
+
+# seed =========================================================================
+def seed(path, nwells=200, nmanual=120, npressure=2000, seed_value=0):
+    import models
+    from database import Base
+
+    for p in (path, f"{path}.dbo"):
+        if os.path.exists(p):
+            os.remove(p)
+
+    engine = make_engine(path)
+    Base.metadata.create_all(bind=engine)
+
+    rng = random.Random(seed_value)
+    locations, wells, manual, pressure = [], [], [], []
+    ngwmn_manual, ngwmn_daily, construction, lithology = [], [], [], []
+    start = datetime(2000, 1, 1)
+    for pid in pointids(nwells):
+        lid, wid = uuid.uuid4(), uuid.uuid4()
+        locations.append(
+            dict(
+                LocationId=lid,
+                PointID=pid,
+                PublicRelease=True,
+                Easting=rng.randint(150000, 650000),
+                Northing=rng.randint(3500000, 4100000),
+                Altitude=rng.uniform(3000, 9000),
+            )
+        )
+        wells.append(
+            dict(
+                LocationId=lid,
+                WellID=wid,
+                PointID=pid,
+                WellDepth=rng.randint(50, 1500),
+                OSEWellID=f"RG-{rng.randint(1000, 99999)}",
+            )
+        )
+
+        base = rng.uniform(20, 400)
+        for i in range(nmanual):
+            dm = (start + timedelta(days=45 * i)).date()
+            dtw = base + rng.gauss(0, 2)
+            manual.append(
+                dict(
+                    OBJECTID=len(manual) + 1,
+                    WellID=wid,
+                    DepthToWaterBGS=dtw,
+                    DateMeasured=dm,
+                    PublicRelease=True,
+                )
+            )
+            ngwmn_manual.append(
+                (pid, dm.isoformat(), dtw, "ft bgs", "Steel tape", "0.02 ft")
+            )
+
+        t0 = datetime(2018, 1, 1)
+        for i in range(npressure):
+            dm = t0 + timedelta(hours=6 * i)
+            dtw = base + rng.gauss(0, 1)
+            pressure.append(
+                dict(
+                    GlobalID=uuid.uuid4(),
+                    OBJECTID=len(pressure) + 1,
+                    WellID=wid,
+                    DepthToWaterBGS=dtw,
+                    DateMeasured=dm,
+                )
+            )
+            if i % 4 == 0:
+                row = [None] * len(DBO_TABLES["WaterLevelsContinuous_Pressure_Daily"])
+                row[3], row[4], row[8], row[12] = pid, dm.isoformat(), dtw, 1
+                ngwmn_daily.append(tuple(row))
+
+        construction.append((pid, 0, 100, "ft", 100, 120, "ft", "PVC", "Steel"))
+        lithology.append((pid, "SAND", "Sand", "NMBGMR", 0, "ft", 100, "ft"))
+
+    with engine.begin() as conn:
+        conn.execute(insert(models.Location.__table__), locations)
+        conn.execute(insert(models.Well.__table__), wells)
+        conn.execute(insert(models.WaterLevels.__table__), manual)
+        conn.execute(insert(models.WaterLevelsContinuous_Pressure.__table__), pressure)
+
+        # the indexes production has on the waterlevel tables
+        for table in (
+            "WaterLevels",
+            "WaterLevelsContinuous_Pressure",
+            "WaterLevelsContinuous_Acoustic",
+        ):
+            conn.execute(
+                text(
+                    f"CREATE INDEX ix_{table}_wellid ON {table} (WellID, DateMeasured)"
+                )
+            )
+            conn.execute(
+                text(f"CREATE INDEX ix_{table}_date ON {table} (DateMeasured)")
+            )
+        conn.execute(text("CREATE INDEX ix_Location_pointid ON Location (PointID)"))
+        conn.execute(text("CREATE INDEX ix_WellData_location ON WellData (LocationId)"))
+
+        for name, rows in (
+            ("view_NGWMN_WaterLevels", ngwmn_manual),
+            ("WaterLevelsContinuous_Pressure_Daily", ngwmn_daily),
+            ("view_NGWMN_WellConstruction", construction),
+            ("view_NGWMN_Lithology", lithology),
+        ):
+            columns = DBO_TABLES[name]
+            conn.execute(text(f"CREATE TABLE dbo.{name} ({', '.join(columns)})"))
+            conn.execute(
+                text(f"CREATE INDEX dbo.ix_{name}_pointid ON {name} (PointID)")
+            )
+            params = ", ".join(f":p{i}" for i in range(len(columns)))
+            conn.execute(
+                text(f"INSERT INTO dbo.{name} VALUES ({params})"),
+                [{f"p{i}": v for i, v in enumerate(r)} for r in rows],
+            )
+
+    engine.dispose()
+
+
+# POD stub =====================================================================
+class PODStubHandler(BaseHTTPRequestHandler):
+    latency = 0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        body = json.dumps(
+            {
+                "features": [
+                    {
+                        "attributes": {
+                            "db_file": "stub",
+                            "nmwrrs_wrs": "http://localhost/water-right",
+                            "pod_status": "ACT",
+                        },
+                        "geometry": {"x": -106.0, "y": 34.5},
+                    }
+                ]
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_pod_stub(latency=0):
+    PODStubHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PODStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/query"
+
+
+# serve ========================================================================
+def create_app():
+    """
+    uvicorn factory used by `serve`. Configured through the LOADTEST_DB and
+    POD_SERVICE_URL environment variables so every worker process builds the
+    same app
+    """
+    from sqlalchemy.orm import sessionmaker
+
+    import crud
+    from main import app, get_db
+
+    engine = make_engine(os.environ.get("LOADTEST_DB", DEFAULT_DB))
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_loadtest_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    crud.POD_SERVICE_URL = os.environ.get("POD_SERVICE_URL", crud.POD_SERVICE_URL)
+    app.dependency_overrides[get_db] = get_loadtest_db
+    return app
+
+
+def serve(db, port, workers=1):
+    import uvicorn
+
+    os.environ["LOADTEST_DB"] = db
+    uvicorn.run(
+        "loadtest:create_app",
+        factory=True,
+        host="127.0.0.1",
+        port=port,
+        workers=workers,
+        log_level="warning",
+    )
+
+
+def spawn_server(db, port, workers, pod_url):
+    env = dict(os.environ, POD_SERVICE_URL=pod_url)
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            __file__,
+            "serve",
+            "--db",
+            db,
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+        ],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/docs", timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+
+    proc.terminate()
+    raise RuntimeError("server failed to start")
+
+
+# traffic profiles =============================================================
+# each profile is one user action and may issue several requests. returns the
+# number of requests made; raises on any non-200 response
+def profile_map(session, url, pids, rng):
+    check(session.get(f"{url}/map"))
+    return 1
+
+
+def profile_view(session, url, pids, rng):
+    check(session.get(f"{url}/locations/view/{rng.choice(pids)}"))
+    return 1
+
+
+def profile_ngwmn(session, url, pids, rng):
+    pid = rng.choice(pids)
+    for doc in ("waterlevels", "wellconstruction", "lithology"):
+        check(session.get(f"{url}/ngwmn/{doc}/{pid}"))
+    return 3
+
+
+def profile_walk(session, url, pids, rng, size=100):
+    pid = rng.choice(pids)
+    kind = rng.choice(("manual", "pressure"))
+    page, pages = 1, 1
+    while page <= pages:
+        resp = check(
+            session.get(
+                f"{url}/waterlevels/{kind}",
+                params={"pointid": pid, "page": page, "size": size},
+            )
+        )
+        pages = resp.json()["pages"] or 0
+        page += 1
+    return page - 1
+
+
+PROFILES = {
+    "map": profile_map,
+    "view": profile_view,
+    "ngwmn": profile_ngwmn,
+    "walk": profile_walk,
+}
+
+
+def check(resp):
+    if resp.status_code != 200:
+        raise RuntimeError(f"{resp.request.url} {resp.status_code}")
+    return resp
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        if name not in PROFILES:
+            raise ValueError(f"unknown profile {name}. choose from {list(PROFILES)}")
+        weights[name] = float(weight)
+    return weights
+
+
+# runner =======================================================================
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def run_level(url, pids, weights, concurrency, duration, seed_value=0):
+    names = list(weights)
+    cum = list(weights.values())
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    samples = []
+    errors = {}
+
+    def worker(i):
+        rng = random.Random(seed_value * 1000 + i)
+        session = requests.Session()
+        local = []
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, cum)[0]
+            st = time.perf_counter()
+            ok, nreq = True, 1
+            try:
+                nreq = PROFILES[name](session, url, pids, rng)
+            except Exception as e:
+                ok = False
+                with lock:
+                    errors[name] = str(e)
+            local.append((name, time.perf_counter() - st, ok, nreq))
+
+        with lock:
+            samples.extend(local)
+
+    st = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return samples, time.perf_counter() - st, errors
+
+
+def summarize(samples, elapsed):
+    lat = [s[1] * 1000 for s in samples if s[2]]
+    return {
+        "actions": len(samples),
+        "requests": sum(s[3] for s in samples),
+        "errors": sum(1 for s in samples if not s[2]),
+        "aps": len(samples) / elapsed,
+        "rps": sum(s[3] for s in samples) / elapsed,
+        "p50": percentile(lat, 50),
+        "p95": percentile(lat, 95),
+        "p99": percentile(lat, 99),
+    }
+
+
+def report(results, by_profile):
+    header = f"{'conc':>5} {'actions':>8} {'reqs':>7} {'err':>5} {'act/s':>8} {'req/s':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8}"
+    print(header)
+    print("-" * len(header))
+    for concurrency, samples, elapsed in results:
+        rows = [("", samples)]
+        if by_profile:
+            for name in sorted({s[0] for s in samples}):
+                rows.append((name, [s for s in samples if s[0] == name]))
+
+        for name, ss in rows:
+            r = summarize(ss, elapsed)
+            label = f"{concurrency:>5}" if not name else f"{name:>5}"
+            print(
+                f"{label:>5} {r['actions']:>8} {r['requests']:>7} {r['errors']:>5} {r['aps']:>8.1f} "
+                f"{r['rps']:>8.1f} {r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f}"
+            )
+
+    # saturation: first level where doubling concurrency no longer buys at
+    # least 10% more throughput
+    totals = [(c, summarize(s, e)) for c, s, e in results]
+    for (c0, r0), (c1, r1) in zip(totals, totals[1:]):
+        if r1["rps"] < r0["rps"] * 1.1:
+            print(
+                f"\nthroughput saturates at ~{c0} concurrent clients "
+                f"({r0['rps']:.1f} req/s, p99 {r0['p99']:.0f}ms -> {r1['p99']:.0f}ms at {c1})"
+            )
+            break
+    else:
+        print("\nno saturation observed. try higher concurrency levels")
+
+
+def run(args):
+    weights = parse_mix(args.mix)
+    url, proc, pod_server = args.url, None, None
+    if not url and (not args.no_seed or not os.path.exists(args.db)):
+        print(f"seeding {args.db} with {args.wells} wells")
+        seed(args.db, args.wells, args.manual, args.pressure)
+
+    pids = pointids(args.wells)
+    try:
+        if not url:
+            pod_server, pod_url = start_pod_stub(args.pod_latency)
+            proc, url = spawn_server(args.db, args.port, args.workers, pod_url)
+
+        # warm up connections and caches before measuring
+        run_level(url, pids, weights, 1, 1)
+
+        results, errors = [], {}
+        for c in [int(c) for c in args.concurrency.split(",")]:
+            samples, elapsed, errs = run_level(url, pids, weights, c, args.duration)
+            results.append((c, samples, elapsed))
+            errors.update(errs)
+
+        report(results, args.by_profile)
+        for name, err in errors.items():
+            print(f"last {name} error: {err}")
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        if pod_server:
+            pod_server.shutdown()
+            pod_server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("seed", help="create the SQLite stand-in database")
+    p.add_argument("--db", default=DEFAULT_DB)
+    p.add_argument("--wells", type=int, default=200)
+    p.add_argument("--manual", type=int, default=120)
+    p.add_argument("--pressure", type=int, default=2000)
+
+    p = sub.add_parser("serve", help="serve the app against the stand-in database")
+    p.add_argument("--db", default=DEFAULT_DB)
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=1)
+
+    p = sub.add_parser("run", help="replay the traffic mix and report")
+    p.add_argument("--url", help="target an already running app instead")
+    p.add_argument("--db", default=DEFAULT_DB)
+    p.add_argument("--no-seed", action="store_true")
+    p.add_argument("--wells", type=int, default=200)
+    p.add_argument("--manual", type=int, default=120)
+    p.add_argument("--pressure", type=int, default=2000)
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--mix", default=DEFAULT_MIX)
+    p.add_argument("--concurrency", default="1,2,4,8,16,32")
+    p.add_argument("--duration", type=float, default=10, help="seconds per level")
+    p.add_argument("--pod-latency", type=float, default=0.05)
+    p.add_argument("--by-profile", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "seed":
+        seed(args.db, args.wells, args.manual, args.pressure)
+    elif args.command == "serve":
+        serve(args.db, args.port, args.workers)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
+
+# ============= EOF =============================================
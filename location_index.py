@@ -0,0 +1,570 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Columnar, memory-mapped index of public locations.
+
+A refresher builds the index as a set of .npy columns plus pre-rendered
+documents (the map geojson, a JSON-LD document per location and sitemaps for
+geoconnex harvesters) in a versioned directory under LOCATION_INDEX_DIR, then
+swaps the CURRENT pointer. Workers map the columns read-only
+(np.load(mmap_mode="r")), so every worker on a host shares the same page
+cache copy. Workers pick up a new version within LOCATION_INDEX_CHECK seconds.
+
+    python location_index.py               # build once
+    python location_index.py --every 600   # keep refreshing
+
+A worker that finds no index builds one itself on first use. Without a
+refresher, a worker serving a version older than LOCATION_INDEX_MAX_AGE
+seconds rebuilds it in a background thread and keeps serving the old one
+meanwhile. Builds hold an exclusive lock on BUILD.lock in LOCATION_INDEX_DIR,
+so concurrent workers build once between them. A superseded version is removed only after
+LOCATION_INDEX_CHECK + LOCATION_INDEX_PRUNE_GRACE seconds, when no worker is
+still serving it.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+import models
+import schemas
+from crud import public_release_filter
+from database import new_session
+from dependencies import BULK_TIMEOUT
+from geo_utils import utm_to_latlon
+from singleflight import SingleFlight
+
+LOCATION_INDEX_DIR = os.environ.get("LOCATION_INDEX_DIR", "./location_index")
+LOCATION_INDEX_CHECK = float(os.environ.get("LOCATION_INDEX_CHECK", 5))
+LOCATION_INDEX_MAX_AGE = float(os.environ.get("LOCATION_INDEX_MAX_AGE", 3600))
+KEEP_VERSIONS = 2
+PRUNE_GRACE = float(os.environ.get("LOCATION_INDEX_PRUNE_GRACE", 300))
+# bumped when the set of pre-rendered documents changes. older versions are
+# rebuilt on first use
+FORMAT = 2
+
+# documents are rendered without knowing the host they will be served from.
+# BASE is replaced by the request's base url when they are served
+BASE = "{{base_url}}"
+SITEMAP_SIZE = 50000
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+COLUMNS = (
+    "location_id",
+    "pointid",
+    "alternate_site_id",
+    "search_key",
+    "lon",
+    "lat",
+    "elevation",
+    "elevation_method",
+)
+
+
+# build ========================================================================
+def read_records(db):
+    q = db.query(
+        models.Location.LocationId,
+        models.Location.PointID,
+        models.Location.AlternateSiteID,
+        models.Location.Easting,
+        models.Location.Northing,
+        models.Location.Altitude,
+        models.LU_AltitudeMethod.Meaning,
+    )
+    q = q.outerjoin(
+        models.LU_AltitudeMethod,
+        models.LU_AltitudeMethod.Code == models.Location.AltitudeMethod,
+    )
+    q = public_release_filter(q)
+    q = q.order_by(models.Location.PointID)
+    return q.all()
+
+
+def fixed_width(values):
+    values = [(v or "").encode() for v in values]
+    width = max([len(v) for v in values] + [1])
+    return np.array(values, dtype=f"S{width}")
+
+
+def build_columns(records):
+    """
+    columns from (LocationId, PointID, AlternateSiteID, Easting, Northing,
+    Altitude, elevation method meaning) records
+    """
+    n = len(records)
+    e = np.array([r[3] if r[3] is not None else np.nan for r in records], float)
+    nn = np.array([r[4] if r[4] is not None else np.nan for r in records], float)
+    lon, lat = utm_to_latlon(e, nn) if n else (np.empty(0), np.empty(0))
+
+    altitude = np.array([r[5] if r[5] is not None else np.nan for r in records], float)
+
+    methods = sorted({r[6] for r in records if r[6]})
+    codes = {m: i for i, m in enumerate(methods)}
+
+    pointids = [r[1] or "" for r in records]
+    alternates = [r[2] or "" for r in records]
+    columns = {
+        "location_id": fixed_width([str(r[0]) for r in records]),
+        "pointid": fixed_width(pointids),
+        "alternate_site_id": fixed_width(alternates),
+        "search_key": fixed_width(
+            [f"{p}|{a}".upper() for p, a in zip(pointids, alternates)]
+        ),
+        "lon": np.asarray(lon, dtype=float),
+        "lat": np.asarray(lat, dtype=float),
+        # altitude is in ft above sea level geojson wants meters
+        "elevation": altitude * 0.3048,
+        "elevation_method": np.array(
+            [codes.get(r[6], -1) for r in records], dtype=np.int16
+        ),
+    }
+    return columns, methods
+
+
+def write_index(records, root=None):
+    """
+    write a new index version and point CURRENT at it. returns its path
+    """
+    root = root or LOCATION_INDEX_DIR
+    columns, methods = build_columns(records)
+
+    # names sort in build order, also for builds within the same second
+    now = time.time()
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(now))
+    version = f"{stamp}.{int(now % 1 * 1e6):06d}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(root, version)
+    os.makedirs(path)
+    for name, values in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), values)
+
+    n_sitemaps = max(1, -(-len(records) // SITEMAP_SIZE))
+    with open(os.path.join(path, "meta.json"), "w") as wfile:
+        json.dump(
+            {
+                "format": FORMAT,
+                "count": len(records),
+                "elevation_methods": methods,
+                "sitemaps": n_sitemaps,
+                "lastmod": time.strftime("%Y-%m-%d"),
+            },
+            wfile,
+        )
+
+    index = LocationIndex(path)
+    with open(os.path.join(path, "locations.geojson"), "wb") as wfile:
+        wfile.write(json.dumps(index.features(named=True)).encode())
+    write_jsonld(index, path)
+    write_sitemaps(index, path)
+
+    tmp = os.path.join(root, f"CURRENT.{os.getpid()}.tmp")
+    with open(tmp, "w") as wfile:
+        wfile.write(version)
+    os.replace(tmp, os.path.join(root, "CURRENT"))
+
+    prune(root, version)
+    return path
+
+
+def jsonld_documents(index):
+    """
+    the /locations/pointid/{pointid}/jsonld document of every location, in
+    one pass over the columns
+    """
+    context = schemas.LocationJSONLD.__fields__["context"].default
+    features = index.features()
+    location_ids = [v.decode() for v in index.location_id]
+    for location_id, f in zip(location_ids, features):
+        props = f["properties"]
+        pointid = props["point_id"]
+        lon, lat, _ = f["geometry"]["coordinates"]
+        yield {
+            "LocationId": location_id,
+            "PointID": pointid,
+            "PublicRelease": True,
+            "alternate_site_id": props["alternate_name"],
+            "elevation_method": props["elevation_method"],
+            "geometry": {"coordinates": f["geometry"]["coordinates"], "type": "Point"},
+            "@context": context,
+            "type": "schema:Place",
+            "geosparql:hasGeometry": {
+                "@type": "http://www.opengis.net/ont/sf#Point",
+                "geosparql:asWKT": f"POINT({lon}, {lat})",
+            },
+            "schema:geo": {
+                "@type": "schema:GeoCoordinates",
+                "schema:latitude": lon,
+                "schema:longitude": lat,
+            },
+            "links": [
+                {
+                    "rel": "self",
+                    "href": f"{BASE}locations/pointid/{pointid}/jsonld",
+                    "type": "application/ld+json",
+                    "title": "This document as RDF (JSON-LD)",
+                },
+                {
+                    "rel": "alternate",
+                    "href": f"{BASE}location/pointid/{pointid}",
+                    "type": "application/json",
+                    "title": "This document as JSON",
+                },
+                {
+                    "rel": "alternate",
+                    "href": f"{BASE}location/pointid/{pointid}/geojson",
+                    "type": "application/geo+json",
+                    "title": "This document as GeoJSON",
+                },
+            ],
+        }
+
+
+def write_jsonld(index, path):
+    """
+    all JSON-LD documents as newline delimited JSON
+    """
+    with open(os.path.join(path, "locations.jsonld"), "w") as wfile:
+        for doc in jsonld_documents(index):
+            wfile.write(json.dumps(doc, separators=(",", ":")))
+            wfile.write("\n")
+
+
+def write_sitemaps(index, path):
+    """
+    sitemap pages of SITEMAP_SIZE JSON-LD urls each
+    """
+    pointids = [p.decode() for p in index.pointid]
+    meta = index.meta
+    for i in range(meta["sitemaps"]):
+        page = pointids[i * SITEMAP_SIZE : (i + 1) * SITEMAP_SIZE]
+        with open(os.path.join(path, f"sitemap-{i}.xml"), "w") as wfile:
+            wfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            wfile.write(f'<urlset xmlns="{SITEMAP_NS}">\n')
+            for p in page:
+                loc = escape(f"{BASE}locations/pointid/{p}/jsonld")
+                wfile.write(
+                    f"<url><loc>{loc}</loc><lastmod>{meta['lastmod']}</lastmod></url>\n"
+                )
+            wfile.write("</urlset>\n")
+
+
+def prune(root, current):
+    """
+    remove old versions, keeping the newest KEEP_VERSIONS. a version is only
+    removed once it was superseded more than LOCATION_INDEX_CHECK +
+    PRUNE_GRACE seconds ago; workers may serve it until their next check
+    """
+    versions = sorted(
+        d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d))
+    )
+    cutoff = time.time() - LOCATION_INDEX_CHECK - PRUNE_GRACE
+    for old, newer in zip(versions[:-KEEP_VERSIONS], versions[1:]):
+        # a version directory is last modified when it is published
+        superseded = os.path.getmtime(os.path.join(root, newer))
+        if old != current and superseded < cutoff:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+
+@contextmanager
+def build_lock(root):
+    """
+    exclusive lock on root/BUILD.lock, held while a version is written and
+    old ones pruned. shared between workers and the refresher
+    """
+    with open(os.path.join(root, "BUILD.lock"), "a") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def refresh_index(db, root=None):
+    root = root or LOCATION_INDEX_DIR
+    with build_lock(root):
+        return write_index(read_records(db), root)
+
+
+def age(path):
+    # a version directory is last modified when it is published
+    return time.time() - os.path.getmtime(path)
+
+
+def refresh_stale(db, root):
+    """
+    rebuild the index if it is still older than LOCATION_INDEX_MAX_AGE once
+    the build lock is held. another worker may have rebuilt it meanwhile
+    """
+    with build_lock(root):
+        path = current_path(root)
+        if path is None or age(path) > LOCATION_INDEX_MAX_AGE:
+            return write_index(read_records(db), root)
+
+
+def refresh_in_background(db, root):
+    """
+    run refresh_stale in a daemon thread, on a session of its own with the
+    bulk statement timeout. concurrent callers share one refresh
+    """
+
+    def run():
+        with new_session(db) as session:
+            session.info["statement_timeout"] = BULK_TIMEOUT
+            flight.do(root, refresh_stale, session, root)
+
+    if not flight.in_flight:
+        threading.Thread(target=run, name="location-index", daemon=True).start()
+
+
+# read =========================================================================
+def finite(v):
+    return None if v != v else v
+
+
+class LocationIndex:
+    def __init__(self, path):
+        self.path = path
+        for name in COLUMNS:
+            setattr(
+                self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            )
+        with open(os.path.join(path, "meta.json")) as rfile:
+            meta = json.load(rfile)
+        self.meta = meta
+        self.elevation_methods = meta["elevation_methods"]
+
+    def __len__(self):
+        return len(self.pointid)
+
+    def geojson(self):
+        """
+        the pre-rendered list of {"name": PointID} features
+        """
+        with open(os.path.join(self.path, "locations.geojson"), "rb") as rfile:
+            return rfile.read()
+
+    def jsonld(self, base_url, chunk_size=1 << 20):
+        """
+        stream the pre-rendered JSON-LD documents, one per line
+        """
+        base_url = base_url.encode()
+        with open(os.path.join(self.path, "locations.jsonld"), "rb") as rfile:
+            while True:
+                # whole lines only, so BASE is never split across chunks
+                lines = rfile.readlines(chunk_size)
+                if not lines:
+                    break
+                yield b"".join(lines).replace(BASE.encode(), base_url)
+
+    def sitemap_index(self, base_url):
+        lastmod = self.meta["lastmod"]
+        entries = "".join(
+            f"<sitemap><loc>{escape(base_url)}locations/sitemap/{i}.xml</loc>"
+            f"<lastmod>{lastmod}</lastmod></sitemap>\n"
+            for i in range(self.meta["sitemaps"])
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<sitemapindex xmlns="{SITEMAP_NS}">\n{entries}</sitemapindex>\n'
+        )
+
+    def sitemap(self, i, base_url):
+        """
+        sitemap page i, or None if there is no such page
+        """
+        if not 0 <= i < self.meta["sitemaps"]:
+            return
+        with open(os.path.join(self.path, f"sitemap-{i}.xml"), "rb") as rfile:
+            return rfile.read().replace(BASE.encode(), escape(base_url).encode())
+
+    def features(self, idx=None, named=False, extra=None):
+        if idx is None:
+            idx = np.arange(len(self))
+
+        lon = self.lon[idx].tolist()
+        lat = self.lat[idx].tolist()
+        elevation = self.elevation[idx].tolist()
+        pointid = [p.decode() for p in self.pointid[idx]]
+        if named:
+            props = [{"name": p} for p in pointid]
+        else:
+            alternate = [a.decode() or None for a in self.alternate_site_id[idx]]
+            methods = [
+                self.elevation_methods[m] if m >= 0 else None
+                for m in self.elevation_method[idx].tolist()
+            ]
+            props = [
+                {"point_id": p, "alternate_name": a, "elevation_method": m}
+                for p, a, m in zip(pointid, alternate, methods)
+            ]
+        if extra:
+            for key, values in extra.items():
+                for p, v in zip(props, values):
+                    p[key] = v
+
+        return [
+            {
+                "type": "Feature",
+                "properties": p,
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [finite(x), finite(y), finite(z)],
+                },
+            }
+            for p, x, y, z in zip(props, lon, lat, elevation)
+        ]
+
+    def bbox(self, minx, miny, maxx, maxy):
+        lon, lat = self.lon, self.lat
+        mask = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+        return np.flatnonzero(mask)
+
+    def within(self, geometry):
+        """
+        indices of the locations inside a shapely (multi)polygon. a bbox
+        prefilter on the mapped columns, then one vectorized point in
+        polygon test over the candidates against the prepared geometry
+        """
+        import shapely
+
+        idx = self.bbox(*geometry.bounds)
+        if not len(idx):
+            return idx
+        shapely.prepare(geometry)
+        inside = shapely.contains_xy(geometry, self.lon[idx], self.lat[idx])
+        return idx[inside]
+
+    def nearest(self, lon, lat, n=10):
+        """
+        indices of the n closest locations and their great circle distance (km)
+        """
+        lon1, lat1 = np.radians(self.lon), np.radians(self.lat)
+        lon0, lat0 = np.radians(lon), np.radians(lat)
+        a = (
+            np.sin((lat1 - lat0) / 2) ** 2
+            + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+        )
+        d = 2 * 6371.0088 * np.arcsin(np.sqrt(a))
+        d = np.where(np.isnan(d), np.inf, d)
+
+        n = min(n, len(d))
+        if not n:
+            return np.empty(0, dtype=int), np.empty(0)
+        idx = np.argpartition(d, n - 1)[:n]
+        idx = idx[np.argsort(d[idx], kind="stable")]
+        idx = idx[np.isfinite(d[idx])]
+        return idx, d[idx]
+
+    def search(self, text, limit=50):
+        """
+        case-insensitive substring match on PointID and AlternateSiteID
+        """
+        text = text.strip().upper().encode()
+        if not text:
+            return np.empty(0, dtype=int)
+        hits = np.flatnonzero(np.char.find(self.search_key, text) >= 0)
+        return hits[:limit]
+
+
+_index = None
+_checked = 0
+_lock = threading.Lock()
+flight = SingleFlight("location_index")
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, "CURRENT")) as rfile:
+            return rfile.read().strip()
+    except FileNotFoundError:
+        return
+
+
+def current_path(root):
+    """
+    path of the published version, or None if there is none or it was built
+    in an older FORMAT
+    """
+    version = current_version(root)
+    if version is None:
+        return
+    path = os.path.join(root, version)
+    with open(os.path.join(path, "meta.json")) as rfile:
+        if json.load(rfile).get("format", 1) < FORMAT:
+            return
+    return path
+
+
+def get_index(db):
+    """
+    the current index, re-mapped when the refresher has published a new
+    version. builds one if none exists yet, and starts a rebuild in the
+    background if the current one is older than LOCATION_INDEX_MAX_AGE
+    """
+    global _index, _checked
+
+    now = time.monotonic()
+    if _index is not None and now - _checked < LOCATION_INDEX_CHECK:
+        return _index
+
+    with _lock:
+        _checked = now
+        root = LOCATION_INDEX_DIR
+        path = current_path(root)
+        if path is None:
+            os.makedirs(root, exist_ok=True)
+            with build_lock(root):
+                # another worker may have built it while this one waited
+                path = current_path(root) or write_index(read_records(db), root)
+        elif LOCATION_INDEX_MAX_AGE and age(path) > LOCATION_INDEX_MAX_AGE:
+            refresh_in_background(db, root)
+
+        if _index is None or _index.path != path:
+            _index = LocationIndex(path)
+        return _index
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="build the location index")
+    parser.add_argument("--every", type=float, default=0, help="refresh period (s)")
+    args = parser.parse_args()
+
+    os.makedirs(LOCATION_INDEX_DIR, exist_ok=True)
+    while 1:
+        db = SessionLocal()
+        try:
+            path = refresh_index(db)
+            print(f"wrote {path}")
+        finally:
+            db.close()
+
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+# ============= EOF =============================================
@@ -16,13 +16,15 @@
 import json
 
 from fastapi import Depends, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi_pagination import add_pagination
 
 from sqlalchemy.orm import Session
 
+import metrics
 import models
 import schemas
+from admission import AdmissionMiddleware, controller
 from app import app
 
 from crud import (
@@ -30,15 +32,23 @@ from crud import (
     public_release_filter,
     _read_pods,
     read_waterlevels_pressure_query,
-    read_locations,
+    read_location_list,
 )
 
-import plotly
-import plotly.graph_objects as go
-
-from dependencies import get_db
-from routers import locations, wells, waterlevels, ngwmn
-from starlette.templating import Jinja2Templates
+from database import QueryTimeout, QueryCancelled
+from dependencies import get_db, get_interactive_db
+from graphql_app import graphql_app
+from routers import (
+    batch,
+    changes,
+    jobs,
+    locations,
+    wells,
+    waterlevels,
+    waterchemistry,
+    ngwmn,
+)
+from templating import get_templates
 
 # ===============================================================================
 # views
@@ -69,18 +79,13 @@ from fastapi.responses import JSONResponse
 #     content = jsonable_encoder(content)
 #     return JSONResponse(content=content)
 
-from pathlib import Path
-
-BASE_DIR = Path(__file__).resolve().parent
-templates = Jinja2Templates(directory=str(Path(BASE_DIR, "templates")))
-
 
 @app.get("/map", response_class=HTMLResponse)
-def map_view(request: Request, db: Session = Depends(get_db)):
+def map_view(request: Request, db: Session = Depends(get_interactive_db)):
     # q = db.query(models.Location.__table__)
     # q = public_release_filter(q)
     # locations = q.all()
-    locations = read_locations(db)
+    locations = read_location_list(db)
 
     def make_point(i):
         return {
@@ -89,7 +94,7 @@ def map_view(request: Request, db: Session = Depends(get_db)):
             "geometry": i.geometry,
         }
 
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
         "map_view.html",
         {
             "request": request,
@@ -98,7 +103,7 @@ def map_view(request: Request, db: Session = Depends(get_db)):
             "points": {
                 "type": "FeatureCollection",
                 "features": [make_point(i) for i in locations],
-            }
+            },
             # "points": {
             #     'type': 'FeatureCollection',
             #     'features': [
@@ -115,12 +120,38 @@ def map_view(request: Request, db: Session = Depends(get_db)):
 # ===============================================================================
 
 
+# ===============================================================================
+# errors
+@app.exception_handler(QueryTimeout)
+def query_timeout_handler(request: Request, exc: QueryTimeout):
+    return PlainTextResponse(str(exc), status_code=504)
+
+
+@app.exception_handler(QueryCancelled)
+def query_cancelled_handler(request: Request, exc: QueryCancelled):
+    # client closed the connection. nobody is listening for this response
+    return PlainTextResponse("client disconnected", status_code=499)
+
+
+# ===============================================================================
+# metrics
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics():
+    return metrics.render()
+
+
 # ===============================================================================
 # routes
+app.add_middleware(AdmissionMiddleware, controller=controller)
 app.include_router(locations.router)
 app.include_router(wells.router)
 app.include_router(waterlevels.router)
+app.include_router(waterchemistry.router)
 app.include_router(ngwmn.router)
+app.include_router(batch.router)
+app.include_router(changes.router)
+app.include_router(jobs.router)
+app.include_router(graphql_app, prefix="/graphql", include_in_schema=False)
 add_pagination(app)
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Minimal Prometheus text exposition.
+
+Modules register a collector, a callable returning a list of
+(name, type, help, samples) where samples is a list of (labels, value).
+"""
+
+COLLECTORS = []
+
+
+def register(collector):
+    COLLECTORS.append(collector)
+    return collector
+
+
+def render():
+    lines = []
+    for collector in COLLECTORS:
+        for name, kind, help_text, samples in collector():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if labels:
+                    ls = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{ls}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# ============= EOF =============================================
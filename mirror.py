@@ -0,0 +1,224 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Local read mirror of the public data.
+
+Snapshots the publicly released Location and WellData rows, the LU_* lookups
+and the public manual, pressure and acoustic water levels into a SQLite file
+(DB_MIRROR_PATH), indexed for the API's access paths. With
+DB_READ_MODE=mirror, read-only routes are served from it (see
+database.Mirror).
+
+    python mirror.py           # incremental
+    python mirror.py --full    # rebuild from scratch
+
+An incremental sync copies the current file, re-copies the small tables and
+appends water levels changed since the stored change feed position of each
+table (see crud.change_feed_order), plus the rows with no watermark at all. Either way the new snapshot is written
+beside the live one and swapped in with a rename, so readers never see a
+half written mirror. Run --full periodically to drop rows that were deleted
+or edited without a watermark bump.
+"""
+
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, delete, insert, select, text
+
+import models
+from crud import change_feed_order, change_feed_query, rows_without_watermark
+from database import MIRROR_PATH
+
+CHUNK_SIZE = 5000
+
+LOOKUPS = (
+    models.LU_Formations,
+    models.LU_MeasurementMethod,
+    models.LU_DataSource,
+    models.LU_AltitudeMethod,
+)
+SERIES = (
+    models.WaterLevels,
+    models.WaterLevelsContinuous_Pressure,
+    models.WaterLevelsContinuous_Acoustic,
+)
+TABLES = (*LOOKUPS, models.Location, models.Well, *SERIES)
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS ix_location_pointid ON "Location" ("PointID")',
+    'CREATE INDEX IF NOT EXISTS ix_welldata_locationid ON "WellData" ("LocationId")',
+    'CREATE INDEX IF NOT EXISTS ix_welldata_pointid ON "WellData" ("PointID")',
+    "CREATE INDEX IF NOT EXISTS ix_waterlevels_well_date "
+    'ON "WaterLevels" ("WellID", "DateMeasured")',
+    "CREATE INDEX IF NOT EXISTS ix_pressure_well_date "
+    'ON "WaterLevelsContinuous_Pressure" ("WellID", "DateMeasured")',
+    "CREATE INDEX IF NOT EXISTS ix_acoustic_well_date "
+    'ON "WaterLevelsContinuous_Acoustic" ("WellID", "DateMeasured")',
+)
+
+
+def public_query(table):
+    t = table.__table__
+    if table in LOOKUPS:
+        return select(t)
+    if table is models.Location:
+        return select(t).where(t.c.PublicRelease == True)
+    if table is models.Well:
+        q = select(t).join(models.Location.__table__)
+        return q.where(models.Location.PublicRelease == True)
+
+    public = select(models.Well.WellID).join(models.Location)
+    public = public.where(models.Location.PublicRelease == True)
+    return select(t).where(t.c.WellID.in_(public))
+
+
+def copy_rows(db, conn, table, q, replace=False):
+    """
+    stream the rows of `q` from the source session into the mirror. returns
+    (count, last row)
+    """
+    t = table.__table__
+    names = [c.name for c in t.c]
+    stmt = insert(t).prefix_with("OR REPLACE") if replace else insert(t)
+
+    count, last = 0, None
+    result = db.execute(q.execution_options(stream_results=True))
+    for rows in result.partitions(CHUNK_SIZE):
+        conn.execute(stmt, [{n: r._mapping[n] for n in names} for r in rows])
+        count += len(rows)
+        last = rows[-1]
+    return count, last
+
+
+def encode(obj):
+    return obj.isoformat() if hasattr(obj, "isoformat") else str(obj)
+
+
+def read_meta(conn):
+    return dict(conn.execute(text("SELECT key, value FROM mirror_meta")).all())
+
+
+def read_position(meta, table, order):
+    position = meta.get(f"position:{table.__tablename__}")
+    if position:
+        position = json.loads(position)
+        if len(position) == len(order):
+            return [
+                datetime.fromisoformat(v) if c.name == "Updated" and v else v
+                for c, v in zip(order, position)
+            ]
+
+
+def sync(db, path=None, full=False):
+    """
+    write a new mirror snapshot from the source session `db` and swap it in.
+    returns {table name: rows copied}
+    """
+    path = path or MIRROR_PATH
+    full = full or not os.path.isfile(path)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if full:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    else:
+        shutil.copyfile(path, tmp)
+
+    copied = {}
+    engine = create_engine(f"sqlite:///{tmp}")
+    try:
+        models.Base.metadata.create_all(engine, tables=[t.__table__ for t in TABLES])
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS mirror_meta "
+                    "(key VARCHAR PRIMARY KEY, value VARCHAR)"
+                )
+            )
+            meta = read_meta(conn)
+
+            # small tables are copied whole every time
+            for table in (*LOOKUPS, models.Location, models.Well):
+                conn.execute(delete(table.__table__))
+                copied[table.__tablename__], _ = copy_rows(
+                    db, conn, table, public_query(table)
+                )
+
+            for table in SERIES:
+                name = table.__tablename__
+                order = change_feed_order(table, db)
+                if order is None:
+                    # no watermark to resume from
+                    conn.execute(delete(table.__table__))
+                    copied[name], _ = copy_rows(db, conn, table, public_query(table))
+                    continue
+
+                after = None if full else read_position(meta, table, order)
+                q = change_feed_query(table, order, after)
+                copied[name], last = copy_rows(db, conn, table, q, replace=not full)
+                if after:
+                    # rows without a watermark sort before any position
+                    q = rows_without_watermark(table, order)
+                    n, _ = copy_rows(db, conn, table, q, replace=True)
+                    copied[name] += n
+                if last is not None:
+                    meta[f"position:{name}"] = json.dumps(
+                        [last._mapping[c.name] for c in order], default=encode
+                    )
+
+            for sql in INDEXES:
+                conn.execute(text(sql))
+
+            meta["synced_at"] = datetime.now().isoformat()
+            meta["mode"] = "full" if full else "incremental"
+            conn.execute(text("DELETE FROM mirror_meta"))
+            conn.execute(
+                text("INSERT INTO mirror_meta (key, value) VALUES (:key, :value)"),
+                [{"key": k, "value": v} for k, v in meta.items()],
+            )
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+    finally:
+        engine.dispose()
+
+    os.replace(tmp, path)
+    return copied
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="sync the local read mirror")
+    parser.add_argument("--full", action="store_true", help="rebuild from scratch")
+    parser.add_argument("--path", default=MIRROR_PATH)
+    args = parser.parse_args()
+
+    st = time.time()
+    db = SessionLocal()
+    try:
+        copied = sync(db, args.path, args.full)
+    finally:
+        db.close()
+
+    for name, n in copied.items():
+        print(f"{name:<32} {n:>10}")
+    print(f"synced {args.path} in {time.time() - st:0.1f}s")
+
+# ============= EOF =============================================
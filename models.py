@@ -228,4 +228,47 @@ class WaterLevels(Base, MeasurementMixin):
     PublicRelease = Column(Boolean)
 
 
+# Water chemistry ==============================================================
+class ChemistrySampleInfo(Base):
+    __tablename__ = "ChemistrySampleInfo"
+    SamplePtID = Column(GUID, primary_key=True)
+    SamplePointID = Column(String(10))
+    LocationId = Column(GUID, ForeignKey("Location.LocationId"))
+    WCLab_ID = Column(String(25))
+    CollectionDate = Column(DateTime)
+    CollectionMethod = Column(String(50))
+    CollectedBy = Column(String(50))
+    SampleType = Column(String(50))
+    DataSource = Column(String(50))
+    PublicRelease = Column(Boolean)
+    OBJECTID = Column(Integer)
+
+
+class ChemistryMixin(object):
+    GlobalID = Column(GUID, primary_key=True)
+    OBJECTID = Column(Integer)
+    SamplePointID = Column(String(10))
+    Analyte = Column(String(50))
+    Symbol = Column(String(50))
+    SampleValue = Column(Float)
+    Units = Column(String(50))
+    Uncertainty = Column(Float)
+    AnalysisMethod = Column(String(255))
+    AnalysisDate = Column(DateTime)
+    Notes = Column(String(255))
+    AnalysesAgency = Column(String(50))
+
+    @declared_attr
+    def SamplePtID(cls):
+        return Column(GUID, ForeignKey("ChemistrySampleInfo.SamplePtID"))
+
+
+class MajorChemistry(Base, ChemistryMixin):
+    __tablename__ = "MajorChemistry"
+
+
+class MinorandTraceChemistry(Base, ChemistryMixin):
+    __tablename__ = "MinorandTraceChemistry"
+
+
 # ============= EOF =============================================
@@ -56,30 +56,21 @@ def water_levels_xml2(manual, pressure):
             "CONDDL (mS/cm)",
         ]
 
-        manual_dates = [r[1] for r in manual]
-        records = []
-        for r in pressure:
-            dm = r[columns.index("DateMeasured")]
-            tag = "pressure"
-            if dm.date() in manual_dates:
-                ri = next((ri for ri in manual if ri[1] == dm.date()))
-                if ri[2] < r[columns.index("DepthToWaterBGS")]:
-                    r = ri
-                    tag = "manual"
-                manual.remove(ri)
-
-            records.append((tag, r))
-
-        for mi in manual:
-            records.append(("manual", mi))
-
-        for k, record in sorted(
-            records, key=lambda r: r[1][4].date() if r[0] == "pressure" else r[1][1]
-        ):
-            if k == "pressure":
-                make_continuous_water_level(root, record)
+        from hydrograph import merge_order
+
+        di = columns.index("DateMeasured")
+        wi = columns.index("DepthToWaterBGS")
+        is_manual, rows = merge_order(
+            [r[1] for r in manual],
+            [r[2] for r in manual],
+            [r[di] for r in pressure],
+            [r[wi] for r in pressure],
+        )
+        for mi, ri in zip(is_manual, rows):
+            if mi:
+                make_water_level(root, manual[ri])
             else:
-                make_water_level(root, record)
+                make_continuous_water_level(root, pressure[ri])
         return etree.tostring(root)
 
 
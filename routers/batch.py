@@ -0,0 +1,229 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+POST /batch: run several GET sub-requests against the existing routes in one
+request.
+
+Sub-requests are dispatched in-process through the app's router. They run
+concurrently, but every route that takes a database session gets the
+batch's session, and only one sub-request holds it at a time. A page's worth
+of small lookups therefore checks out a single pooled connection and makes a
+single round trip.
+
+Sub-requests are not admitted on their own, so only paths outside the bulk
+admission class may be batched, and each sub-response body is capped at
+BATCH_MAX_BODY bytes.
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import os
+from contextlib import AsyncExitStack
+from urllib.parse import unquote
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+from starlette.middleware.exceptions import ExceptionMiddleware
+
+from admission import controller
+from dependencies import INTERACTIVE_TIMEOUT, get_interactive_db
+from schemas.batch import BatchRequest, BatchResponse
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX = int(os.environ.get("BATCH_MAX", 25))
+BATCH_MAX_BODY = int(os.environ.get("BATCH_MAX_BODY", 1 << 20))
+# request headers not passed on to sub-requests
+SKIP_HEADERS = {b"content-length", b"content-type", b"transfer-encoding"}
+TEXT_TYPES = ("text/", "application/xml", "application/geo+json")
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class Batch:
+    """
+    state shared by the sub-requests of one batch (see get_db_timeout)
+    """
+
+    def __init__(self, db, timeout):
+        self.db = db
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+
+
+def sub_scope(request, path, batch):
+    path, _, query = path.partition("?")
+    scope = request.scope
+    return {
+        "type": "http",
+        "asgi": scope.get("asgi", {"version": "3.0"}),
+        "http_version": scope.get("http_version", "1.1"),
+        "method": "GET",
+        "scheme": scope.get("scheme", "http"),
+        "server": scope.get("server"),
+        "client": scope.get("client"),
+        "root_path": scope.get("root_path", ""),
+        "path": unquote(path),
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": [
+            (k, v) for k, v in scope["headers"] if k.lower() not in SKIP_HEADERS
+        ],
+        "app": request.app,
+        "batch": batch,
+    }
+
+
+def decode_body(content_type, body):
+    if not body:
+        return None, None
+    if content_type.startswith("application/json"):
+        return json.loads(body), None
+    if content_type.startswith(TEXT_TYPES):
+        return body.decode(), None
+    return base64.b64encode(body).decode(), "base64"
+
+
+async def dispatch(app, scope):
+    """
+    run one sub-request through the router and collect its response
+    """
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # nothing more to read. wait to be cancelled (see Request.is_disconnected)
+        await asyncio.Event().wait()
+
+    status, headers, chunks = 500, [], []
+    size = 0
+
+    async def send(message):
+        nonlocal status, headers, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > BATCH_MAX_BODY:
+                # stop buffering. the route's response is abandoned
+                raise BodyTooLarge()
+            chunks.append(chunk)
+
+    # yield dependencies, including the shared session, are released when the
+    # sub-request's exit stack closes. fastapi_astack is where FastAPI < 0.100
+    # (pinned in requirements.txt) looks for that stack
+    async with AsyncExitStack() as stack:
+        scope["fastapi_astack"] = stack
+        await app(scope, receive, send)
+
+    headers = {k.decode().lower(): v.decode() for k, v in headers}
+    return status, headers, b"".join(chunks)
+
+
+def make_dispatcher(app):
+    # the app's own exception handlers (QueryTimeout -> 504, ...). admission
+    # and the rest of the middleware stack already ran for the batch itself
+    handlers = {
+        k: v for k, v in app.exception_handlers.items() if k not in (500, Exception)
+    }
+    return ExceptionMiddleware(app.router, handlers=handlers)
+
+
+def error(status, detail):
+    return (
+        status,
+        {"content-type": "application/json"},
+        json.dumps({"detail": detail}).encode(),
+    )
+
+
+async def run_one(dispatcher, request, sub, batch):
+    # classified as routed, after percent-decoding (see sub_scope)
+    path = unquote(sub.path.partition("?")[0])
+    rc = controller.classify(path)
+    if path.rstrip("/") == "/batch":
+        status, headers, body = error(400, "batches cannot be nested")
+    elif rc is not None and rc.name != "interactive":
+        status, headers, body = error(400, f"{rc.name} routes cannot be batched")
+    else:
+        try:
+            status, headers, body = await dispatch(
+                dispatcher, sub_scope(request, sub.path, batch)
+            )
+        except BodyTooLarge:
+            status, headers, body = error(
+                413, f"response larger than {BATCH_MAX_BODY} bytes"
+            )
+        except Exception:
+            logger.exception("batch sub-request %s failed", sub.path)
+            status, headers, body = (
+                500,
+                {"content-type": "text/plain"},
+                b"Internal Server Error",
+            )
+
+    content_type = headers.get("content-type", "")
+    body, encoding = decode_body(content_type, body)
+    return {
+        "id": sub.id,
+        "status": status,
+        "headers": {"content-type": content_type} if content_type else {},
+        "body": body,
+        "encoding": encoding,
+    }
+
+
+@router.post("/batch", response_model=BatchResponse)
+async def batch(
+    payload: BatchRequest,
+    request: Request,
+    db: Session = Depends(get_interactive_db),
+):
+    """
+    run up to BATCH_MAX GET sub-requests, e.g.
+
+        {"requests": [{"id": "well", "path": "/well?pointid=NM-1"},
+                      {"id": "location", "path": "/locations/pointid/NM-1"}]}
+
+    responses come back in request order, each with its own status
+    """
+    if len(payload.requests) > BATCH_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"a batch may contain at most {BATCH_MAX} requests",
+        )
+
+    shared = Batch(db, db.info.get("statement_timeout", INTERACTIVE_TIMEOUT))
+    dispatcher = make_dispatcher(request.app)
+    responses = await asyncio.gather(
+        *(run_one(dispatcher, request, sub, shared) for sub in payload.requests)
+    )
+    return JSONResponse({"responses": responses})
+
+
+# ============= EOF =============================================
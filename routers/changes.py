@@ -0,0 +1,145 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Incremental change feeds.
+
+    GET /changes                          available feeds and their watermarks
+    GET /changes/{feed}?since=<token>     rows changed after token, as NDJSON
+
+Rows are returned oldest change first, keyset-paginated on the table's
+watermark columns (Updated, falling back to Created, then OBJECTID) with the
+primary key as a tie breaker. Each line is {"key": {...}, "row": {...}}. A {"checkpoint": token}
+line follows every batch, and the last line is
+{"next": token, "count": n, "more": bool}. A mirror stores the last token it
+saw and resumes from it, even after an interrupted download.
+
+Tables with only OBJECTID report new rows but not edits. Rows with no
+watermark at all come first, so only a reader starting without a token sees
+them. Deletes are not reported.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import Union
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from starlette.responses import StreamingResponse
+
+from crud import CHANGE_FEEDS, change_feed_order, change_feed_query, watermark_columns
+from dependencies import get_primary_bulk_db
+
+router = APIRouter(prefix="/changes", tags=["changes"])
+
+CHUNK_SIZE = 1000
+MAX_LIMIT = 100000
+
+
+def encode(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return obj.isoformat() if hasattr(obj, "isoformat") else str(obj)
+
+
+def make_token(feed, position):
+    payload = json.dumps({"feed": feed, "after": position}, default=encode)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def read_token(feed, token, order):
+    """
+    keyset position from a token. 400 if it is malformed or for another feed
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        after = payload["after"]
+        if payload["feed"] != feed or len(after) != len(order):
+            raise ValueError
+        return [
+            datetime.fromisoformat(v) if c.name == "Updated" and v else v
+            for c, v in zip(order, after)
+        ]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail=f"invalid token for {feed}")
+
+
+def stream_changes(feed, table, result, order, after, limit):
+    keys = [c.name for c in table.__table__.primary_key.columns]
+    columns = [c.name for c in table.__table__.c]
+    count = 0
+    position = after
+    for rows in result.partitions(CHUNK_SIZE):
+        lines = []
+        for row in rows:
+            m = row._mapping
+            lines.append(
+                json.dumps(
+                    {
+                        "key": {k: m[k] for k in keys},
+                        "row": {c: m[c] for c in columns},
+                    },
+                    default=encode,
+                )
+            )
+            position = [m[c.name] for c in order]
+        count += len(rows)
+        token = make_token(feed, position)
+        lines.append(json.dumps({"checkpoint": token}))
+        yield "\n".join(lines) + "\n"
+
+    token = make_token(feed, position) if position else None
+    yield json.dumps({"next": token, "count": count, "more": count == limit}) + "\n"
+
+
+@router.get("")
+def read_feeds(db: Session = Depends(get_primary_bulk_db)):
+    return {
+        feed: {"watermark": [name for name, _ in watermark_columns(table, db)]}
+        for feed, table in CHANGE_FEEDS.items()
+    }
+
+
+@router.get("/{feed}")
+def read_changes(
+    feed: str,
+    since: Union[str, None] = None,
+    limit: int = Query(MAX_LIMIT, ge=1, le=MAX_LIMIT),
+    db: Session = Depends(get_primary_bulk_db),
+):
+    table = CHANGE_FEEDS.get(feed)
+    if table is None:
+        raise HTTPException(status_code=404, detail=f"no change feed {feed}")
+
+    order = change_feed_order(table, db)
+    if order is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"{table.__tablename__} has no Updated or OBJECTID column",
+        )
+    after = read_token(feed, since, order) if since else None
+
+    result = db.execute(change_feed_query(table, order, after, limit))
+    return StreamingResponse(
+        stream_changes(feed, table, result, order, after, limit),
+        media_type="application/x-ndjson",
+    )
+
+
+# ============= EOF =============================================
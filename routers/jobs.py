@@ -0,0 +1,101 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from fastapi import APIRouter, Depends, HTTPException, Path
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+
+from dependencies import get_primary_bulk_db
+from schemas.jobs import ExportSpec, JobStatus
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+# job ids are digests (see jobs.job_id). anything else never reaches a path
+JOB_ID = Path(..., regex="^[0-9a-f]{16}$")
+
+
+def job_status(state, request):
+    status = dict(state)
+    if state["parts"]:
+        status["progress"] = state["done"] / state["parts"]
+    else:
+        status["progress"] = float(state["status"] == "done")
+    if state["status"] == "done":
+        status["result"] = str(request.url_for("read_job_result", job_id=state["id"]))
+    return status
+
+
+@router.post("/export", response_model=JobStatus, status_code=202)
+async def create_export_job(
+    spec: ExportSpec,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_primary_bulk_db),
+):
+    """
+    queue an export, or return the job already running or finished for an
+    identical spec. poll /jobs/{id} for progress and the result
+    """
+    import jobs
+
+    spec = jobs.canonical(spec.dict())
+    job = jobs.job_id(spec)
+    if await run_in_threadpool(jobs.claim, job, spec):
+        await run_in_threadpool(jobs.prune)
+        try:
+            parts = await run_in_threadpool(jobs.list_parts, spec, db)
+        except Exception as e:
+            jobs.fail(job, e)
+            raise
+        url = jobs.bind_url(db.get_bind())
+        state = await run_in_threadpool(jobs.start, job, spec, parts, url)
+    else:
+        state = jobs.read_state(job)
+        if state is None:
+            raise HTTPException(status_code=409, detail=f"Job {job} is starting")
+
+    response.headers["Location"] = str(request.url_for("read_job", job_id=job))
+    return job_status(state, request)
+
+
+@router.get("/{job_id}", response_model=JobStatus)
+def read_job(request: Request, job_id: str = JOB_ID):
+    import jobs
+
+    state = jobs.read_state(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    return job_status(state, request)
+
+
+@router.get("/{job_id}/result")
+def read_job_result(job_id: str = JOB_ID):
+    import jobs
+
+    state = jobs.read_state(job_id)
+    if state is None or state["status"] != "done":
+        raise HTTPException(status_code=404, detail=f"No result for job {job_id}")
+
+    kind = state["spec"]["kind"]
+    return FileResponse(
+        jobs.result_path(job_id),
+        media_type="application/zip",
+        filename=f"export-{kind}-{job_id}.zip",
+    )
+
+
+# ============= EOF =============================================
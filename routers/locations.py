@@ -13,61 +13,209 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import asyncio
+import base64
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Union
 from uuid import UUID
 
-import plotly
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
 from fastapi.encoders import jsonable_encoder
 from fastapi_pagination import LimitOffsetPage, Page
 from fastapi_pagination.ext.sqlalchemy import paginate
+from requests import RequestException
 
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
-from starlette.responses import Response, JSONResponse, HTMLResponse
+from starlette.responses import (
+    HTMLResponse,
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.status import HTTP_200_OK
-from starlette.templating import Jinja2Templates
 
 import models
 import schemas
 from crud import (
+    POD_TIMEOUT,
     public_release_filter,
-    _read_pods,
-    read_waterlevels_manual_query,
-    read_waterlevels_pressure_query,
+    read_ose_pods,
+    read_wells,
+    read_waterlevels_manual,
+    read_waterlevels_pressure,
 )
-from dependencies import get_db
-import plotly.graph_objects as go
+from cache import cache
+from database import MAX_OVERFLOW, POOL_SIZE, new_session
+from dependencies import get_interactive_db
+from singleflight import SingleFlight
+from templating import get_templates
 
 router = APIRouter(prefix="/locations", tags=["locations"])
 
+# identical concurrent view/thumbnail requests share one build
+flight = SingleFlight("locations")
+
+# fan-out pool for the independent reads and the POD lookup behind a view page
+view_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("VIEW_WORKERS", 16)), thread_name_prefix="view"
+)
+# extra sessions all view builds together may hold on top of their own, so
+# the fan-out can never take more than a share of the connection pool
+view_fanout = threading.BoundedSemaphore(
+    int(os.environ.get("VIEW_FANOUT", max(1, (POOL_SIZE + MAX_OVERFLOW) // 4)))
+)
+
 
 @router.get("/geojson", response_model=list[schemas.LocationGeoJSON])
-def read_locations_geojson(db: Session = Depends(get_db)):
-    q = db.query(models.Location)
-    q = public_release_filter(q)
-    locations = q.all()
+def read_locations_geojson(db: Session = Depends(get_interactive_db)):
+    from location_index import get_index
+
+    return Response(get_index(db).geojson(), media_type="application/json")
+
+
+@router.get("/bbox", response_model=list[schemas.LocationGeoJSON])
+def read_locations_bbox(
+    minx: float,
+    miny: float,
+    maxx: float,
+    maxy: float,
+    db: Session = Depends(get_interactive_db),
+):
+    from location_index import get_index
+
+    index = get_index(db)
+    return index.features(index.bbox(minx, miny, maxx, maxy))
+
+
+@router.get("/nearest", response_model=list[schemas.LocationGeoJSON])
+def read_locations_nearest(
+    lon: float,
+    lat: float,
+    n: int = Query(10, ge=1, le=500),
+    db: Session = Depends(get_interactive_db),
+):
+    from location_index import get_index
+
+    index = get_index(db)
+    idx, distance = index.nearest(lon, lat, n)
+    return index.features(idx, extra={"distance_km": distance.round(3).tolist()})
 
-    def togeojson(l):
-        return {
-            "type": "Feature",
-            "properties": {"name": l.PointID},
-            "geometry": l.geometry,
-        }
 
-    # content = {
-    #     "type": "FeatureCollection",
-    #     "features": [togeojson(l) for l in locations],
-    # }
+@router.get("/search", response_model=list[schemas.LocationGeoJSON])
+def read_locations_search(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(50, ge=1, le=1000),
+    db: Session = Depends(get_interactive_db),
+):
+    from location_index import get_index
+
+    index = get_index(db)
+    return index.features(index.search(q, limit))
+
+
+@router.post("/within")
+def read_locations_within(
+    geojson: Union[schemas.PolygonFeature, schemas.PolygonGeometry] = Body(
+        ..., description="GeoJSON Polygon/MultiPolygon or Feature"
+    ),
+    stats: bool = False,
+    db: Session = Depends(get_interactive_db),
+):
+    """
+    public locations inside a polygon (basin, county, a drawn shape), as a
+    FeatureCollection. with stats=true, water level statistics over the
+    wells inside are added from the precomputed well summaries
+    """
+    import shapely
+    from shapely.errors import GEOSException
+    from shapely.geometry import shape
+
+    from location_index import get_index
+
+    if isinstance(geojson, schemas.PolygonFeature):
+        geojson = geojson.geometry
+    try:
+        polygon = shape(geojson.dict())
+    except (GEOSException, ValueError, TypeError, KeyError, IndexError):
+        raise HTTPException(status_code=400, detail="invalid polygon coordinates")
+    if not polygon.is_valid:
+        polygon = shapely.make_valid(polygon)
+
+    index = get_index(db)
+    idx = index.within(polygon)
+    content = {"type": "FeatureCollection", "features": index.features(idx)}
+    if stats:
+        from summary import aggregate, read_summaries
+
+        pointids = {p.decode().upper() for p in index.pointid[idx]}
+        rows = [r for r in read_summaries() if (r["PointID"] or "").upper() in pointids]
+        content["stats"] = {"n_locations": len(idx), **aggregate(rows)}
+
+    return JSONResponse(content, media_type="application/geo+json")
+
+
+# geoconnex harvesting. pre-rendered by the location index refresher, so a
+# full crawl reads files instead of querying once per site
+def index_etag(request, index):
+    etag = f'"{os.path.basename(index.path)}"'
+    return etag, request.headers.get("if-none-match") == etag
+
+
+@router.get("/jsonld")
+def read_locations_jsonld(request: Request, db: Session = Depends(get_interactive_db)):
+    """
+    every public location's JSON-LD document, one per line
+    """
+    from location_index import get_index
+
+    index = get_index(db)
+    etag, match = index_etag(request, index)
+    if match:
+        return Response(status_code=304, headers={"ETag": etag})
+    return StreamingResponse(
+        index.jsonld(str(request.base_url)),
+        media_type="application/x-ndjson",
+        headers={"ETag": etag},
+    )
+
+
+@router.get("/sitemap.xml")
+def read_locations_sitemap_index(
+    request: Request, db: Session = Depends(get_interactive_db)
+):
+    from location_index import get_index
+
+    index = get_index(db)
+    return Response(
+        index.sitemap_index(str(request.base_url)), media_type="application/xml"
+    )
+
 
-    # content = jsonable_encoder(content)
-    # return JSONResponse(content=content)
-    return [togeojson(l) for l in locations]
+@router.get("/sitemap/{page}.xml")
+def read_locations_sitemap(
+    request: Request, page: int, db: Session = Depends(get_interactive_db)
+):
+    from location_index import get_index
+
+    index = get_index(db)
+    etag, match = index_etag(request, index)
+    if match:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    content = index.sitemap(page, str(request.base_url))
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"no sitemap page {page}")
+    return Response(content, media_type="application/xml", headers={"ETag": etag})
 
 
 @router.get("", response_model=Page[schemas.Location])
 @router.get("/limit-offset", response_model=LimitOffsetPage[schemas.Location])
-def read_locations(pointid: str = None, db: Session = Depends(get_db)):
+def read_locations(pointid: str = None, db: Session = Depends(get_interactive_db)):
     q = db.query(models.Location)
     if pointid:
         q = q.filter(models.Location.PointID.like(f"%{pointid}%"))
@@ -78,7 +226,7 @@ def read_locations(pointid: str = None, db: Session = Depends(get_db)):
 
 
 @router.get("/{location_id}", response_model=schemas.Location)
-def read_location(location_id: UUID, db: Session = Depends(get_db)):
+def read_location(location_id: UUID, db: Session = Depends(get_interactive_db)):
     return (
         db.query(models.Location)
         .filter(models.Location.LocationId == location_id)
@@ -87,7 +235,7 @@ def read_location(location_id: UUID, db: Session = Depends(get_db)):
 
 
 @router.get("/pointid/{pointid}", response_model=schemas.Location)
-def read_location_pointid(pointid: str, db: Session = Depends(get_db)):
+def read_location_pointid(pointid: str, db: Session = Depends(get_interactive_db)):
     q = db.query(models.Location)
     q = q.filter(models.Location.PointID == pointid)
     q = public_release_filter(q)
@@ -100,7 +248,7 @@ def read_location_pointid(pointid: str, db: Session = Depends(get_db)):
 
 @router.get("/pointid/{pointid}/jsonld", response_model=schemas.LocationJSONLD)
 def read_location_pointid_jsonld(
-    request: Request, pointid: str, db: Session = Depends(get_db)
+    request: Request, pointid: str, db: Session = Depends(get_interactive_db)
 ):
     loc = get_location(pointid, db)
     if loc is None:
@@ -113,7 +261,9 @@ def read_location_pointid_jsonld(
 
 
 @router.get("/pointid/{pointid}/geojson", response_model=schemas.LocationGeoJSON)
-def read_location_pointid_jsonld(pointid: str, db: Session = Depends(get_db)):
+def read_location_pointid_jsonld(
+    pointid: str, db: Session = Depends(get_interactive_db)
+):
     loc = get_location(pointid, db)
     if loc is None:
         loc = Response(status_code=HTTP_200_OK)
@@ -121,62 +271,196 @@ def read_location_pointid_jsonld(pointid: str, db: Session = Depends(get_db)):
     return loc
 
 
-# Views ==========================================================
-from pathlib import Path
+@router.get("/{pointid}/hydrograph.{fmt}")
+async def read_location_hydrograph(
+    pointid: str,
+    fmt: str,
+    w: int = Query(200, ge=16, le=1600),
+    h: int = Query(60, ge=16, le=1200),
+    db: Session = Depends(get_interactive_db),
+):
+    """
+    sparkline of a well's combined hydrograph as png or svg. w and h are
+    rounded up to one of the rendered sizes
+    """
+    import thumbnails
+
+    if fmt not in thumbnails.FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unsupported format {fmt}")
+
+    watermark = await run_in_threadpool(thumbnails.read_watermark, pointid, db)
+    if watermark is None:
+        raise HTTPException(status_code=404, detail=f"No well {pointid}")
+
+    w, h = thumbnails.snap(w), thumbnails.snap(h)
+    path = thumbnails.thumbnail_path(pointid, watermark, fmt, w, h)
+    blob = await run_in_threadpool(thumbnails.load, path)
+    if blob is None:
+        blob = await flight.do_async(path, make_thumbnail, pointid, fmt, w, h, path, db)
+
+    return Response(
+        blob,
+        media_type=thumbnails.FORMATS[fmt],
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
+
+
+async def make_thumbnail(pointid, fmt, w, h, path, db):
+    import thumbnails
+
+    def read():
+        with new_session(db) as sess:
+            return thumbnails.read_series(pointid, w, sess)
+
+    t, y = await run_in_threadpool(read)
+    loop = asyncio.get_running_loop()
+    blob = await loop.run_in_executor(
+        thumbnails.get_pool(), thumbnails.render, t, y, fmt, w, h
+    )
+    await run_in_threadpool(thumbnails.store, path, blob)
+    return blob
+
 
-BASE_DIR = Path(__file__).resolve().parent.parent
-templates = Jinja2Templates(directory=str(Path(BASE_DIR, "templates")))
-# templates = Jinja2Templates(directory="templates")
+# Views ==========================================================
 
 
 @router.get("/view/{pointid}", response_class=HTMLResponse)
-def location_view(request: Request, pointid: str, db: Session = Depends(get_db)):
-    q = db.query(models.Location)
-    q = q.filter(models.Location.PointID == pointid)
-    q = public_release_filter(q)
-    loc = q.first()
-    loc = schemas.Location.from_orm(loc)
+def location_view(
+    request: Request, pointid: str, db: Session = Depends(get_interactive_db)
+):
+    def build():
+        # the build is shared by every waiting request, so it runs on a
+        # session of its own that the leader's disconnect can't cancel
+        with new_session(db) as session:
+            return build_location_view(pointid, session)
+
+    context = flight.do(("view", pointid), build)
+    return get_templates().TemplateResponse(
+        "location_view.html", {"request": request, **context}
+    )
+
+
+def fan_out(func, pointid, db):
+    """
+    run func(pointid, session) on view_pool with a session of its own while
+    a view_fanout slot is free. otherwise run it later on `db`; returns a
+    callable giving the result
+    """
+    if not view_fanout.acquire(blocking=False):
+        return lambda: func(pointid, db)
+
+    def fetch():
+        try:
+            with new_session(db) as sess:
+                return func(pointid, sess)
+        finally:
+            view_fanout.release()
 
-    wells = _read_pods(pointid, db)
+    return view_pool.submit(fetch).result
+
+
+def build_location_view(pointid, db):
+    """
+    gather everything the view template needs as plain data so it can be
+    shared between requests after the session is closed.
+
+    the location, wells and hydrograph reads are independent. the location
+    and hydrograph run concurrently on sessions of their own, bounded by
+    view_fanout, while the wells are read on `db`. the POD lookup gets
+    POD_TIMEOUT seconds; past that the page renders without PODs
+    """
+    location = fan_out(get_location_dict, pointid, db)
+    graph = fan_out(read_location_graph, pointid, db)
+    wells = read_wells(pointid, db)
 
     well = None
     pods = []
+    pods_unavailable = False
     if wells:
         well = wells[0]
-        pods = well.pods
-
-    fig = go.Figure()
-    manual_waterlevels = read_waterlevels_manual_query(pointid, db).all()
-    mxs = [w.DateMeasured for w in manual_waterlevels]
-    mys = [w.DepthToWaterBGS for w in manual_waterlevels]
-
-    fig.add_trace(go.Scatter(x=mxs, y=mys, mode="markers", name="Manual Water Levels"))
-
-    pressure_waterlevels = read_waterlevels_pressure_query(
-        pointid, db, as_dict=True
-    ).all()
-    pxs = [w.DateMeasured for w in pressure_waterlevels]
-    pys = [w.DepthToWaterBGS for w in pressure_waterlevels]
-    fig.add_trace(
-        go.Scatter(x=pxs, y=pys, mode="lines", name="Continuous Water Levels")
-    )
-
-    fig.update_layout(
-        xaxis={"title": "Date Measured"},
-        yaxis={"title": "Depth to Water BGS (ft)", "autorange": "reversed"},
-    )
-    graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-
-    return templates.TemplateResponse(
-        "location_view.html",
-        {
-            "request": request,
-            "location": loc.dict() if loc else {},
-            "well": well,
-            "pods": pods,
-            "graphJSON": graphJSON,
+        if well.OSEWellID:
+            future = view_pool.submit(read_ose_pods, well.OSEWellID)
+            try:
+                pods = future.result(timeout=POD_TIMEOUT) or []
+            except (TimeoutError, RequestException):
+                # a late response still lands in the cache for the next view
+                pods_unavailable = True
+
+        well = dict(
+            well.dict(exclude={"formation_meaning"}),
+            formation=well.formation_meaning,
+        )
+
+    return {
+        "location": location(),
+        "well": well,
+        "pods": pods,
+        "pods_unavailable": pods_unavailable,
+        "graphJSON": graph(),
+    }
+
+
+def typed_array(values, dtype):
+    """
+    Plotly.js typed array spec: raw little-endian bytes, base64 encoded.
+    plotly.js >= 2.28 decodes these directly
+    """
+    import numpy as np
+
+    a = np.ascontiguousarray(values, dtype=f"<{dtype}")
+    return {"dtype": dtype, "bdata": base64.b64encode(a.tobytes()).decode()}
+
+
+def trace_arrays(records):
+    """
+    (epoch ms, depth) arrays for a series, vectorized. plotly.js has no int64
+    typed arrays, so times go out as float64 ms on a date axis
+    """
+    import numpy as np
+
+    records = [r for r in records if r.DateMeasured is not None]
+    xs = np.array([r.DateMeasured for r in records], dtype="datetime64[ms]")
+    ys = np.array([r.DepthToWaterBGS for r in records], dtype=float)
+    return typed_array(xs.astype("int64"), "f8"), typed_array(ys, "f4")
+
+
+@cache.cached(
+    ttl=600,
+    tags=lambda pointid: [
+        f"pointid:{pointid}",
+        "table:WaterLevels",
+        "table:WaterLevelsContinuous_Pressure",
+    ],
+)
+def read_location_graph(pointid, db):
+    mx, my = trace_arrays(read_waterlevels_manual(pointid, db))
+    px, py = trace_arrays(read_waterlevels_pressure(pointid, db))
+    fig = {
+        "data": [
+            {
+                "type": "scatter",
+                "x": mx,
+                "y": my,
+                "mode": "markers",
+                "name": "Manual Water Levels",
+            },
+            {
+                "type": "scatter",
+                "x": px,
+                "y": py,
+                "mode": "lines",
+                "name": "Continuous Water Levels",
+            },
+        ],
+        "layout": {
+            "xaxis": {"title": {"text": "Date Measured"}, "type": "date"},
+            "yaxis": {
+                "title": {"text": "Depth to Water BGS (ft)"},
+                "autorange": "reversed",
+            },
         },
-    )
+    }
+    return json.dumps(fig)
 
 
 # End Views ======================================================
@@ -189,4 +473,9 @@ def get_location(pointid, db):
     return q.first()
 
 
+def get_location_dict(pointid, db):
+    loc = get_location(pointid, db)
+    return schemas.Location.from_orm(loc).dict() if loc else {}
+
+
 # ============= EOF =============================================
@@ -16,30 +16,46 @@
 from typing import List
 
 from fastapi import APIRouter, Depends
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import Response
 
-from dependencies import get_db
+from database import new_session
+from dependencies import get_primary_bulk_db
 from ngwmn import make_waterlevels, make_wellconstruction, make_lithology
+from singleflight import SingleFlight
 
 router = APIRouter(prefix="/ngwmn", tags=["ngwmn"])
 
+flight = SingleFlight("ngwmn")
 
-@router.get("/waterlevels/{pointid}")
-async def read_ngwmn_waterlevels(pointid: str, db=Depends(get_db)):
-    data = make_waterlevels(pointid, db)
+
+async def make_document(func, pointid, db):
+    """
+    build an NGWMN document off the event loop. identical concurrent requests
+    share one build, run on its own session so it outlives any one client
+    """
+
+    def build():
+        with new_session(db) as sess:
+            return func(pointid, sess)
+
+    data = await flight.do_async((func.__name__, pointid), run_in_threadpool, build)
     return Response(content=data, media_type="application/xml")
 
 
+@router.get("/waterlevels/{pointid}")
+async def read_ngwmn_waterlevels(pointid: str, db=Depends(get_primary_bulk_db)):
+    return await make_document(make_waterlevels, pointid, db)
+
+
 @router.get("/wellconstruction/{pointid}")
-async def read_ngwmn_wellconstruction(pointid: str, db=Depends(get_db)):
-    data = make_wellconstruction(pointid, db)
-    return Response(content=data, media_type="application/xml")
+async def read_ngwmn_wellconstruction(pointid: str, db=Depends(get_primary_bulk_db)):
+    return await make_document(make_wellconstruction, pointid, db)
 
 
 @router.get("/lithology/{pointid}")
-async def read_ngwmn_lithology(pointid: str, db=Depends(get_db)):
-    data = make_lithology(pointid, db)
-    return Response(content=data, media_type="application/xml")
+async def read_ngwmn_lithology(pointid: str, db=Depends(get_primary_bulk_db)):
+    return await make_document(make_lithology, pointid, db)
 
 
 # ============= EOF =============================================
@@ -13,18 +13,110 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import csv
+import io
+import json
+from datetime import date
 from typing import List
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from starlette.responses import StreamingResponse
 
+from crud import (
+    as_pointids,
+    read_chemistry_analytes,
+    read_chemistry_long,
+    read_chemistry_wide,
+)
+from database import new_session
+from dependencies import get_primary_bulk_db
 from schemas import waterchemistry
 
 router = APIRouter(prefix="/waterchem", tags=["waterchem"])
 
+CHUNK_SIZE = 1000
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+def encode(obj):
+    return obj.isoformat() if hasattr(obj, "isoformat") else str(obj)
+
+
+def stream_rows(result, fmt):
+    """
+    serialize a result CHUNK_SIZE rows at a time, so a large pull is never
+    held in memory as a whole
+    """
+    keys = list(result.keys())
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(keys)
+        for rows in result.partitions(CHUNK_SIZE):
+            writer.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    else:
+        sep = "\n" if fmt == "ndjson" else ","
+        first = True
+        if fmt == "json":
+            yield "["
+        for rows in result.partitions(CHUNK_SIZE):
+            chunk = sep.join(
+                json.dumps(dict(zip(keys, row)), default=encode) for row in rows
+            )
+            yield chunk if first else sep + chunk
+            first = False
+        yield "\n" if fmt == "ndjson" else "]"
+
+
+@router.get("/analytes")
+def read_analytes(
+    pointid: List[str] = Query(None),
+    analyte: List[str] = Query(None),
+    layout: str = Query("long", regex="^(long|wide)$"),
+    format: str = Query("csv", regex="^(csv|ndjson|json)$"),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_primary_bulk_db),
+):
+    """
+    chemistry results for any number of sites and analytes in one request.
+
+    layout=long gives one row per result; layout=wide gives one row per
+    sample with a column per analyte (all analytes at the sites if none are
+    given). streamed as csv, ndjson or a json array
+    """
+    if not pointid and not analyte:
+        raise HTTPException(status_code=400, detail="pointid or analyte required")
+
+    if layout == "wide":
+        analytes = as_pointids(analyte) or read_chemistry_analytes(db, pointid)
+        q = read_chemistry_wide(analytes, pointid, start, end)
+    else:
+        q = read_chemistry_long(pointid, analyte, start, end)
+
+    def stream():
+        # the request's session may be closed before the body is sent
+        with new_session(db) as session:
+            result = session.execute(q, execution_options={"stream_results": True})
+            yield from stream_rows(result, format)
+
+    return StreamingResponse(stream(), media_type=MEDIA_TYPES[format])
+
 
 @router.get("/{pointid}/{analyte}", response_model=List[waterchemistry.Analyte])
-async def read_analyte(pointid: str, analyte: str):
-    pass
+def read_analyte(
+    pointid: str, analyte: str, db: Session = Depends(get_primary_bulk_db)
+):
+    return db.execute(read_chemistry_long(pointid, analyte)).all()
 
 
 # ============= EOF =============================================
@@ -13,33 +13,142 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from fastapi import Depends, APIRouter
+import hashlib
+import os
+from datetime import date, timedelta
+from typing import Dict, List
+
+from fastapi import Depends, APIRouter, HTTPException, Path, Query, Request
 from fastapi_pagination import Page, LimitOffsetPage
 from fastapi_pagination.ext.sqlalchemy import paginate
 from sqlalchemy.orm import Session
+from starlette.responses import Response
 
 import models
+from cache import cache
 from schemas import waterlevels
 from crud import (
+    as_pointids,
+    pointid_tags,
+    read_public_wells,
     read_waterlevels_manual_query,
     read_waterlevels_acoustic_query,
     read_waterlevels_pressure_query,
+    read_waterlevels_by_site,
 )
-from dependencies import get_db
+from dependencies import get_bulk_db
 
 router = APIRouter(prefix="/waterlevels", tags=["waterlevels"])
 
+FORMATS = "^(json|csv|arrow)$"
+
+# a year is complete (and its resource cacheable for YEAR_MAX_AGE_CLOSED)
+# once YEAR_CLOSED_AFTER days have passed since it ended. transducer data
+# is downloaded in the field, so the last months of a year arrive late
+YEAR_CLOSED_AFTER = int(os.environ.get("WATERLEVELS_YEAR_CLOSED_AFTER", 90))
+YEAR_MAX_AGE_CLOSED = int(os.environ.get("WATERLEVELS_YEAR_MAX_AGE", 365 * 86400))
+YEAR_MAX_AGE_OPEN = int(os.environ.get("WATERLEVELS_YEAR_MAX_AGE_OPEN", 300))
+
+# /sites responses are unpaginated, so bound how many sites and readings one
+# request can pull. narrow the window or use the paginated listing beyond it
+SITES_MAX_POINTIDS = int(os.environ.get("WATERLEVELS_SITES_MAX_POINTIDS", 50))
+SITES_MAX_ROWS = int(os.environ.get("WATERLEVELS_SITES_MAX_ROWS", 50000))
+
+
+def frame_body(df, fmt):
+    """
+    serialize a DataFrame as json (records), csv or an Arrow IPC stream.
+    returns (body, media type)
+    """
+    if fmt == "csv":
+        return df.to_csv(index=False).encode(), "text/csv"
+    elif fmt == "arrow":
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise HTTPException(status_code=406, detail="arrow output needs pyarrow")
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), "application/vnd.apache.arrow.stream"
+
+    return df.to_json(orient="records", date_format="iso").encode(), "application/json"
+
+
+def read_sites(table, pointid, start, end, db):
+    """
+    readings grouped by PointID, within the SITES_MAX_POINTIDS and
+    SITES_MAX_ROWS caps
+    """
+    pointids = as_pointids(pointid)
+    if len(pointids) > SITES_MAX_POINTIDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"at most {SITES_MAX_POINTIDS} pointids per request",
+        )
+
+    groups = read_waterlevels_by_site(
+        table, pointids, db, start, end, limit=SITES_MAX_ROWS + 1
+    )
+    if sum(len(g) for g in groups.values()) > SITES_MAX_ROWS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"more than {SITES_MAX_ROWS} readings. narrow the start/end window",
+        )
+    return groups
+
+
+def frame_response(df, fmt, name):
+    body, media_type = frame_body(df, fmt)
+    headers = {}
+    if fmt == "csv":
+        headers["Content-Disposition"] = f'attachment; filename="{name}.csv"'
+    return Response(body, media_type=media_type, headers=headers)
+
 
 # ============= EOF =============================================
+@router.get("/combined", response_model=List[waterlevels.CombinedWaterLevel])
+def read_waterlevels_combined(
+    pointid: str,
+    format: str = Query("json", regex=FORMATS),
+    db: Session = Depends(get_bulk_db),
+):
+    """
+    manual, pressure and acoustic readings merged into one hydrograph, using
+    the same manual vs continuous precedence as the NGWMN WaterLevels document
+    """
+    from hydrograph import read_combined_waterlevels
+
+    df = read_combined_waterlevels(pointid, db)
+    return frame_response(df, format, f"{pointid}_waterlevels")
+
+
 @router.get("/manual", response_model=Page[waterlevels.WaterLevels])
 @router.get(
     "/manual/limit-offset", response_model=LimitOffsetPage[waterlevels.WaterLevels]
 )
-def read_waterlevels_manual(pointid: str = None, db: Session = Depends(get_db)):
-    q = read_waterlevels_manual_query(pointid, db)
+def read_waterlevels_manual(
+    pointid: List[str] = Query(None),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_bulk_db),
+):
+    q = read_waterlevels_manual_query(pointid, db, start=start, end=end)
     return paginate(q)
 
 
+@router.get("/manual/sites", response_model=Dict[str, List[waterlevels.WaterLevels]])
+def read_waterlevels_manual_sites(
+    pointid: List[str] = Query(...),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_bulk_db),
+):
+    return read_sites(models.WaterLevels, pointid, start, end, db)
+
+
 @router.get(
     "/pressure", response_model=Page[waterlevels.WaterLevelsContinuous_Pressure]
 )
@@ -47,11 +156,114 @@ def read_waterlevels_manual(pointid: str = None, db: Session = Depends(get_db)):
     "/pressure/limit-offset",
     response_model=LimitOffsetPage[waterlevels.WaterLevelsContinuous_Pressure],
 )
-def read_waterlevels_pressure(pointid: str = None, db: Session = Depends(get_db)):
-    q = read_waterlevels_pressure_query(pointid, db)
+def read_waterlevels_pressure(
+    pointid: List[str] = Query(None),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_bulk_db),
+):
+    q = read_waterlevels_pressure_query(pointid, db, start=start, end=end)
     return paginate(q)
 
 
+@router.get(
+    "/pressure/sites",
+    response_model=Dict[str, List[waterlevels.WaterLevelsContinuous_Pressure]],
+)
+def read_waterlevels_pressure_sites(
+    pointid: List[str] = Query(...),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_bulk_db),
+):
+    return read_sites(models.WaterLevelsContinuous_Pressure, pointid, start, end, db)
+
+
+def year_is_closed(year):
+    return date.today() - date(year, 12, 31) > timedelta(days=YEAR_CLOSED_AFTER)
+
+
+def render_pressure_year(pointid, year, fmt, db):
+    """
+    one site's pressure readings for one calendar year, serialized.
+    returns (body, media type, etag)
+    """
+    import pandas as pd
+
+    rows = read_waterlevels_pressure_query(
+        pointid, db, as_dict=True, start=date(year, 1, 1), end=date(year, 12, 31)
+    )
+    rows = [r._mapping for r in rows]
+    df = pd.DataFrame(
+        {
+            "measurement_datetime": pd.to_datetime(
+                pd.Series([r["DateMeasured"] for r in rows], dtype=object)
+            ),
+            "depth_to_water_ftbgs": pd.to_numeric(
+                pd.Series([r["DepthToWaterBGS"] for r in rows], dtype=object)
+            ).astype(float),
+        }
+    )
+    body, media_type = frame_body(df, fmt)
+    return body, media_type, f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+# complete years are rendered once and kept; the current year refreshes often
+pressure_tags = pointid_tags("WaterLevelsContinuous_Pressure")
+read_pressure_year_closed = cache.cached(
+    ttl=86400, tags=pressure_tags, name="read_pressure_year_closed"
+)(render_pressure_year)
+read_pressure_year_open = cache.cached(
+    ttl=YEAR_MAX_AGE_OPEN, tags=pressure_tags, name="read_pressure_year_open"
+)(render_pressure_year)
+
+
+def etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+@router.get("/pressure/{pointid}/{year}")
+def read_waterlevels_pressure_year(
+    request: Request,
+    pointid: str,
+    year: int = Path(..., ge=1900),
+    format: str = Query("json", regex=FORMATS),
+    db: Session = Depends(get_bulk_db),
+):
+    """
+    a site's pressure readings for one calendar year as json, csv or arrow.
+
+    the ETag is a hash of the content. complete years are served with a
+    long lived, immutable Cache-Control so browsers and CDNs keep them
+    """
+    if year > date.today().year:
+        raise HTTPException(status_code=404, detail=f"no data for {year} yet")
+    if pointid.upper() not in read_public_wells(db):
+        raise HTTPException(status_code=404, detail=f"unknown pointid {pointid}")
+
+    if year_is_closed(year):
+        reader = read_pressure_year_closed
+        cache_control = f"public, max-age={YEAR_MAX_AGE_CLOSED}, immutable"
+    else:
+        reader = read_pressure_year_open
+        cache_control = f"public, max-age={YEAR_MAX_AGE_OPEN}"
+
+    body, media_type, etag = reader(pointid, year, format, db)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if format == "csv":
+        headers["Content-Disposition"] = (
+            f'attachment; filename="{pointid}_pressure_{year}.csv"'
+        )
+    return Response(body, media_type=media_type, headers=headers)
+
+
 @router.get(
     "/acoustic", response_model=Page[waterlevels.WaterLevelsContinuous_Acoustic]
 )
@@ -59,6 +271,24 @@ def read_waterlevels_pressure(pointid: str = None, db: Session = Depends(get_db)
     "/acoustic/limit-offset",
     response_model=LimitOffsetPage[waterlevels.WaterLevelsContinuous_Acoustic],
 )
-def read_waterlevels_acoustic(pointid: str = None, db: Session = Depends(get_db)):
-    q = read_waterlevels_acoustic_query(pointid, db)
+def read_waterlevels_acoustic(
+    pointid: List[str] = Query(None),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_bulk_db),
+):
+    q = read_waterlevels_acoustic_query(pointid, db, start=start, end=end)
     return paginate(q)
+
+
+@router.get(
+    "/acoustic/sites",
+    response_model=Dict[str, List[waterlevels.WaterLevelsContinuous_Acoustic]],
+)
+def read_waterlevels_acoustic_sites(
+    pointid: List[str] = Query(...),
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_bulk_db),
+):
+    return read_sites(models.WaterLevelsContinuous_Acoustic, pointid, start, end, db)
@@ -13,23 +13,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import asyncio
+import os
 from typing import List
 
-from fastapi import Depends, APIRouter
+from fastapi import Depends, APIRouter, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
-from starlette.responses import Response
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response
 from starlette.status import HTTP_200_OK
 
 import models
 import schemas
-from crud import _read_pods, public_release_filter
-from dependencies import get_db
+from crud import (
+    _read_pods,
+    public_release_filter,
+    read_latest_waterlevels,
+    read_location_list,
+)
+from database import new_session
+from dependencies import BULK_TIMEOUT, get_bulk_db, get_interactive_db
+from schemas.waterlevels import LatestWaterLevel, WellSummary
+from singleflight import SingleFlight
 
 router = APIRouter()
 
+# identical concurrent surface grid/tile requests share one render
+flight = SingleFlight("surface")
+
 
 @router.get("/well", response_model=schemas.Well)
-def read_well(pointid: str = None, db: Session = Depends(get_db)):
+def read_well(pointid: str = None, db: Session = Depends(get_interactive_db)):
     q = db.query(models.Well)
     if pointid:
         q = q.join(models.Location)
@@ -42,11 +57,163 @@ def read_well(pointid: str = None, db: Session = Depends(get_db)):
 
 
 @router.get("/pod", response_model=List[schemas.Well])
-def read_pods(pointid: str = None, db: Session = Depends(get_db)):
+def read_pods(pointid: str = None, db: Session = Depends(get_interactive_db)):
     pods = _read_pods(pointid, db)
     if pods is None:
         pods = Response(status_code=HTTP_200_OK)
     return pods
 
 
+@router.get("/wells/latest", response_model=List[LatestWaterLevel])
+def read_wells_latest(db: Session = Depends(get_bulk_db)):
+    return read_latest_waterlevels(db)
+
+
+@router.get("/wells/latest/geojson")
+def read_wells_latest_geojson(db: Session = Depends(get_bulk_db)):
+    geometries = {(l.PointID or "").upper(): l.geometry for l in read_location_list(db)}
+    features = []
+    for row in read_latest_waterlevels(db):
+        geometry = geometries.get((row["PointID"] or "").upper())
+        if geometry is not None:
+            properties = LatestWaterLevel(**row).dict()
+            features.append(
+                {"type": "Feature", "properties": properties, "geometry": geometry}
+            )
+
+    return JSONResponse(
+        jsonable_encoder({"type": "FeatureCollection", "features": features}),
+        media_type="application/geo+json",
+    )
+
+
+@router.get("/wells/summary", response_model=List[WellSummary])
+def read_wells_summary(db: Session = Depends(get_interactive_db)):
+    from summary import read_summaries, refresh_in_background, refreshed
+
+    rows = read_summaries()
+    if not rows and not refreshed.is_set():
+        # nothing precomputed yet (fresh deployment). build the table in the
+        # background rather than inside this interactive request
+        refresh_in_background(db)
+        raise HTTPException(
+            status_code=503,
+            detail="well summaries are being computed",
+            headers={"Retry-After": "60"},
+        )
+    return rows
+
+
+@router.get("/wells/{pointid}/summary", response_model=WellSummary)
+def read_well_summary(pointid: str, db: Session = Depends(get_interactive_db)):
+    from summary import get_summary
+
+    row = get_summary(pointid, db)
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"No summary for {pointid}")
+    return row
+
+
+async def read_surface_points(name, quantity, db):
+    """
+    (x, y, z) points and their digest for a surface time slice
+    """
+    import surface
+
+    if not surface.SLICE.match(name):
+        raise HTTPException(status_code=404, detail=f"Invalid time slice {name}")
+
+    def read():
+        # a statewide read. give it the bulk statement timeout rather than
+        # the interactive one, on a session of its own
+        with new_session(db) as session:
+            session.info["statement_timeout"] = BULK_TIMEOUT
+            return surface.read_points(session, name, quantity)
+
+    points = await flight.do_async(("points", name, quantity), run_in_threadpool, read)
+    return points, surface.points_digest(*points)
+
+
+async def make_surface_file(path, render, *args):
+    import surface
+
+    loop = asyncio.get_running_loop()
+    blob = await loop.run_in_executor(surface.get_pool(), render, *args)
+    await run_in_threadpool(surface.store, path, blob)
+
+
+@router.get("/wells/surface/{name}.json")
+async def read_wells_surface_grid(
+    name: str,
+    quantity: str = Query("elevation", regex="^(elevation|depth)$"),
+    cell: int = Query(5000, ge=1000, le=50000),
+    db: Session = Depends(get_interactive_db),
+):
+    """
+    coarse IDW water-table grid (UTM zone 13) for a time slice, "latest" or
+    a year
+    """
+    import surface
+
+    (px, py, pz), digest = await read_surface_points(name, quantity, db)
+    path = surface.grid_path(name, quantity, digest, cell)
+    if not os.path.isfile(path):
+        await flight.do_async(
+            path, make_surface_file, path, surface.grid, px, py, pz, cell
+        )
+
+    return FileResponse(
+        path,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=600"},
+    )
+
+
+@router.get("/wells/surface/{name}/{z}/{x}/{y}.png")
+async def read_wells_surface_tile(
+    name: str,
+    z: int,
+    x: int,
+    y: int,
+    quantity: str = Query("elevation", regex="^(elevation|depth)$"),
+    db: Session = Depends(get_interactive_db),
+):
+    """
+    XYZ (web mercator) PNG tile of the IDW water-table surface
+    """
+    import surface
+
+    if not (
+        surface.SURFACE_MIN_ZOOM <= z <= surface.SURFACE_MAX_ZOOM
+        and 0 <= x < 2**z
+        and 0 <= y < 2**z
+    ):
+        raise HTTPException(status_code=404, detail=f"No tile {z}/{x}/{y}")
+
+    (px, py, pz), digest = await read_surface_points(name, quantity, db)
+    headers = {"Cache-Control": "public, max-age=600"}
+    if not surface.tile_has_points(px, py, z, x, y):
+        return Response(surface.blank_tile(), media_type="image/png", headers=headers)
+
+    path = surface.tile_path(name, quantity, digest, z, x, y)
+    if not os.path.isfile(path):
+        vmin, vmax = surface.color_scale(pz)
+        await flight.do_async(
+            path,
+            make_surface_file,
+            path,
+            surface.render_tile,
+            px,
+            py,
+            pz,
+            z,
+            x,
+            y,
+            vmin,
+            vmax,
+        )
+
+    return FileResponse(path, media_type="image/png", headers=headers)
+
+
 # ============= EOF =============================================
@@ -29,7 +29,7 @@ class Measurement(ORMBaseModel):
     MeasurementMethod: Union[str, None] = Field(..., alias="measurement_method")
     MeasuringAgency: Union[str, None] = Field(..., alias="measuring_agency")
     DataSource: Union[str, None] = Field(..., alias="data_source")
-    DataQuality: Union[str, None] = Field(..., alias="data_quality")
+    DataQuality: Union[str, None] = Field(None, alias="data_quality")
 
 
 class Location(ORMBaseModel):
@@ -42,6 +42,20 @@ class Location(ORMBaseModel):
     geometry: Optional[dict] = None
 
 
+class LocationRecord(ORMBaseModel):
+    """
+    the location fields the cached readers hand out. plain data, so it can be
+    shared between sessions and threads
+    """
+
+    LocationId: UUID
+    PointID: Union[str, None]
+    Easting: Union[int, None]
+    Northing: Union[int, None]
+    Altitude: Union[float, None]
+    geometry: Optional[dict] = None
+
+
 class LocationJSONLD(Location):
     context: list = Field(
         [
@@ -75,6 +89,17 @@ class LocationGeoJSON(ORMBaseModel):
     geometry: dict = Field(..., alias="geometry")
 
 
+class PolygonGeometry(BaseModel):
+    type: str = Field(..., regex="^(Polygon|MultiPolygon)$")
+    coordinates: list
+
+
+class PolygonFeature(BaseModel):
+    type: str = Field(..., regex="^Feature$")
+    properties: Optional[dict] = None
+    geometry: PolygonGeometry
+
+
 class Well(ORMBaseModel):
     LocationId: UUID
     WellID: UUID
@@ -98,4 +123,12 @@ class Well(ORMBaseModel):
     pods: Optional[list] = None
 
 
+class WellRecord(Well):
+    """
+    a Well plus its formation meaning, as cached by crud.read_wells
+    """
+
+    formation_meaning: Union[str, None] = None
+
+
 # ============= EOF =============================================
@@ -0,0 +1,55 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from typing import Any, Dict, List, Union
+
+from pydantic import BaseModel, Field, validator
+
+
+class SubRequest(BaseModel):
+    id: Union[str, None] = None
+    method: str = "GET"
+    path: str = Field(..., description="route path and query, e.g. /well?pointid=NM-1")
+
+    @validator("method")
+    def only_get(cls, v):
+        if v.upper() != "GET":
+            raise ValueError("only GET sub-requests are supported")
+        return "GET"
+
+    @validator("path")
+    def absolute_path(cls, v):
+        if not v.startswith("/"):
+            raise ValueError("path must start with /")
+        return v
+
+
+class BatchRequest(BaseModel):
+    requests: List[SubRequest]
+
+
+class SubResponse(BaseModel):
+    id: Union[str, None]
+    status: int
+    headers: Dict[str, str]
+    body: Any
+    encoding: Union[str, None] = None
+
+
+class BatchResponse(BaseModel):
+    responses: List[SubResponse]
+
+
+# ============= EOF =============================================
@@ -0,0 +1,60 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from datetime import date, datetime
+from typing import List, Union
+
+from pydantic import BaseModel, Field, validator
+
+
+class ExportSpec(BaseModel):
+    kind: str = Field(..., regex="^(manual|pressure|acoustic|ngwmn)$")
+    pointids: Union[List[str], None] = Field(
+        None, description="restrict to these wells. default every public well"
+    )
+    start: Union[date, None] = None
+    end: Union[date, None] = None
+    partition: str = Field("well", regex="^(well|year)$")
+    format: str = Field("csv", regex="^(csv|ndjson)$")
+
+    @validator("partition")
+    def ngwmn_by_well(cls, v, values):
+        if values.get("kind") == "ngwmn" and v != "well":
+            raise ValueError("ngwmn exports are partitioned by well")
+        return v
+
+    @validator("end")
+    def ordered(cls, v, values):
+        start = values.get("start")
+        if v and start and v < start:
+            raise ValueError("end is before start")
+        return v
+
+
+class JobStatus(BaseModel):
+    id: str
+    status: str
+    spec: ExportSpec
+    parts: int
+    done: int
+    rows: int
+    progress: float
+    error: Union[str, None] = None
+    created: datetime
+    updated: datetime
+    result: Union[str, None] = Field(None, description="result download url")
+
+
+# ============= EOF =============================================
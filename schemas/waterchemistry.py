@@ -13,11 +13,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from pydantic import BaseModel
+from datetime import datetime
+from typing import Union
+from uuid import UUID
 
+from schemas import ORMBaseModel
 
-class Analyte(BaseModel):
-    pass
+
+class Analyte(ORMBaseModel):
+    PointID: str
+    SamplePointID: Union[str, None]
+    SamplePtID: UUID
+    CollectionDate: Union[datetime, None]
+    Analyte: Union[str, None]
+    Symbol: Union[str, None]
+    SampleValue: Union[float, None]
+    Units: Union[str, None]
+    Uncertainty: Union[float, None]
+    AnalysisMethod: Union[str, None]
+    AnalysisDate: Union[datetime, None]
 
 
 # ============= EOF =============================================
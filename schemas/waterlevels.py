@@ -15,8 +15,9 @@
 # ===============================================================================
 from datetime import date, time, datetime
 from typing import Union
+from uuid import UUID
 
-from pydantic import Field
+from pydantic import BaseModel, Field
 
 from schemas import ORMBaseModel, Measurement
 
@@ -37,4 +38,39 @@ class WaterLevelsContinuous_Acoustic(Measurement):
     DateMeasured: Union[datetime, None] = Field(..., alias="measurement_datetime")
 
 
+class CombinedWaterLevel(BaseModel):
+    source: str
+    measurement_datetime: datetime
+    depth_to_water_ftbgs: Union[float, None]
+
+
+class WellSummary(ORMBaseModel):
+    PointID: str
+    WellID: UUID
+    n_measurements: int
+    n_manual: int
+    n_pressure: int
+    n_acoustic: int
+    first_measurement: Union[datetime, None]
+    last_measurement: Union[datetime, None]
+    record_length_years: Union[float, None]
+    min_depth_to_water_ftbgs: Union[float, None]
+    max_depth_to_water_ftbgs: Union[float, None]
+    median_depth_to_water_ftbgs: Union[float, None]
+    last_depth_to_water_ftbgs: Union[float, None]
+    change_1yr_ft: Union[float, None]
+    trend_ft_per_yr: Union[float, None]
+    computed_at: Union[datetime, None]
+
+
+class LatestWaterLevel(ORMBaseModel):
+    PointID: Union[str, None]
+    WellID: UUID
+    manual_measurement_date: Union[date, None]
+    manual_depth_to_water_ftbgs: Union[float, None]
+    continuous_measurement_datetime: Union[datetime, None]
+    continuous_depth_to_water_ftbgs: Union[float, None]
+    continuous_source: Union[str, None]
+
+
 # ============= EOF =============================================
@@ -0,0 +1,128 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Single-flight request coalescing.
+
+The first caller for a key runs the computation; callers arriving with the
+same key while it is in flight wait for it and share its result (or its
+exception). Nothing is kept once the call completes, so this only collapses
+concurrent duplicates. Pair it with a cache to absorb sequential repeats.
+"""
+
+import asyncio
+import threading
+
+import metrics
+
+FLIGHTS = []
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.leaders = 0
+        self.followers = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        FLIGHTS.append(self)
+
+    def do(self, key, func, *args, **kw):
+        """
+        coalesce a blocking call. use from sync handlers (threadpool)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if leader:
+            try:
+                call.result = func(*args, **kw)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(self, key, func, *args, **kw):
+        """
+        coalesce a coroutine function. use from async handlers. the shared task
+        is shielded so a follower (or the leader) going away doesn't cancel it
+        for everybody else
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(func(*args, **kw))
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._tasks.pop(key, None))
+        else:
+            self.followers += 1
+
+        return await asyncio.shield(task)
+
+    @property
+    def in_flight(self):
+        return len(self._calls) + len(self._tasks)
+
+
+@metrics.register
+def collect():
+    def samples(attr):
+        return [({"flight": f.name}, getattr(f, attr)) for f in FLIGHTS]
+
+    return [
+        (
+            "singleflight_leaders_total",
+            "counter",
+            "Calls that ran the computation",
+            samples("leaders"),
+        ),
+        (
+            "singleflight_followers_total",
+            "counter",
+            "Calls coalesced onto an in-flight computation",
+            samples("followers"),
+        ),
+        (
+            "singleflight_in_flight",
+            "gauge",
+            "Computations currently in flight",
+            samples("in_flight"),
+        ),
+    ]
+
+
+# ============= EOF =============================================
@@ -0,0 +1,364 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Per-well hydrograph summary statistics.
+
+Summaries are computed with vectorized pandas over the manual, pressure and
+acoustic series and stored in a local SQLite table (SUMMARY_DB). Each stored
+row keeps a watermark (row count, last date and max OBJECTID per source), so a
+refresh only recomputes wells whose data changed. Run the refresh nightly:
+
+    python summary.py            # incremental
+    python summary.py --full     # recompute everything
+
+Requests never build the whole table. Before the first refresh has run,
+/wells/summary answers 503 and starts one background refresh (see
+refresh_in_background).
+"""
+
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    func,
+    select,
+)
+
+import models
+from crud import (
+    public_wellids_filter,
+    read_public_pointids,
+    read_public_wells,
+)
+from database import new_session
+from dependencies import BULK_TIMEOUT
+from singleflight import SingleFlight
+
+SUMMARY_DB = os.environ.get("SUMMARY_DB", "./summaries.db")
+CHUNK_SIZE = 200
+
+flight = SingleFlight("summary")
+# set once a full refresh has run in this process, so an empty table then
+# means no public well has data rather than nothing computed yet
+refreshed = threading.Event()
+
+SOURCES = {
+    "manual": models.WaterLevels,
+    "pressure": models.WaterLevelsContinuous_Pressure,
+    "acoustic": models.WaterLevelsContinuous_Acoustic,
+}
+
+metadata = MetaData()
+well_summary = Table(
+    "well_summary",
+    metadata,
+    Column("WellID", String(36), primary_key=True),
+    Column("PointID", String(50), index=True),
+    Column("n_measurements", Integer),
+    Column("n_manual", Integer),
+    Column("n_pressure", Integer),
+    Column("n_acoustic", Integer),
+    Column("first_measurement", DateTime),
+    Column("last_measurement", DateTime),
+    Column("record_length_years", Float),
+    Column("min_depth_to_water_ftbgs", Float),
+    Column("max_depth_to_water_ftbgs", Float),
+    Column("median_depth_to_water_ftbgs", Float),
+    Column("last_depth_to_water_ftbgs", Float),
+    Column("change_1yr_ft", Float),
+    Column("trend_ft_per_yr", Float),
+    Column("watermark", String(255)),
+    Column("computed_at", DateTime),
+)
+
+_engine = None
+
+
+def get_store():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(
+            f"sqlite:///{SUMMARY_DB}", connect_args={"check_same_thread": False}
+        )
+        metadata.create_all(_engine)
+    return _engine
+
+
+# compute ======================================================================
+def load_series(db, wellids):
+    """
+    manual, pressure and acoustic measurements for `wellids` as one frame
+    """
+    frames = []
+    for source, table in SOURCES.items():
+        q = db.query(table.WellID, table.DateMeasured, table.DepthToWaterBGS)
+        q = q.filter(table.WellID.in_(wellids))
+        rows = q.all()
+        if rows:
+            df = pd.DataFrame.from_records(
+                rows, columns=["WellID", "DateMeasured", "DepthToWaterBGS"]
+            )
+            df["source"] = source
+            frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(
+            columns=["WellID", "DateMeasured", "DepthToWaterBGS", "source"]
+        )
+
+    df = pd.concat(frames, ignore_index=True)
+    df["WellID"] = df["WellID"].astype(str)
+    # one resolution for every source. date and datetime columns otherwise
+    # load as different units, which merge_asof refuses to compare
+    df["DateMeasured"] = pd.to_datetime(df["DateMeasured"]).astype("datetime64[ns]")
+    df["DepthToWaterBGS"] = pd.to_numeric(df["DepthToWaterBGS"], errors="coerce")
+    return df
+
+
+def compute_summaries(df):
+    """
+    summary statistics for every well in `df`, one row per WellID
+    """
+    df = df.dropna(subset=["DateMeasured", "DepthToWaterBGS"])
+    df = df.sort_values(["WellID", "DateMeasured"], kind="mergesort")
+    if df.empty:
+        return pd.DataFrame()
+
+    g = df.groupby("WellID", sort=False)["DepthToWaterBGS"]
+    dates = df.groupby("WellID", sort=False)["DateMeasured"]
+    out = pd.DataFrame(
+        {
+            "n_measurements": g.size(),
+            "first_measurement": dates.first(),
+            "last_measurement": dates.last(),
+            "min_depth_to_water_ftbgs": g.min(),
+            "max_depth_to_water_ftbgs": g.max(),
+            "median_depth_to_water_ftbgs": g.median(),
+            "last_depth_to_water_ftbgs": g.last(),
+        }
+    )
+
+    counts = df.groupby(["WellID", "source"]).size().unstack(fill_value=0)
+    for source in SOURCES:
+        out[f"n_{source}"] = counts[source] if source in counts else 0
+
+    span = out["last_measurement"] - out["first_measurement"]
+    out["record_length_years"] = span.dt.total_seconds() / (365.25 * 86400)
+
+    # change over the last year: latest value minus the last value measured
+    # at least a year before it. positive means the water level dropped
+    target = pd.DataFrame(
+        {
+            "WellID": out.index.to_numpy(),
+            "target": (out["last_measurement"] - pd.Timedelta(days=365)).to_numpy(),
+        }
+    ).sort_values("target")
+    prior = pd.merge_asof(
+        target,
+        df[["WellID", "DateMeasured", "DepthToWaterBGS"]].sort_values("DateMeasured"),
+        left_on="target",
+        right_on="DateMeasured",
+        by="WellID",
+        direction="backward",
+    ).set_index("WellID")
+    out["change_1yr_ft"] = out["last_depth_to_water_ftbgs"] - prior[
+        "DepthToWaterBGS"
+    ].reindex(out.index)
+
+    # least squares slope of depth vs time (ft/yr), all wells at once
+    t = (df["DateMeasured"] - df["DateMeasured"].min()).dt.total_seconds()
+    t = t / (365.25 * 86400)
+    y = df["DepthToWaterBGS"].astype(float)
+    wid = df["WellID"]
+    dt = t - t.groupby(wid).transform("mean")
+    dy = y - y.groupby(wid).transform("mean")
+    sxy = (dt * dy).groupby(wid).sum()
+    sxx = (dt * dt).groupby(wid).sum()
+    out["trend_ft_per_yr"] = (sxy / sxx.replace(0, np.nan)).reindex(out.index)
+
+    out.index.name = "WellID"
+    return out.reset_index()
+
+
+# watermarks ===================================================================
+def read_watermarks(db, wellids=None):
+    """
+    WellID -> watermark string summarizing the state of each well's series
+    """
+    marks = {}
+    for source, table in SOURCES.items():
+        q = db.query(
+            table.WellID,
+            func.count(),
+            func.max(table.DateMeasured),
+            func.max(table.OBJECTID),
+        )
+        if wellids is None:
+            q = public_wellids_filter(q, table, None, db)
+        else:
+            q = q.filter(table.WellID.in_(wellids))
+        for wellid, n, last, oid in q.group_by(table.WellID):
+            marks.setdefault(str(wellid), {})[source] = f"{n}|{last}|{oid}"
+
+    return {
+        k: ";".join(f"{s}={v.get(s, '')}" for s in SOURCES) for k, v in marks.items()
+    }
+
+
+# store ========================================================================
+def refresh_summaries(db, full=False, wellids=None):
+    """
+    recompute summaries for wells whose watermark changed (all wells when
+    `full`). returns the number of wells recomputed
+    """
+    store = get_store()
+    public = read_public_wells(db)
+    pointids = {str(w): p for w, p in read_public_pointids(db).items()}
+    if wellids is not None:
+        wellids = [str(w) for w in wellids]
+
+    marks = read_watermarks(db, wellids)
+    with store.connect() as conn:
+        stored = {
+            w: m
+            for w, m in conn.execute(
+                select(well_summary.c.WellID, well_summary.c.watermark)
+            )
+        }
+
+    stale = [
+        w for w, m in marks.items() if w in pointids and (full or stored.get(w) != m)
+    ]
+
+    lookup = {str(w): w for ws in public.values() for w in ws}
+    now = datetime.now()
+    for i in range(0, len(stale), CHUNK_SIZE):
+        chunk = stale[i : i + CHUNK_SIZE]
+        df = compute_summaries(load_series(db, [lookup[w] for w in chunk]))
+        if df.empty:
+            continue
+
+        df["PointID"] = df["WellID"].map(pointids)
+        df["watermark"] = df["WellID"].map(marks)
+        df["computed_at"] = now
+        records = df.astype(object).where(df.notna(), None).to_dict("records")
+        for r in records:
+            for k in ("first_measurement", "last_measurement"):
+                if r[k] is not None:
+                    r[k] = r[k].to_pydatetime()
+
+        with store.begin() as conn:
+            conn.execute(well_summary.delete().where(well_summary.c.WellID.in_(chunk)))
+            conn.execute(well_summary.insert(), records)
+
+    # wells that lost their public status or all their data
+    gone = [w for w in stored if w not in marks or w not in pointids]
+    if wellids is None and gone:
+        with store.begin() as conn:
+            conn.execute(well_summary.delete().where(well_summary.c.WellID.in_(gone)))
+
+    if wellids is None:
+        refreshed.set()
+    return len(stale)
+
+
+def refresh_in_background(db):
+    """
+    run refresh_summaries in a daemon thread, on a session of its own with
+    the bulk statement timeout. concurrent callers share one refresh
+    """
+
+    def run():
+        with new_session(db) as session:
+            session.info["statement_timeout"] = BULK_TIMEOUT
+            flight.do("all", refresh_summaries, session)
+
+    if not flight.in_flight:
+        threading.Thread(target=run, name="summary-refresh", daemon=True).start()
+
+
+def read_summaries(pointid=None):
+    q = select(well_summary).order_by(well_summary.c.PointID)
+    if pointid:
+        q = q.where(func.upper(well_summary.c.PointID) == pointid.upper())
+    with get_store().connect() as conn:
+        return [dict(r._mapping) for r in conn.execute(q)]
+
+
+def aggregate(rows):
+    """
+    summary statistics over a set of well summaries (see read_summaries)
+    """
+    funcs = {"min": np.min, "median": np.median, "mean": np.mean, "max": np.max}
+
+    def stats(key, *names):
+        v = np.array([r[key] for r in rows if r[key] is not None], dtype=float)
+        return {n: round(float(funcs[n](v)), 3) if len(v) else None for n in names}
+
+    return {
+        "n_wells": len(rows),
+        "n_measurements": int(sum(r["n_measurements"] or 0 for r in rows)),
+        "last_depth_to_water_ftbgs": stats(
+            "last_depth_to_water_ftbgs", "min", "median", "mean", "max"
+        ),
+        "change_1yr_ft": stats("change_1yr_ft", "median", "mean"),
+        "trend_ft_per_yr": stats("trend_ft_per_yr", "median", "mean"),
+    }
+
+
+def get_summary(pointid, db):
+    """
+    summary for a PointID, computed on demand if the precompute hasn't got
+    to it yet
+    """
+    rows = read_summaries(pointid)
+    if not rows:
+        wellids = read_public_wells(db).get(pointid.upper())
+        if wellids:
+            flight.do(pointid.upper(), refresh_summaries, db, wellids=wellids)
+            rows = read_summaries(pointid)
+
+    return rows[0] if rows else None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="refresh well summaries")
+    parser.add_argument("--full", action="store_true")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        n = refresh_summaries(db, full=args.full)
+        print(f"recomputed {n} well summaries")
+    finally:
+        db.close()
+
+# ============= EOF =============================================
@@ -0,0 +1,442 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Gridded water-table surfaces.
+
+The latest level of every public well in a time slice ("latest" = the last
+SURFACE_LATEST_DAYS days, or a calendar year) is interpolated by inverse
+distance weighting in UTM zone 13 (Location Easting/Northing). Only wells
+within SURFACE_RADIUS of a cell contribute to it; cells with none are left
+empty. Surfaces are served as a coarse grid (JSON) and as XYZ PNG tiles,
+computed in a process pool and kept on disk (SURFACE_DIR) under a digest of
+the input points. The points are cached for POINTS_TTL seconds, so new
+measurements reach the surfaces within that: they change the points and
+therefore the digest.
+
+Requests render missing grids and tiles but never delete any. Pre-render the
+common slices and prune old digests with the CLI, e.g. nightly:
+
+    python surface.py latest --zoom 6 9
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from cache import cache
+from crud import read_latest_waterlevels, read_location_list
+from geo_utils import latlon_to_utm, utm_to_latlon
+
+SURFACE_DIR = os.environ.get("SURFACE_DIR", "./surfaces")
+SURFACE_WORKERS = int(os.environ.get("SURFACE_WORKERS", 2))
+SURFACE_LATEST_DAYS = int(os.environ.get("SURFACE_LATEST_DAYS", 365))
+SURFACE_POWER = float(os.environ.get("SURFACE_POWER", 2))
+# metres. wells farther than this from a cell do not contribute to it
+SURFACE_RADIUS = float(os.environ.get("SURFACE_RADIUS", 25000))
+SURFACE_MIN_ZOOM = int(os.environ.get("SURFACE_MIN_ZOOM", 4))
+SURFACE_MAX_ZOOM = int(os.environ.get("SURFACE_MAX_ZOOM", 12))
+POINTS_TTL = 600
+
+ZONE = 13
+CRS = "EPSG:32613"
+QUANTITIES = ("elevation", "depth")
+SLICE = re.compile(r"^(latest|\d{4})$")
+TILE_SIZE = 256
+COLORMAP = "viridis"
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=SURFACE_WORKERS)
+    return _pool
+
+
+def slice_window(name):
+    """
+    (start, end) dates of a time slice, "latest" or a year
+    """
+    if name == "latest":
+        return date.today() - timedelta(days=SURFACE_LATEST_DAYS), None
+    year = int(name)
+    return date(year, 1, 1), date(year, 12, 31)
+
+
+def as_date(d):
+    return d.date() if isinstance(d, datetime) else d
+
+
+@cache.cached(
+    ttl=POINTS_TTL,
+    tags=[
+        "table:Location",
+        "table:WellData",
+        "table:WaterLevels",
+        "table:WaterLevelsContinuous_Pressure",
+        "table:WaterLevelsContinuous_Acoustic",
+    ],
+)
+def read_points(db, name, quantity):
+    """
+    (x, y, z) arrays of the latest level per public well in a time slice.
+    z is the water-table elevation (ft asl) or the depth to water (ft bgs)
+    """
+    locations = {
+        (l.PointID or "").upper(): l
+        for l in read_location_list(db)
+        if l.Easting is not None and l.Northing is not None
+    }
+
+    start, end = slice_window(name)
+    x, y, z = [], [], []
+    for row in read_latest_waterlevels(db, start, end):
+        location = locations.get((row["PointID"] or "").upper())
+        if location is None:
+            continue
+
+        readings = [
+            (
+                as_date(row["manual_measurement_date"]),
+                row["manual_depth_to_water_ftbgs"],
+            ),
+            (
+                as_date(row["continuous_measurement_datetime"]),
+                row["continuous_depth_to_water_ftbgs"],
+            ),
+        ]
+        readings = [r for r in readings if r[0] is not None and r[1] is not None]
+        if not readings:
+            continue
+
+        _, depth = max(readings, key=lambda r: r[0])
+        if quantity == "elevation":
+            if location.Altitude is None:
+                continue
+            depth = location.Altitude - depth
+
+        x.append(location.Easting)
+        y.append(location.Northing)
+        z.append(depth)
+
+    return (
+        np.asarray(x, dtype=float),
+        np.asarray(y, dtype=float),
+        np.asarray(z, dtype=float),
+    )
+
+
+def points_digest(x, y, z):
+    h = hashlib.sha1(f"{SURFACE_POWER}|{SURFACE_RADIUS}".encode())
+    for a in (x, y, z):
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()[:16]
+
+
+def color_scale(z):
+    """
+    (vmin, vmax) shared by every tile of a surface
+    """
+    if not len(z):
+        return 0.0, 1.0
+    vmin, vmax = np.percentile(z, [2, 98])
+    if vmax <= vmin:
+        vmax = vmin + 1
+    return float(vmin), float(vmax)
+
+
+def idw(px, py, pz, gx, gy, power=SURFACE_POWER, radius=SURFACE_RADIUS, chunk=256):
+    """
+    inverse distance weighted values at (gx, gy) from points (px, py, pz).
+    only points within radius contribute; cells without any are NaN. a cell
+    on a point takes that point's value
+    """
+    gx = np.asarray(gx, dtype=float).ravel()
+    gy = np.asarray(gy, dtype=float).ravel()
+    out = np.full(len(gx), np.nan)
+    if not len(px) or not len(gx):
+        return out
+
+    # points that can reach any cell at all
+    near = (
+        (px >= gx.min() - radius)
+        & (px <= gx.max() + radius)
+        & (py >= gy.min() - radius)
+        & (py <= gy.max() + radius)
+    )
+    px, py, pz = px[near], py[near], pz[near]
+    if not len(px):
+        return out
+
+    r2 = radius * radius
+    for s in range(0, len(gx), chunk):
+        # small blocks, updated in place, stay in cache
+        d2 = np.subtract.outer(gx[s : s + chunk], px)
+        d2 *= d2
+        dy = np.subtract.outer(gy[s : s + chunk], py)
+        dy *= dy
+        d2 += dy
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            w = 1 / d2 if power == 2 else d2 ** (-power / 2)
+            w[d2 > r2] = 0
+            exact = d2 == 0
+            w[exact] = 0
+            den = w.sum(axis=1)
+            values = (w @ pz) / den
+
+        hit = exact.any(axis=1)
+        values[hit] = pz[exact[hit].argmax(axis=1)]
+        values[~hit & (den == 0)] = np.nan
+        out[s : s + chunk] = values
+    return out
+
+
+def grid(px, py, pz, cell):
+    """
+    coarse grid over the points' extent. runs in a worker process.
+    values are row-major, rows from south to north, cell centres at
+    (x0 + i * cell, y0 + j * cell)
+    """
+    if len(px):
+        x0 = math.floor(px.min() / cell) * cell + cell / 2
+        y0 = math.floor(py.min() / cell) * cell + cell / 2
+        nx = int((px.max() - x0) // cell) + 2
+        ny = int((py.max() - y0) // cell) + 2
+    else:
+        x0 = y0 = 0.0
+        nx = ny = 0
+
+    gx, gy = np.meshgrid(x0 + np.arange(nx) * cell, y0 + np.arange(ny) * cell)
+    values = idw(px, py, pz, gx, gy)
+    vmin, vmax = color_scale(pz)
+    doc = {
+        "crs": CRS,
+        "x0": x0,
+        "y0": y0,
+        "dx": cell,
+        "dy": cell,
+        "nx": nx,
+        "ny": ny,
+        "count": int(len(pz)),
+        "scale": [vmin, vmax],
+        "values": [None if np.isnan(v) else round(float(v), 2) for v in values],
+    }
+    return json.dumps(doc).encode()
+
+
+def tile_lonlat(z, x, y, size=TILE_SIZE, edges=False):
+    """
+    lon/lat of the pixel centres of web mercator tile z/x/y, rows from north.
+    with edges, a size x size lattice from edge to edge instead
+    """
+    n = 2**z
+    i = np.linspace(0, 1, size) if edges else (np.arange(size) + 0.5) / size
+    lon = (x + i) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + i) / n))))
+    return np.meshgrid(lon, lat)
+
+
+def tile_has_points(px, py, z, x, y):
+    """
+    whether any point is within SURFACE_RADIUS of tile z/x/y's UTM extent
+    """
+    lon, lat = tile_lonlat(z, x, y, size=17, edges=True)
+    gx, gy = latlon_to_utm(lon.ravel(), lat.ravel(), zone=ZONE)
+    return bool(
+        np.any(
+            (px >= np.min(gx) - SURFACE_RADIUS)
+            & (px <= np.max(gx) + SURFACE_RADIUS)
+            & (py >= np.min(gy) - SURFACE_RADIUS)
+            & (py <= np.max(gy) + SURFACE_RADIUS)
+        )
+    )
+
+
+def render_tile(px, py, pz, z, x, y, vmin, vmax):
+    """
+    draw tile z/x/y as a PNG. runs in a worker process
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from matplotlib import colormaps
+    from matplotlib.image import imsave
+
+    lon, lat = tile_lonlat(z, x, y)
+    gx, gy = latlon_to_utm(lon.ravel(), lat.ravel(), zone=ZONE)
+    values = idw(px, py, pz, gx, gy).reshape(TILE_SIZE, TILE_SIZE)
+
+    rgba = colormaps[COLORMAP]((values - vmin) / (vmax - vmin))
+    rgba[np.isnan(values)] = 0
+
+    buf = io.BytesIO()
+    imsave(buf, rgba, format="png")
+    return buf.getvalue()
+
+
+_blank = None
+
+
+def blank_tile():
+    """
+    a fully transparent tile, for tiles no well reaches. written by hand so
+    it needs neither matplotlib nor a worker
+    """
+    global _blank
+    if _blank is None:
+
+        def chunk(tag, data):
+            crc = zlib.crc32(tag + data)
+            return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+        header = struct.pack(">IIBBBBB", TILE_SIZE, TILE_SIZE, 8, 6, 0, 0, 0)
+        rows = (b"\x00" * (1 + 4 * TILE_SIZE)) * TILE_SIZE
+        _blank = (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b"")
+        )
+    return _blank
+
+
+def surface_dir(name, quantity, digest):
+    return os.path.join(SURFACE_DIR, f"{name}-{quantity}", digest)
+
+
+def grid_path(name, quantity, digest, cell):
+    return os.path.join(surface_dir(name, quantity, digest), f"grid-{int(cell)}.json")
+
+
+def tile_path(name, quantity, digest, z, x, y):
+    return os.path.join(surface_dir(name, quantity, digest), str(z), str(x), f"{y}.png")
+
+
+def store(path, blob):
+    """
+    atomically write a grid or tile
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as wfile:
+        wfile.write(blob)
+    os.replace(tmp, path)
+
+
+def prune(name, quantity, current, now=None):
+    """
+    remove the other digests of a slice not written to for POINTS_TTL
+    seconds. workers may serve an older digest until their cached points
+    expire. CLI only
+    """
+    root = os.path.join(SURFACE_DIR, f"{name}-{quantity}")
+    cutoff = (now or time.time()) - POINTS_TTL
+    removed = 0
+    for digest in os.listdir(root):
+        path = os.path.join(root, digest)
+        if digest != current and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def tile_range(px, py, z):
+    """
+    x/y tile ranges at zoom z covering the points (plus the search radius)
+    """
+    lon, lat = utm_to_latlon(
+        np.array([px.min() - SURFACE_RADIUS, px.max() + SURFACE_RADIUS]),
+        np.array([py.min() - SURFACE_RADIUS, py.max() + SURFACE_RADIUS]),
+        ZONE,
+    )
+    n = 2**z
+
+    def tx(lo):
+        return min(n - 1, max(0, int((lo + 180) / 360 * n)))
+
+    def ty(la):
+        r = math.radians(la)
+        v = (1 - math.asinh(math.tan(r)) / math.pi) / 2 * n
+        return min(n - 1, max(0, int(v)))
+
+    return range(tx(lon[0]), tx(lon[1]) + 1), range(ty(lat[1]), ty(lat[0]) + 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pre-render water-table surfaces")
+    parser.add_argument("slice", nargs="*", default=["latest"])
+    parser.add_argument("--quantity", choices=QUANTITIES, default="elevation")
+    parser.add_argument("--cell", type=float, default=5000)
+    parser.add_argument("--zoom", type=int, nargs=2, default=(6, 8))
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        for name in args.slice:
+            px, py, pz = read_points.uncached(db, name, args.quantity)
+            digest = points_digest(px, py, pz)
+            store(
+                grid_path(name, args.quantity, digest, args.cell),
+                grid(px, py, pz, args.cell),
+            )
+            if not len(pz):
+                print(f"{name}: no points")
+                continue
+
+            vmin, vmax = color_scale(pz)
+            pool = get_pool()
+            jobs = {}
+            for z in range(args.zoom[0], args.zoom[1] + 1):
+                xs, ys = tile_range(px, py, z)
+                for x in xs:
+                    for y in ys:
+                        if not tile_has_points(px, py, z, x, y):
+                            continue
+                        path = tile_path(name, args.quantity, digest, z, x, y)
+                        jobs[path] = pool.submit(
+                            render_tile, px, py, pz, z, x, y, vmin, vmax
+                        )
+            for path, job in jobs.items():
+                store(path, job.result())
+            removed = prune(name, args.quantity, digest)
+            print(
+                f"{name}: {len(pz)} points, {len(jobs)} tiles ({digest}), "
+                f"{removed} old surfaces removed"
+            )
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# ============= EOF =============================================
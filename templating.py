@@ -0,0 +1,34 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Jinja2 templates for the HTML views, built on first use so workers that only
+serve JSON/XML never import jinja2.
+"""
+
+from functools import lru_cache
+from pathlib import Path
+
+TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
+
+
+@lru_cache()
+def get_templates():
+    from starlette.templating import Jinja2Templates
+
+    return Jinja2Templates(directory=str(TEMPLATE_DIR))
+
+
+# ============= EOF =============================================
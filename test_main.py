@@ -13,11 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import asyncio
+import threading
+import time
+
+import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
-from database import Base
+from admission import AdmissionController, RouteClass, Shed
+import crud
+from cache import Cache, MemoryBackend, RedisBackend, MISSING
+from database import Base, QueryTimeout, QueryCancelled
+from singleflight import SingleFlight
 from main import app, get_db
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -53,9 +62,1156 @@ def test_read_location_pointid():
     assert response.status_code == 200
 
 
-def test_read_location_view():
+def test_read_location_view(monkeypatch):
+    from sqlalchemy import event
+
+    from cache import cache
+    from routers import locations
+
+    checkouts = []
+
+    def checkout(*args):
+        checkouts.append(args)
+
+    event.listen(engine, "checkout", checkout)
+    try:
+        response = client.get("/locations/view/MG-030")
+        assert response.status_code == 200
+
+        # no fan-out slot free: every read on the build's own session
+        cache.clear()
+        checkouts.clear()
+        monkeypatch.setattr(locations, "view_fanout", threading.BoundedSemaphore(1))
+        locations.view_fanout.acquire()
+        response = client.get("/locations/view/MG-030")
+        assert response.status_code == 200
+        assert len(checkouts) == 1
+    finally:
+        event.remove(engine, "checkout", checkout)
+
+
+def test_read_pods_copies_cached_wells(monkeypatch):
+    import uuid
+
+    import models
+    import schemas
+
+    well = schemas.WellRecord.from_orm(
+        models.Well(LocationId=uuid.uuid4(), WellID=uuid.uuid4(), OSEWellID="RG-1")
+    )
+    monkeypatch.setattr(crud, "read_wells", lambda pointid, db: [well])
+    monkeypatch.setattr(crud, "read_ose_pods", lambda ose_id: [{"id": ose_id}])
+
+    (pi,) = crud._read_pods("MG-030", None)
+    assert pi.pods == [{"id": "RG-1"}]
+    assert well.pods is None
+
+
+def test_read_location_view_pod_deadline(monkeypatch):
+    import uuid
+
+    import models
+    import schemas
+    from routers import locations
+
+    well = schemas.WellRecord.from_orm(
+        models.Well(LocationId=uuid.uuid4(), WellID=uuid.uuid4(), OSEWellID="RG-1")
+    )
+
+    def slow_pods(ose_id):
+        time.sleep(1)
+        return []
+
+    monkeypatch.setattr(locations, "read_wells", lambda pointid, db: [well])
+    monkeypatch.setattr(locations, "read_ose_pods", slow_pods)
+    monkeypatch.setattr(locations, "POD_TIMEOUT", 0.1)
+
+    st = time.time()
     response = client.get("/locations/view/MG-030")
     assert response.status_code == 200
+    assert time.time() - st < 1
+    assert "temporarily unavailable" in response.text
+
+
+def test_trace_arrays():
+    import base64
+    from datetime import date
+    from types import SimpleNamespace
+
+    import numpy as np
+
+    from routers.locations import trace_arrays
+
+    records = [
+        SimpleNamespace(DateMeasured=date(2020, 1, 1), DepthToWaterBGS=10.5),
+        SimpleNamespace(DateMeasured=None, DepthToWaterBGS=11),
+        SimpleNamespace(DateMeasured=date(2020, 1, 2), DepthToWaterBGS=None),
+    ]
+    x, y = trace_arrays(records)
+    assert x["dtype"] == "f8" and y["dtype"] == "f4"
+
+    xs = np.frombuffer(base64.b64decode(x["bdata"]), "<f8")
+    ys = np.frombuffer(base64.b64decode(y["bdata"]), "<f4")
+    assert xs.tolist() == [1577836800000, 1577923200000]
+    assert ys[0] == 10.5 and np.isnan(ys[1])
+
+
+def test_read_location_hydrograph():
+    response = client.get("/locations/MG-030/hydrograph.png")
+    assert response.status_code == 404
+
+    response = client.get("/locations/MG-030/hydrograph.gif")
+    assert response.status_code == 404
+
+
+def test_render_thumbnail():
+    import numpy as np
+
+    from thumbnails import downsample, render
+
+    t = np.arange("2020-01-01", "2021-01-01", dtype="datetime64[h]")
+    y = np.sin(np.arange(len(t)) / 100.0)
+    y[1000] = 5
+    dt, dy = downsample(t, y, 50)
+    assert len(dt) <= 100 and dy.max() == 5
+    assert (np.diff(dt) > np.timedelta64(0)).all()
+
+    assert render(dt, dy, "png", 120, 40).startswith(b"\x89PNG")
+    assert b"<svg" in render(dt, dy, "svg", 120, 40)
+
+
+def test_thumbnail_cache_bounded(tmp_path, monkeypatch):
+    import os
+
+    import thumbnails
+
+    assert [thumbnails.snap(n) for n in (16, 17, 60, 201, 1600)] == [
+        16,
+        32,
+        60,
+        300,
+        1600,
+    ]
+
+    monkeypatch.setattr(thumbnails, "THUMBNAIL_DIR", str(tmp_path))
+    monkeypatch.setattr(thumbnails, "prune_in_background", lambda: None)
+    paths = [
+        thumbnails.thumbnail_path("TW-001", mark, "png", 200, 60)
+        for mark in ("a", "b", "c", "d")
+    ]
+    for p in paths:
+        thumbnails.store(p, b"x" * 1024)
+    # a superseded watermark may still be served, so store leaves it alone
+    assert all(os.path.isfile(p) for p in paths)
+    assert thumbnails.load(paths[0]) == b"x" * 1024
+
+    now = time.time()
+    for i, p in enumerate(paths):
+        os.utime(p, (now - 3 + i, now - 3 + i))
+    old = now - thumbnails.THUMBNAIL_MAX_AGE - 60
+    os.utime(paths[0], (old, old))
+    monkeypatch.setattr(thumbnails, "THUMBNAIL_MAX_MB", 2 / 1024)
+    # the expired one, then the oldest until within budget
+    assert thumbnails.prune(now) == 2
+    assert [os.path.isfile(p) for p in paths] == [False, False, True, True]
+    assert thumbnails.load(paths[0]) is None
+
+
+def test_thumbnail_watermark_cached():
+    import uuid
+    from datetime import date
+
+    from sqlalchemy import event
+
+    import models
+    import thumbnails
+    from cache import cache
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="TW-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="TW-001"
+    )
+    level = models.WaterLevels(
+        OBJECTID=9000, WellID=well.WellID, DateMeasured=date(2020, 1, 1)
+    )
+    db.add_all([location, well, level])
+    db.commit()
+    cache.invalidate("table:WellData")
+
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    try:
+        watermark = thumbnails.read_watermark("TW-001", db)
+        assert watermark.startswith("manual=1|")
+
+        event.listen(engine, "before_cursor_execute", count)
+        # a cache hit runs none of the aggregates
+        assert thumbnails.read_watermark("TW-001", db) == watermark
+        assert statements == []
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+        for r in [level, well, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+        cache.invalidate("table:WellData", "table:WaterLevels")
+
+
+def test_read_waterlevels_manual_window():
+    response = client.get(
+        "/waterlevels/manual?pointid=MG-030&pointid=MG-031&start=2000-01-01&end=2020-12-31"
+    )
+    assert response.status_code == 200
+
+
+def test_read_waterlevels_sites(monkeypatch):
+    import uuid
+    from datetime import datetime
+
+    import models
+    from cache import cache
+    from routers import waterlevels
+
+    response = client.get("/waterlevels/pressure/sites?pointid=MG-030,MG-031")
+    assert response.status_code == 200
+    assert response.json() == {"MG-030": [], "MG-031": []}
+
+    db = TestingSessionLocal()
+    locations = [
+        models.Location(
+            LocationId=uuid.uuid4(), PointID=f"ST-00{i}", PublicRelease=True
+        )
+        for i in range(2)
+    ]
+    wells = [
+        models.Well(WellID=uuid.uuid4(), LocationId=l.LocationId, PointID=l.PointID)
+        for l in locations
+    ]
+    levels = [
+        models.WaterLevels(
+            OBJECTID=6000 + i * 10 + j,
+            WellID=w.WellID,
+            DateMeasured=datetime(2020, 1, 1 + j, 12),
+            DepthToWaterBGS=10 * i + j,
+        )
+        for i, w in enumerate(wells)
+        for j in range(4)
+    ]
+    db.add_all([*locations, *wells, *levels])
+    db.commit()
+    cache.invalidate("table:WellData")
+
+    try:
+        url = "/waterlevels/manual/sites?pointid=ST-001&pointid=ST-000"
+        response = client.get(f"{url}&start=2020-01-02&end=2020-01-03")
+        assert response.status_code == 200
+        data = response.json()
+        assert list(data) == ["ST-001", "ST-000"]
+        # the end date is inclusive, readings later that day included
+        assert [r["depth_to_water_ftbgs"] for r in data["ST-000"]] == [1, 2]
+        assert [r["depth_to_water_ftbgs"] for r in data["ST-001"]] == [11, 12]
+
+        monkeypatch.setattr(waterlevels, "SITES_MAX_ROWS", 4)
+        assert client.get(url).status_code == 413
+        assert client.get(f"{url}&end=2020-01-02").status_code == 200
+
+        monkeypatch.setattr(waterlevels, "SITES_MAX_POINTIDS", 1)
+        assert client.get(url).status_code == 400
+    finally:
+        for r in [*levels, *wells, *locations]:
+            db.delete(r)
+        db.commit()
+        db.close()
+        cache.invalidate("table:WellData")
+
+
+def test_wells_summary(tmp_path, monkeypatch):
+    import uuid
+    from datetime import date
+
+    import models
+    import summary
+    from cache import cache
+
+    monkeypatch.setattr(summary, "SUMMARY_DB", str(tmp_path / "summaries.db"))
+    monkeypatch.setattr(summary, "_engine", None)
+    monkeypatch.setattr(summary, "refreshed", threading.Event())
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="Sm-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="Sm-001"
+    )
+    levels = [
+        models.WaterLevels(
+            OBJECTID=7000 + i,
+            WellID=well.WellID,
+            DateMeasured=date(2018 + i, 1, 1),
+            DepthToWaterBGS=20 + i,
+        )
+        for i in range(3)
+    ]
+    db.add_all([location, well, *levels])
+    db.commit()
+    cache.invalidate("table:WellData")
+
+    try:
+        # cold start. the table is built in the background, not in the request
+        response = client.get("/wells/summary")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "60"
+
+        for _ in range(50):
+            response = client.get("/wells/summary")
+            if response.status_code == 200:
+                break
+            time.sleep(0.1)
+        rows = response.json()
+        assert [(r["PointID"], r["WellID"]) for r in rows] == [
+            ("Sm-001", str(well.WellID))
+        ]
+        assert rows[0]["n_manual"] == 3
+
+        response = client.get("/wells/SM-001/summary")
+        assert response.status_code == 200
+        assert response.json()["WellID"] == str(well.WellID)
+
+        response = client.get("/wells/MG-030/summary")
+        assert response.status_code == 404
+    finally:
+        for r in [*levels, well, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+        cache.invalidate("table:WellData")
+
+
+def test_wells_latest():
+    import uuid
+    from datetime import date, datetime
+
+    import models
+    from cache import cache
+
+    response = client.get("/wells/latest")
+    assert response.status_code == 200
+    assert response.json() == []
+
+    response = client.get("/wells/latest/geojson")
+    assert response.status_code == 200
+    assert response.json()["type"] == "FeatureCollection"
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="LW-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="LW-001"
+    )
+    readings = [
+        models.WaterLevels(
+            OBJECTID=8000,
+            WellID=well.WellID,
+            DateMeasured=date(2020, 5, 1),
+            DepthToWaterBGS=30,
+        ),
+        models.WaterLevelsContinuous_Pressure(
+            GlobalID=uuid.uuid4(),
+            OBJECTID=8001,
+            WellID=well.WellID,
+            DateMeasured=datetime(2021, 3, 1, 6),
+            DepthToWaterBGS=31,
+        ),
+        # an undated acoustic reading never wins
+        models.WaterLevelsContinuous_Acoustic(
+            GlobalID=uuid.uuid4(),
+            OBJECTID=8002,
+            WellID=well.WellID,
+            DateMeasured=None,
+            DepthToWaterBGS=32,
+        ),
+    ]
+    db.add_all([location, well, *readings])
+    db.commit()
+    tags = (
+        "table:WellData",
+        "table:WaterLevels",
+        "table:WaterLevelsContinuous_Pressure",
+        "table:WaterLevelsContinuous_Acoustic",
+    )
+    cache.invalidate(*tags)
+
+    try:
+        response = client.get("/wells/latest")
+        assert response.status_code == 200
+        (row,) = response.json()
+        assert row["manual_measurement_date"] == "2020-05-01"
+        assert row["manual_depth_to_water_ftbgs"] == 30
+        assert row["continuous_source"] == "pressure"
+        assert row["continuous_measurement_datetime"] == "2021-03-01T06:00:00"
+        assert row["continuous_depth_to_water_ftbgs"] == 31
+    finally:
+        for r in [*readings, well, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+        cache.invalidate(*tags)
+
+
+def test_surface_idw():
+    import json
+
+    import numpy as np
+
+    from surface import grid, idw, render_tile
+
+    px, py, pz = np.array([0.0, 1000.0]), np.zeros(2), np.array([10.0, 20.0])
+    values = idw(px, py, pz, [0, 500, 1000, 1e6], [0, 0, 0, 0], radius=5000)
+    assert values[:3].tolist() == [10, 15, 20]
+    assert np.isnan(values[3])
+
+    doc = json.loads(grid(px, py, pz, 1000))
+    assert doc["crs"] == "EPSG:32613" and doc["count"] == 2
+    assert len(doc["values"]) == doc["nx"] * doc["ny"]
+
+    # a tile over central New Mexico, with a well (UTM 13N) at its centre
+    blob = render_tile(
+        np.array([400000.0]), np.array([3800000.0]), np.array([5.0]), 7, 26, 50, 0, 10
+    )
+    assert blob.startswith(b"\x89PNG")
+
+
+def test_wells_surface(tmp_path, monkeypatch):
+    import surface
+
+    monkeypatch.setattr(surface, "SURFACE_DIR", str(tmp_path))
+
+    response = client.get("/wells/surface/latest.json")
+    assert response.status_code == 200
+    assert response.json()["count"] == 0
+
+    # no wells anywhere: a transparent tile without a render
+    response = client.get("/wells/surface/2020/7/26/50.png?quantity=depth")
+    assert response.status_code == 200
+    assert response.content == surface.blank_tile()
+
+    assert client.get("/wells/surface/last-week.json").status_code == 404
+    assert client.get("/wells/surface/latest/20/0/0.png").status_code == 404
+
+    # writing a digest leaves the others for the CLI to prune, by age
+    import os
+
+    old, new = (surface.grid_path("2020", "depth", d, 5000) for d in ("a", "b"))
+    surface.store(old, b"{}")
+    surface.store(new, b"{}")
+    assert os.path.isfile(old)
+    assert surface.prune("2020", "depth", "b") == 0
+    later = time.time() + surface.POINTS_TTL + 1
+    assert surface.prune("2020", "depth", "b", now=later) == 1
+    assert not os.path.isfile(old) and os.path.isfile(new)
+
+
+def test_compute_summaries():
+    import pandas as pd
+
+    from summary import compute_summaries
+
+    df = pd.DataFrame(
+        {
+            "WellID": ["a", "a", "a", "b"],
+            "DateMeasured": pd.to_datetime(
+                ["2020-01-01", "2021-01-01", "2022-01-01", "2022-06-01"]
+            ),
+            "DepthToWaterBGS": [10.0, 12.0, 14.0, 5.0],
+            "source": ["manual", "pressure", "pressure", "acoustic"],
+        }
+    )
+    s = compute_summaries(df).set_index("WellID")
+    a = s.loc["a"]
+    assert a["n_measurements"] == 3
+    assert a["n_manual"] == 1 and a["n_pressure"] == 2
+    assert a["median_depth_to_water_ftbgs"] == 12
+    assert a["change_1yr_ft"] == 2
+    assert abs(a["trend_ft_per_yr"] - 2) < 0.01
+    assert s.loc["b", "n_acoustic"] == 1
+
+
+def test_read_waterlevels_combined():
+    response = client.get("/waterlevels/combined?pointid=MG-030")
+    assert response.status_code == 200
+    assert response.json() == []
+
+    response = client.get("/waterlevels/combined?pointid=MG-030&format=csv")
+    assert response.status_code == 200
+    assert response.text.strip() == "source,measurement_datetime,depth_to_water_ftbgs"
+
+
+def test_merge_order():
+    from datetime import date, datetime
+
+    from hydrograph import merge_order
+
+    manual = [date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 5)]
+    continuous = [datetime(2020, 1, 1), datetime(2020, 1, 2), datetime(2020, 1, 3)]
+    is_manual, rows = merge_order(manual, [5, 9, 7], continuous, [6, 8, 8])
+    # shallower reading wins on shared days, unpaired manual readings are kept
+    assert list(zip(is_manual, rows)) == [(True, 0), (False, 1), (False, 2), (True, 2)]
+
+
+def test_read_waterchemistry():
+    import uuid
+
+    import models
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="WC-001", PublicRelease=True
+    )
+    sample = models.ChemistrySampleInfo(
+        SamplePtID=uuid.uuid4(),
+        SamplePointID="WC-001A",
+        LocationId=location.LocationId,
+        PublicRelease=True,
+    )
+    # a withheld sample at the public location
+    hidden = models.ChemistrySampleInfo(
+        SamplePtID=uuid.uuid4(),
+        SamplePointID="WC-001B",
+        LocationId=location.LocationId,
+        PublicRelease=False,
+    )
+    results = [
+        models.MajorChemistry(
+            GlobalID=uuid.uuid4(),
+            SamplePtID=sample.SamplePtID,
+            Analyte="Ca",
+            SampleValue=10,
+        ),
+        models.MajorChemistry(
+            GlobalID=uuid.uuid4(),
+            SamplePtID=sample.SamplePtID,
+            Analyte="Mg",
+            SampleValue=3,
+        ),
+        models.MinorandTraceChemistry(
+            GlobalID=uuid.uuid4(),
+            SamplePtID=sample.SamplePtID,
+            Analyte="As",
+            SampleValue=0.01,
+        ),
+        models.MajorChemistry(
+            GlobalID=uuid.uuid4(),
+            SamplePtID=hidden.SamplePtID,
+            Analyte="Ca",
+            SampleValue=99,
+        ),
+        models.MinorandTraceChemistry(
+            GlobalID=uuid.uuid4(),
+            SamplePtID=hidden.SamplePtID,
+            Analyte="U",
+            SampleValue=0.5,
+        ),
+    ]
+    db.add_all([location, sample, hidden, *results])
+    db.commit()
+    try:
+        response = client.get("/waterchem/analytes?pointid=WC-001&analyte=Ca,As")
+        assert response.status_code == 200
+        lines = response.text.strip().splitlines()
+        assert len(lines) == 3 and lines[0].startswith("PointID,SamplePointID")
+        assert "WC-001B" not in response.text
+
+        response = client.get(
+            "/waterchem/analytes?pointid=WC-001&layout=wide&format=json"
+        )
+        assert response.status_code == 200
+        (row,) = response.json()
+        assert (row["As"], row["Ca"], row["Mg"]) == (0.01, 10, 3)
+
+        response = client.get(
+            "/waterchem/analytes?pointid=WC-001&format=ndjson&analyte=Mg"
+        )
+        assert response.text.count("\n") == 1
+
+        response = client.get("/waterchem/WC-001/Ca")
+        assert response.status_code == 200
+        assert [r["SampleValue"] for r in response.json()] == [10]
+        assert client.get("/waterchem/WC-001/U").json() == []
+
+        assert client.get("/waterchem/analytes").status_code == 400
+    finally:
+        for r in [*results, sample, hidden, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+
+
+def test_graphql():
+    import uuid
+    from datetime import date
+
+    from sqlalchemy import event
+
+    import models
+
+    db = TestingSessionLocal()
+    locations = [
+        models.Location(
+            LocationId=uuid.uuid4(), PointID=f"GQ-00{i}", PublicRelease=True
+        )
+        for i in range(3)
+    ]
+    wells = [
+        models.Well(WellID=uuid.uuid4(), LocationId=l.LocationId, PointID=l.PointID)
+        for l in locations
+    ]
+    levels = [
+        models.WaterLevels(
+            OBJECTID=1000 + i * 10 + j,
+            WellID=w.WellID,
+            DateMeasured=date(2020, 1, 1 + j),
+            DepthToWaterBGS=10 + j,
+        )
+        for i, w in enumerate(wells)
+        for j in range(5)
+    ]
+    db.add_all([*locations, *wells, *levels])
+    db.commit()
+
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        query = """{ locations(pointIds: ["GQ-000", "GQ-001", "GQ-002"]) {
+            pointId wells { wellId manual(limit: 2) { depthToWaterFtbgs } } } }"""
+        response = client.post("/graphql", json={"query": query})
+        assert response.status_code == 200
+        data = response.json()["data"]["locations"]
+        assert [l["pointId"] for l in data] == ["GQ-000", "GQ-001", "GQ-002"]
+        assert data[0]["wells"][0]["manual"] == [
+            {"depthToWaterFtbgs": 14},
+            {"depthToWaterFtbgs": 13},
+        ]
+        # locations, wells, manual levels. no N+1
+        assert len(statements) == 3
+
+        query = "{ locations(limit: 1000) { wells { manual(limit: 1000) { depthToWaterFtbgs } } } }"
+        response = client.post("/graphql", json={"query": query})
+        assert "cost" in response.json()["errors"][0]["message"]
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+        for r in [*levels, *wells, *locations]:
+            db.delete(r)
+        db.commit()
+        db.close()
+
+
+def test_batch(monkeypatch):
+    from routers import batch
+
+    paths = [
+        "/locations/pointid/MG-030",
+        "/pod?pointid=MG-030",
+        "/locations/view/MG-030",
+        "/well",
+    ]
+    payload = {"requests": [{"id": str(i), "path": p} for i, p in enumerate(paths)]}
+    payload["requests"] += [
+        {"id": "missing", "path": "/nope"},
+        {"path": "/batch"},
+        {"id": "bulk", "path": "/waterlevels/manual?pointid=MG-030"},
+    ]
+
+    response = client.post("/batch", json=payload)
+    assert response.status_code == 200
+    responses = response.json()["responses"]
+    assert [r["id"] for r in responses] == [
+        "0",
+        "1",
+        "2",
+        "3",
+        "missing",
+        None,
+        "bulk",
+    ]
+    for r, path in zip(responses, paths):
+        direct = client.get(path)
+        assert r["status"] == direct.status_code == 200
+        if not direct.content:
+            assert r["body"] is None
+        elif direct.headers["content-type"].startswith("application/json"):
+            assert r["body"] == direct.json()
+        else:
+            assert r["body"] == direct.text
+    assert responses[4]["status"] == 404
+    assert responses[5]["status"] == 400
+    # bulk routes are admitted on their own, never through a batch
+    assert responses[6]["status"] == 400
+    assert responses[6]["body"] == {"detail": "bulk routes cannot be batched"}
+
+    # paths are percent-decoded before they are classified and routed
+    payload = {
+        "requests": [
+            {"path": "/locations/pointid/MG%2D030"},
+            {"path": "/water%6Cevels/manual?pointid=MG-030"},
+        ]
+    }
+    encoded, bulk = client.post("/batch", json=payload).json()["responses"]
+    assert encoded["body"] == responses[0]["body"]
+    assert bulk["status"] == 400
+
+    monkeypatch.setattr(batch, "BATCH_MAX_BODY", 64)
+    response = client.post(
+        "/batch", json={"requests": [{"path": "/locations/view/MG-030"}]}
+    )
+    (r,) = response.json()["responses"]
+    assert r["status"] == 413
+
+    response = client.post(
+        "/batch", json={"requests": [{"path": "/well", "method": "POST"}]}
+    )
+    assert response.status_code == 422
+
+
+def test_changes():
+    import json
+    import uuid
+    from datetime import date
+
+    import models
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="CF-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="CF-001"
+    )
+    levels = [
+        models.WaterLevels(
+            OBJECTID=2000 + i,
+            WellID=well.WellID,
+            DateMeasured=date(2021, 1, 1 + i),
+            DepthToWaterBGS=20 + i,
+        )
+        for i in range(5)
+    ]
+    db.add_all([location, well, *levels[:3]])
+    db.commit()
+
+    def read(since=None, limit=None):
+        params = {k: v for k, v in (("since", since), ("limit", limit)) if v}
+        response = client.get("/changes/waterlevels", params=params)
+        assert response.status_code == 200
+        lines = [json.loads(l) for l in response.text.splitlines()]
+        return [l["key"]["OBJECTID"] for l in lines if "key" in l], lines[-1]
+
+    try:
+        assert client.get("/changes").json()["waterlevels"]["watermark"] == ["OBJECTID"]
+
+        keys, end = read(limit=2)
+        assert keys == [2000, 2001] and end["more"]
+        keys, end = read(end["next"])
+        assert keys == [2002] and not end["more"]
+
+        db.add_all(levels[3:])
+        db.commit()
+        keys, end = read(end["next"])
+        assert keys == [2003, 2004]
+
+        assert client.get("/changes/waterlevels?since=bogus").status_code == 400
+        assert client.get("/changes/nope").status_code == 404
+    finally:
+        q = db.query(models.WaterLevels)
+        q.filter(models.WaterLevels.WellID == well.WellID).delete()
+        db.delete(well)
+        db.delete(location)
+        db.commit()
+        db.close()
+
+
+def test_changes_null_watermark():
+    import json
+    import uuid
+    from datetime import datetime
+
+    import models
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="CN-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="CN-001"
+    )
+    readings = [
+        models.WaterLevelsContinuous_Pressure(
+            GlobalID=uuid.uuid4(),
+            OBJECTID=oid,
+            WellID=well.WellID,
+            DateMeasured=datetime(2021, 1, 1 + i),
+        )
+        for i, oid in enumerate((2101, None, 2100, None))
+    ]
+    db.add_all([location, well, *readings])
+    db.commit()
+
+    try:
+        order = crud.change_feed_order(models.WaterLevelsContinuous_Pressure, db)
+        q = crud.change_feed_query(
+            models.WaterLevelsContinuous_Pressure, order, [None, uuid.uuid4()]
+        )
+        sql = str(q).lower()
+        assert "coalesce" not in sql and '"objectid" is not null' in sql
+
+        # one row per page, walking through the NULL watermarks first
+        keys, since = [], None
+        for _ in range(5):
+            params = {"limit": 1, **({"since": since} if since else {})}
+            response = client.get("/changes/pressure", params=params)
+            lines = [json.loads(l) for l in response.text.splitlines()]
+            keys += [l["row"]["OBJECTID"] for l in lines if "row" in l]
+            since = lines[-1]["next"] or since
+        assert keys == [None, None, 2100, 2101]
+    finally:
+        for r in [*readings, well, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+
+
+def test_changes_late_null_updated(tmp_path):
+    import sqlite3
+    import uuid
+    from datetime import datetime
+
+    from sqlalchemy import DateTime, bindparam
+
+    import models
+    from mirror import sync
+
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    Base.metadata.create_all(source)
+    with source.begin() as conn:
+        for name in ("Updated", "Created"):
+            conn.execute(
+                text(f'ALTER TABLE "WaterLevels" ADD COLUMN "{name}" DATETIME')
+            )
+    stamp = text(
+        'UPDATE "WaterLevels" SET "Updated" = :updated, "Created" = :created '
+        'WHERE "OBJECTID" = :oid'
+    ).bindparams(
+        bindparam("updated", type_=DateTime), bindparam("created", type_=DateTime)
+    )
+
+    db = sessionmaker(bind=source)()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="NU-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="NU-001"
+    )
+
+    def add(oid, updated, created):
+        db.add(models.WaterLevels(OBJECTID=oid, WellID=well.WellID))
+        db.commit()
+        db.execute(stamp, {"oid": oid, "updated": updated, "created": created})
+        db.commit()
+
+    db.add_all([location, well])
+    add(1, datetime(2022, 1, 2), datetime(2022, 1, 1))
+    add(2, None, datetime(2022, 1, 1))
+    add(3, None, None)
+    try:
+        order = crud.change_feed_order(models.WaterLevels, db)
+        rows = db.execute(crud.change_feed_query(models.WaterLevels, order)).all()
+        assert [r.OBJECTID for r in rows] == [3, 2, 1]
+        checkpoint = [rows[-1]._mapping[c.name] for c in order]
+        path = str(tmp_path / "mirror.db")
+        sync(db, path, full=True)
+
+        # never edited, so Updated is NULL, but created after the checkpoint
+        add(4, None, datetime(2022, 2, 1))
+        q = crud.change_feed_query(models.WaterLevels, order, checkpoint)
+        assert [r.OBJECTID for r in db.execute(q)] == [4]
+
+        assert sync(db, path)["WaterLevels"] == 2
+        with sqlite3.connect(path) as conn:
+            oids = [o for (o,) in conn.execute('SELECT OBJECTID FROM "WaterLevels"')]
+        assert sorted(oids) == [1, 2, 3, 4]
+    finally:
+        db.close()
+        source.dispose()
+
+
+def test_export_job(tmp_path, monkeypatch):
+    import io
+    import json
+    import os
+    import uuid
+    import zipfile
+    from datetime import date
+
+    import jobs
+    import models
+    from cache import cache
+
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path))
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="EX-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="EX-001"
+    )
+    levels = [
+        models.WaterLevels(
+            OBJECTID=3000 + i,
+            WellID=well.WellID,
+            DateMeasured=date(2020 + i % 2, 1 + i, 1),
+            DepthToWaterBGS=20 + i,
+        )
+        for i in range(5)
+    ]
+    db.add_all([location, well, *levels])
+    db.commit()
+    cache.invalidate("table:WellData")
+
+    spec = {"kind": "manual", "partition": "year", "pointids": ["ex-001"]}
+    try:
+        response = client.post("/jobs/export", json=spec)
+        assert response.status_code == 202
+        job = response.json()
+        assert response.headers["location"].endswith(f"/jobs/{job['id']}")
+
+        st = time.time()
+        while job["status"] in ("queued", "running") and time.time() - st < 30:
+            time.sleep(0.1)
+            job = client.get(f"/jobs/{job['id']}").json()
+        assert job["status"] == "done", job
+        assert job["parts"] == job["done"] == 2 and job["rows"] == 5
+        assert job["progress"] == 1
+
+        response = client.get(job["result"])
+        assert response.status_code == 200
+        zfile = zipfile.ZipFile(io.BytesIO(response.content))
+        assert zfile.namelist() == ["2020.csv", "2021.csv"]
+        lines = zfile.read("2020.csv").decode().splitlines()
+        assert len(lines) == 4 and lines[1].startswith("EX-001,")
+
+        # an identical spec reuses the finished job
+        response = client.post("/jobs/export", json={**spec, "pointids": ["EX-001"]})
+        assert response.json()["id"] == job["id"]
+        assert response.json()["status"] == "done"
+
+        # a job that beats counts as alive however old its state
+        state = jobs.read_state(job["id"])
+        state.update(status="running", updated=time.time() - 2 * jobs.JOBS_STALE)
+        with open(os.path.join(jobs.job_dir(job["id"]), "job.json"), "w") as wfile:
+            json.dump(state, wfile)
+        alive = os.path.join(jobs.job_dir(job["id"]), "heartbeat")
+        os.utime(alive, (0, 0))
+        assert not jobs.reusable(state)
+        with jobs.heartbeat(alive):
+            assert jobs.reusable(state)
+            assert not jobs.claim(job["id"], state["spec"])
+
+        # a claim in progress elsewhere. nobody else resets the job meanwhile
+        state["updated"] = time.time() - 2 * jobs.JOBS_STALE
+        os.utime(alive, (0, 0))
+        jobs.touch(jobs.claim_path(job["id"]))
+        assert not jobs.claim(job["id"], state["spec"])
+        assert os.path.isfile(jobs.result_path(job["id"]))
+        os.remove(jobs.claim_path(job["id"]))
+        assert jobs.claim(job["id"], state["spec"])
+        assert jobs.read_state(job["id"])["status"] == "queued"
+
+        spec = {"kind": "ngwmn", "partition": "year"}
+        assert client.post("/jobs/export", json=spec).status_code == 422
+        assert client.get("/jobs/0123456789abcdef").status_code == 404
+        assert client.get("/jobs/0123456789abcdef/result").status_code == 404
+        assert client.get("/jobs/nope").status_code == 422
+        assert client.get("/jobs/..%2F..%2Fetc/result").status_code in (404, 422)
+    finally:
+        q = db.query(models.WaterLevels)
+        q.filter(models.WaterLevels.WellID == well.WellID).delete()
+        db.delete(well)
+        db.delete(location)
+        db.commit()
+        db.close()
+        cache.invalidate("table:WellData")
+
+
+def test_export_job_failure(tmp_path, monkeypatch):
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    import jobs
+
+    release = threading.Event()
+
+    def run_part(url, spec, part, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if part == "bad":
+            raise ValueError(part)
+        release.wait(10)
+        return 1
+
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs, "get_pool", lambda: pool)
+    monkeypatch.setattr(jobs, "run_part", run_part)
+    pool = ThreadPoolExecutor(max_workers=2)
+    spec = jobs.canonical({"kind": "manual", "partition": "well", "format": "csv"})
+    job = jobs.job_id(spec)
+    try:
+        assert jobs.claim(job, spec)
+        run = jobs.read_state(job)["run"]
+        jobs.start(job, spec, ["slow", "bad", "queued"], None)
+        time.sleep(0.2)
+        # a partition is still running in parts-<run>. the job isn't failed,
+        # so it isn't taken over
+        assert jobs.read_state(job)["status"] == "running"
+        assert not jobs.claim(job, spec)
+
+        release.set()
+        pool.shutdown(wait=True)
+        state = jobs.read_state(job)
+        assert state["status"] == "failed" and "bad" in state["error"]
+        assert jobs.claim(job, spec)
+        assert jobs.read_state(job)["run"] != run
+        assert os.path.isdir(jobs.parts_dir(job, run))
+    finally:
+        release.set()
+        pool.shutdown(wait=True)
+
+
+def test_mirror(tmp_path, monkeypatch):
+    import sqlite3
+    import uuid
+    from datetime import date
+
+    import database
+    import models
+    from mirror import sync
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="MR-001", PublicRelease=True
+    )
+    hidden = models.Location(
+        LocationId=uuid.uuid4(), PointID="MR-002", PublicRelease=False
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="MR-001"
+    )
+    level = models.WaterLevels(
+        OBJECTID=3000,
+        WellID=well.WellID,
+        DateMeasured=date(2022, 1, 1),
+        DepthToWaterBGS=30,
+    )
+    db.add_all([location, hidden, well, level])
+    db.commit()
+
+    path = str(tmp_path / "mirror.db")
+    try:
+        assert sync(db, path, full=True)["WaterLevels"] >= 1
+        # nothing new since the stored position
+        assert sync(db, path)["WaterLevels"] == 0
+        with sqlite3.connect(path) as conn:
+            pointids = {p for (p,) in conn.execute('SELECT PointID FROM "Location"')}
+        assert "MR-001" in pointids and "MR-002" not in pointids
+
+        well.OSEWellID = "RG-PRIMARY"
+        db.commit()
+
+        monkeypatch.setattr(database, "READ_MODE", "mirror")
+        monkeypatch.setattr(database, "mirror", database.Mirror(path))
+        response = client.get("/well?pointid=MR-001")
+        assert response.json()["ose_well_id"] is None
+
+        # a stale mirror falls back to the primary
+        monkeypatch.setattr(database, "MIRROR_MAX_AGE", -1)
+        response = client.get("/well?pointid=MR-001")
+        assert response.json()["ose_well_id"] == "RG-PRIMARY"
+    finally:
+        for r in [level, well, hidden, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+
+
+def test_read_waterlevels_pressure_year():
+    import uuid
+    from datetime import date, datetime
+
+    import models
+    from cache import cache
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(), PointID="PY-001", PublicRelease=True
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="PY-001"
+    )
+    readings = [
+        models.WaterLevelsContinuous_Pressure(
+            GlobalID=uuid.uuid4(),
+            OBJECTID=4000 + i,
+            WellID=well.WellID,
+            DateMeasured=datetime(2019 + i // 3, 6, 1 + i),
+            DepthToWaterBGS=40 + i,
+        )
+        for i in range(6)
+    ]
+    db.add_all([location, well, *readings])
+    db.commit()
+    cache.invalidate("table:WellData")
+
+    try:
+        response = client.get("/waterlevels/pressure/PY-001/2019")
+        assert response.status_code == 200
+        assert [r["depth_to_water_ftbgs"] for r in response.json()] == [40, 41, 42]
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+
+        response = client.get(
+            "/waterlevels/pressure/PY-001/2019", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert response.content == b""
+
+        response = client.get("/waterlevels/pressure/PY-001/2020?format=csv")
+        assert response.text.splitlines()[0] == (
+            "measurement_datetime,depth_to_water_ftbgs"
+        )
+        assert response.headers["etag"] != etag
+
+        response = client.get(f"/waterlevels/pressure/PY-001/{date.today().year}")
+        assert response.json() == []
+        assert "immutable" not in response.headers["cache-control"]
+
+        assert client.get("/waterlevels/pressure/NOPE/2019").status_code == 404
+        assert client.get("/waterlevels/pressure/PY-001/3000").status_code == 404
+    finally:
+        for r in [*readings, well, location]:
+            db.delete(r)
+        db.commit()
+        db.close()
+        cache.invalidate("table:WellData")
 
 
 def test_well():
@@ -83,4 +1239,520 @@ def test_read_waterlevels_acoustic():
     assert response.status_code == 200
 
 
+SLOW_SQL = text(
+    "with recursive c(x) as (select 1 union all select x + 1 from c where x < 100000000) "
+    "select count(*) from c"
+)
+
+
+def test_statement_timeout():
+    db = TestingSessionLocal()
+    db.info["statement_timeout"] = 0.1
+    try:
+        with pytest.raises(QueryTimeout):
+            db.execute(SLOW_SQL)
+
+        # one watchdog thread, not a timer thread per statement
+        threads = threading.active_count()
+        for _ in range(50):
+            assert db.execute(text("select 1")).scalar() == 1
+        assert threading.active_count() == threads
+    finally:
+        db.close()
+
+
+def test_cancelled_session():
+    db = TestingSessionLocal()
+    db.info["cancelled"] = True
+    try:
+        with pytest.raises(QueryCancelled):
+            db.execute(text("select 1"))
+    finally:
+        db.close()
+
+
+def test_metrics():
+    client.get("/locations")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'admission_admitted_total{class="interactive"}' in response.text
+
+
+def test_admission_classes():
+    from admission import make_controller
+
+    controller = make_controller()
+    for path, name in (
+        ("/well", "interactive"),
+        ("/wells/summary", "interactive"),
+        ("/wells/NM-001/summary", "interactive"),
+        ("/wells/latest", "bulk"),
+        ("/wells/latest/geojson", "bulk"),
+        ("/wells/surface/latest.json", "bulk"),
+        ("/wells/surface/2020/7/26/50.png", "bulk"),
+        ("/waterlevels/manual", "bulk"),
+    ):
+        assert controller.classify(path).name == name, path
+
+
+def test_admission_shed_and_priority():
+    interactive = RouteClass("interactive", ("/map",), limit=2, queue=2, priority=0)
+    bulk = RouteClass("bulk", ("/ngwmn",), limit=1, queue=1, priority=1)
+    controller = AdmissionController([interactive, bulk], total=2, queue_timeout=1)
+    assert controller.classify("/ngwmn/waterlevels/MG-030") is bulk
+    assert controller.classify("/docs") is None
+
+    async def scenario():
+        await controller.acquire(bulk)
+        await controller.acquire(interactive)
+
+        # full. bulk may queue one, the second is shed
+        queued_bulk = asyncio.ensure_future(controller.acquire(bulk))
+        await asyncio.sleep(0)
+        with pytest.raises(Shed):
+            await controller.acquire(bulk)
+
+        # interactive queued after bulk is still admitted first
+        queued_interactive = asyncio.ensure_future(controller.acquire(interactive))
+        await asyncio.sleep(0)
+        controller.release(bulk)
+        await queued_interactive
+        assert not queued_bulk.done()
+
+        controller.release(interactive)
+        await queued_bulk
+
+    asyncio.run(scenario())
+    assert bulk.shed["queue_full"] == 1
+
+
+def test_read_locations_geojson():
+    response = client.get("/locations/geojson")
+    assert response.status_code == 200
+
+
+def test_location_index(tmp_path):
+    import json
+    import uuid
+
+    from location_index import LocationIndex, write_index
+
+    records = [
+        (uuid.uuid4(), "MG-030", "USGS-1", 350000, 3800000, 5000, "GPS"),
+        (uuid.uuid4(), "MG-031", None, 360000, 3810000, None, None),
+        (uuid.uuid4(), "NM-001", "mg-9", 500000, 3600000, 4000, "Map"),
+    ]
+    index = LocationIndex(write_index(records, str(tmp_path)))
+    assert len(index) == 3
+    assert [f["properties"]["name"] for f in json.loads(index.geojson())] == [
+        "MG-030",
+        "MG-031",
+        "NM-001",
+    ]
+
+    assert index.bbox(-107, 34, -106, 35).tolist() == [0, 1]
+    idx, d = index.nearest(-106.63, 34.33, 2)
+    assert idx.tolist() == [0, 1] and d[0] < 1
+    assert index.search("mg").tolist() == [0, 1, 2]
+    assert index.search("usgs").tolist() == [0]
+
+    from shapely.geometry import Polygon
+
+    square = Polygon([(-107, 34), (-106, 34), (-106, 35), (-107, 35)])
+    assert index.within(square).tolist() == [0, 1]
+    hole = [(-106.55, 34.4), (-106.5, 34.4), (-106.5, 34.45), (-106.55, 34.45)]
+    assert index.within(Polygon(square.exterior, [hole])).tolist() == [0]
+
+    f = index.features([1])[0]
+    assert f["properties"] == {
+        "point_id": "MG-031",
+        "alternate_name": None,
+        "elevation_method": None,
+    }
+    assert f["geometry"]["coordinates"][2] is None
+
+    docs = [
+        json.loads(line)
+        for chunk in index.jsonld("http://example.org/")
+        for line in chunk.splitlines()
+    ]
+    assert [d["PointID"] for d in docs] == ["MG-030", "MG-031", "NM-001"]
+    assert docs[0]["LocationId"] == str(records[0][0])
+    assert docs[0]["links"][0]["href"] == (
+        "http://example.org/locations/pointid/MG-030/jsonld"
+    )
+    assert "<loc>http://example.org/locations/sitemap/0.xml</loc>" in (
+        index.sitemap_index("http://example.org/")
+    )
+    sitemap = index.sitemap(0, "http://example.org/").decode()
+    assert sitemap.count("<url>") == 3
+    assert index.sitemap(1, "http://example.org/") is None
+
+
+def test_location_index_versions(tmp_path, monkeypatch):
+    import os
+    import uuid
+
+    import location_index
+
+    root = str(tmp_path)
+    records = [(uuid.uuid4(), "MG-030", None, 350000, 3800000, None, None)]
+    paths = [location_index.write_index(records, root) for _ in range(3)]
+    # superseded just now. a worker may still be serving them
+    assert all(os.path.isdir(p) for p in paths)
+
+    old = time.time() - location_index.PRUNE_GRACE - 60
+    for p in paths[:2]:
+        os.utime(p, (old, old))
+    location_index.prune(root, os.path.basename(paths[2]))
+    assert [os.path.isdir(p) for p in paths] == [False, True, True]
+
+    # a published index is mapped, not rebuilt
+    monkeypatch.setattr(location_index, "LOCATION_INDEX_DIR", root)
+    monkeypatch.setattr(location_index, "_index", None)
+    monkeypatch.setattr(location_index, "read_records", None)
+    assert location_index.get_index(None).path == paths[2]
+
+    # an index past its max age keeps serving while it is rebuilt
+    old = time.time() - location_index.LOCATION_INDEX_MAX_AGE - 60
+    os.utime(paths[2], (old, old))
+    monkeypatch.setattr(location_index, "read_records", lambda db: records)
+    monkeypatch.setattr(location_index, "_checked", 0)
+    db = TestingSessionLocal()
+    try:
+        assert location_index.get_index(db).path == paths[2]
+        for _ in range(100):
+            if location_index.current_path(root) != paths[2]:
+                break
+            time.sleep(0.05)
+        monkeypatch.setattr(location_index, "_checked", 0)
+        assert location_index.get_index(db).path not in paths
+    finally:
+        db.close()
+
+
+def test_read_locations_index_routes(tmp_path, monkeypatch):
+    import location_index
+    import summary
+
+    monkeypatch.setattr(location_index, "LOCATION_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(location_index, "_index", None)
+    monkeypatch.setattr(summary, "SUMMARY_DB", str(tmp_path / "summaries.db"))
+    monkeypatch.setattr(summary, "_engine", None)
+    for url in (
+        "/locations/geojson",
+        "/locations/bbox?minx=-110&miny=31&maxx=-103&maxy=37",
+        "/locations/nearest?lon=-106&lat=34",
+        "/locations/search?q=MG",
+    ):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.json() == []
+
+    response = client.get("/locations/jsonld")
+    assert response.status_code == 200 and response.content == b""
+    etag = response.headers["etag"]
+    response = client.get("/locations/jsonld", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert client.get("/locations/sitemap.xml").status_code == 200
+    assert client.get("/locations/sitemap/0.xml").status_code == 200
+    assert client.get("/locations/sitemap/1.xml").status_code == 404
+
+    polygon = {
+        "type": "Polygon",
+        "coordinates": [[[-110, 31], [-103, 31], [-103, 37], [-110, 37], [-110, 31]]],
+    }
+    response = client.post("/locations/within?stats=true", json=polygon)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["features"] == [] and body["stats"]["n_locations"] == 0
+    feature = {"type": "Feature", "properties": {}, "geometry": polygon}
+    assert client.post("/locations/within", json=feature).status_code == 200
+    point = {"type": "Point", "coordinates": [-106, 34]}
+    assert client.post("/locations/within", json=point).status_code == 422
+    feature = {"type": "Feature", "properties": {}, "geometry": "POLYGON"}
+    assert client.post("/locations/within", json=feature).status_code == 422
+
+
+def test_read_locations_within_stats(monkeypatch, tmp_path):
+    import uuid
+
+    import location_index
+    import summary
+
+    records = [(uuid.uuid4(), "MG-030", None, 350000, 3800000, 5000, "GPS")]
+    index = location_index.LocationIndex(
+        location_index.write_index(records, str(tmp_path))
+    )
+    row = {
+        "PointID": "mg-030",
+        "n_measurements": 3,
+        "last_depth_to_water_ftbgs": 10.0,
+        "change_1yr_ft": None,
+        "trend_ft_per_yr": None,
+    }
+    monkeypatch.setattr(location_index, "get_index", lambda db: index)
+    monkeypatch.setattr(summary, "read_summaries", lambda: [row])
+
+    polygon = {
+        "type": "Polygon",
+        "coordinates": [[[-110, 31], [-103, 31], [-103, 37], [-110, 37], [-110, 31]]],
+    }
+    response = client.post("/locations/within?stats=true", json=polygon)
+    assert response.status_code == 200
+    stats = response.json()["stats"]
+    assert stats["n_locations"] == 1 and stats["n_wells"] == 1
+
+
+def test_latest_waterlevels_refill_coalesced(monkeypatch):
+    from cache import cache
+
+    calls = []
+
+    def slow(db, start=None, end=None):
+        calls.append(db.info["statement_timeout"])
+        time.sleep(0.2)
+        return []
+
+    monkeypatch.setattr(crud, "latest_waterlevels", slow)
+    cache.invalidate("table:WaterLevels")
+    db = TestingSessionLocal()
+    db.info["statement_timeout"] = 15
+    try:
+        threads = [
+            threading.Thread(target=crud.read_latest_waterlevels, args=(db,))
+            for i in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # one refill, on its own session with the bulk timeout
+        from dependencies import BULK_TIMEOUT
+
+        assert calls == [BULK_TIMEOUT]
+    finally:
+        db.close()
+        cache.invalidate("table:WaterLevels")
+
+
+def test_singleflight():
+    flight = SingleFlight("test")
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return "result"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("key", work)))
+        for i in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert flight.followers == 4
+
+    async def awork():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "aresult"
+
+    async def scenario():
+        return await asyncio.gather(*[flight.do_async("key", awork) for i in range(5)])
+
+    assert asyncio.run(scenario()) == ["aresult"] * 5
+    assert len(calls) == 2
+
+
+class FakeRedis:
+    """
+    in-process stand-in for the handful of redis commands RedisBackend uses
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def ttl(self, key):
+        if key not in self.data:
+            return -2
+        return self.expires.get(key, -1)
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def persist(self, key):
+        self.expires.pop(key, None)
+
+    def sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member)
+
+    def smembers(self, key):
+        return self.data.get(key, set())
+
+    def delete(self, *keys):
+        return sum(1 for k in keys if self.data.pop(k, None) is not None)
+
+    def keys(self, pattern):
+        return [k for k in self.data if k.startswith(pattern.rstrip("*"))]
+
+
+@pytest.mark.parametrize(
+    "backend", [MemoryBackend(), RedisBackend(FakeRedis())], ids=["memory", "redis"]
+)
+def test_cache(backend):
+    cache = Cache(backend)
+    calls = []
+
+    @cache.cached(ttl=60, tags=lambda pointid: [f"pointid:{pointid}"])
+    def reader(pointid, db):
+        calls.append(pointid)
+        return [pointid] * 3
+
+    db = TestingSessionLocal()
+    assert reader("MG-030", db) == ["MG-030"] * 3
+    assert reader("MG-030", TestingSessionLocal()) == ["MG-030"] * 3
+    assert reader("MG-031", db) == ["MG-031"] * 3
+    assert calls == ["MG-030", "MG-031"]
+    assert cache.stats["reader"].hits == 1
+
+    if isinstance(backend, RedisBackend):
+        assert backend.client.ttl("nmaquifer:tag:pointid:MG-030") == 60
+
+    assert cache.invalidate("pointid:MG-030") == 1
+    reader("MG-030", db)
+    reader("MG-031", db)
+    assert calls == ["MG-030", "MG-031", "MG-030"]
+    db.close()
+
+
+def test_cached_readers_plain_data():
+    import pickle
+    import uuid
+
+    import models
+    from cache import cache
+
+    db = TestingSessionLocal()
+    location = models.Location(
+        LocationId=uuid.uuid4(),
+        PointID="CR-001",
+        PublicRelease=True,
+        Easting=400000,
+        Northing=3800000,
+    )
+    well = models.Well(
+        WellID=uuid.uuid4(), LocationId=location.LocationId, PointID="CR-001"
+    )
+    db.add_all([location, well])
+    db.commit()
+    cache.invalidate("table:Location", "table:WellData")
+
+    try:
+        first = TestingSessionLocal()
+        wells = crud.read_wells("CR-001", first)
+        locations = crud.read_location_list(first, "CR-001")
+        first.close()
+
+        # served from the cache to another session after the first one closed
+        second = TestingSessionLocal()
+        assert crud.read_wells("CR-001", second) is wells
+        assert crud.read_location_list(second, "CR-001") is locations
+        second.close()
+
+        assert wells[0].WellID == well.WellID and wells[0].formation_meaning is None
+        assert locations[0].geometry["type"] == "Point"
+        pickle.dumps((wells, locations))
+    finally:
+        db.delete(well)
+        db.delete(location)
+        db.commit()
+        db.close()
+        cache.invalidate("table:Location", "table:WellData")
+
+
+def test_cache_lru_bytes():
+    backend = MemoryBackend(max_bytes=2000)
+    for i in range(10):
+        backend.set(i, b"x" * 500, 0, ["table:WaterLevels"])
+
+    assert backend.bytes <= 2000
+    assert backend.get(0) is MISSING
+    assert backend.get(9) == b"x" * 500
+
+    backend.invalidate(["table:WaterLevels"])
+    assert backend.info()["entries"] == 0
+
+
+def test_waterlevels_public_semijoin():
+    import uuid
+    from datetime import date
+
+    import models
+    from cache import cache
+
+    db = TestingSessionLocal()
+    for reader in (
+        crud.read_waterlevels_manual_query,
+        crud.read_waterlevels_pressure_query,
+        crud.read_waterlevels_acoustic_query,
+    ):
+        # no implicit cross join against Location
+        for pointid in (None, "MG-030"):
+            froms = reader(pointid, db).statement.get_final_froms()
+            assert len(froms) == 1
+
+    public = models.Location(
+        LocationId=uuid.uuid4(), PointID="Sj-001", PublicRelease=True
+    )
+    hidden = models.Location(
+        LocationId=uuid.uuid4(), PointID="SJ-002", PublicRelease=False
+    )
+    wells = [
+        models.Well(WellID=uuid.uuid4(), LocationId=l.LocationId, PointID=l.PointID)
+        for l in (public, hidden)
+    ]
+    levels = [
+        models.WaterLevels(
+            OBJECTID=5000 + i,
+            WellID=w.WellID,
+            DateMeasured=date(2021, 1, 1),
+            DepthToWaterBGS=10 + i,
+        )
+        for i, w in enumerate(wells)
+    ]
+    db.add_all([public, hidden, *wells, *levels])
+    db.commit()
+    cache.invalidate("table:WellData", "table:WaterLevels")
+
+    try:
+        rows = crud.read_waterlevels_manual_query(None, db, as_dict=True).all()
+        assert [r.WellID for r in rows] == [wells[0].WellID]
+        assert crud.read_waterlevels_manual_query("SJ-002", db).all() == []
+        assert len(crud.read_waterlevels_manual_query("sj-001", db).all()) == 1
+
+        # lookups are case-insensitive, responses keep the stored PointID
+        latest = client.get("/wells/latest").json()
+        assert [r["PointID"] for r in latest] == ["Sj-001"]
+    finally:
+        for r in [*levels, *wells, public, hidden]:
+            db.delete(r)
+        db.commit()
+        db.close()
+        cache.invalidate("table:WellData", "table:WaterLevels")
+
+
 # ============= EOF =============================================
@@ -0,0 +1,222 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+Hydrograph sparkline thumbnails.
+
+Series are downsampled (min/max per pixel column) and drawn with matplotlib's
+Agg/SVG backends in a process pool, so drawing never holds a request worker.
+Requested sizes are rounded up to one of SIZES, so a well has a bounded
+number of renderings. Rendered images are kept on disk (THUMBNAIL_DIR) under
+a key that includes the well's data watermark. New data means a new key.
+The watermark itself is cached for WATERMARK_TTL seconds, so new data shows
+up within that.
+
+Files are served from memory, never by path, so they can be removed at any
+time. A background prune, at most every THUMBNAIL_PRUNE_EVERY seconds per
+worker, removes files older than THUMBNAIL_MAX_AGE (superseded watermarks
+are never requested again) and then the oldest until the directory is under
+THUMBNAIL_MAX_MB.
+"""
+
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cache import cache
+from crud import read_public_wells
+from hydrograph import read_combined_waterlevels
+from summary import read_watermarks
+
+THUMBNAIL_DIR = os.environ.get("THUMBNAIL_DIR", "./thumbnails")
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+WATERMARK_TTL = int(os.environ.get("THUMBNAIL_WATERMARK_TTL", 60))
+THUMBNAIL_MAX_AGE = float(os.environ.get("THUMBNAIL_MAX_AGE", 7 * 86400))
+THUMBNAIL_MAX_MB = float(os.environ.get("THUMBNAIL_MAX_MB", 512))
+THUMBNAIL_PRUNE_EVERY = float(os.environ.get("THUMBNAIL_PRUNE_EVERY", 600))
+FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+# pixel sizes a width or height is rounded up to
+SIZES = (16, 32, 60, 100, 200, 300, 400, 600, 800, 1200, 1600)
+
+_pool = None
+_pruned = 0
+_prune_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    return _pool
+
+
+def downsample(t, y, n):
+    """
+    reduce (t, y) to at most 2n points, keeping the min and max of each of n
+    equal-count buckets so spikes survive at sparkline resolution
+    """
+    valid = ~np.isnan(y)
+    t, y = t[valid], y[valid]
+    if len(t) <= 2 * n:
+        return t, y
+
+    bucket = np.arange(len(t)) * n // len(t)
+    order = np.lexsort((y, bucket))
+    b = bucket[order]
+    first = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    last = np.r_[first[1:], len(order)] - 1
+    keep = np.unique(np.concatenate([order[first], order[last]]))
+    return t[keep], y[keep]
+
+
+def render(t, y, fmt, w, h):
+    """
+    draw a sparkline. runs in a worker process
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    dpi = 100
+    fig = Figure(figsize=(w / dpi, h / dpi), dpi=dpi)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.plot(t, y, color="#1f77b4", linewidth=1)
+    ax.invert_yaxis()
+    ax.set_axis_off()
+    ax.margins(0.02, 0.08)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt, dpi=dpi, transparent=True)
+    return buf.getvalue()
+
+
+def snap(n):
+    """
+    the smallest of SIZES at least n
+    """
+    return next((s for s in SIZES if s >= n), SIZES[-1])
+
+
+def thumbnail_path(pointid, watermark, fmt, w, h):
+    key = hashlib.sha1(f"{pointid}|{watermark}".encode()).hexdigest()[:16]
+    return os.path.join(THUMBNAIL_DIR, f"{safe_name(pointid)}_{w}x{h}_{key}.{fmt}")
+
+
+def safe_name(pointid):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", pointid)
+
+
+@cache.cached(
+    ttl=WATERMARK_TTL,
+    tags=lambda pointid: [
+        f"pointid:{pointid}",
+        "table:WaterLevels",
+        "table:WaterLevelsContinuous_Pressure",
+        "table:WaterLevelsContinuous_Acoustic",
+    ],
+)
+def read_watermark(pointid, db):
+    """
+    watermark of a public well's data, or None if there is no such well
+    """
+    wellids = read_public_wells(db).get(pointid.upper())
+    if not wellids:
+        return
+    marks = read_watermarks(db, wellids)
+    return ";".join(marks.get(str(w), "") for w in sorted(wellids, key=str))
+
+
+def read_series(pointid, w, db):
+    df = read_combined_waterlevels(pointid, db)
+    df = df.dropna(subset=["measurement_datetime"])
+    t = df["measurement_datetime"].to_numpy()
+    y = df["depth_to_water_ftbgs"].to_numpy(dtype=float)
+    return downsample(t, y, w)
+
+
+def load(path):
+    """
+    a stored thumbnail, or None if it isn't there (or was just pruned)
+    """
+    try:
+        with open(path, "rb") as rfile:
+            return rfile.read()
+    except FileNotFoundError:
+        return
+
+
+def store(path, blob):
+    """
+    atomically write a thumbnail, and prune the directory in the background
+    if it is due
+    """
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as wfile:
+        wfile.write(blob)
+    os.replace(tmp, path)
+    prune_in_background()
+
+
+def prune(now=None):
+    """
+    remove thumbnails older than THUMBNAIL_MAX_AGE, then the oldest until
+    the directory holds at most THUMBNAIL_MAX_MB. returns the number removed
+    """
+    now = now or time.time()
+    files = []
+    with os.scandir(THUMBNAIL_DIR) as entries:
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+
+    files.sort()
+    budget = THUMBNAIL_MAX_MB * 1024 * 1024
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        if mtime >= now - THUMBNAIL_MAX_AGE and total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def prune_in_background():
+    global _pruned
+
+    with _prune_lock:
+        now = time.monotonic()
+        if _pruned and now - _pruned < THUMBNAIL_PRUNE_EVERY:
+            return
+        _pruned = now
+    threading.Thread(target=prune, name="thumbnail-prune", daemon=True).start()
+
+
+# ============= EOF =============================================